@@ -11,4 +11,4 @@ admin.site.register(Gene)
 admin.site.register(Tier)
 admin.site.register(UserTier)
 admin.site.register(UserGeneRequest)
-
+admin.site.register(UserGeneAccess)
@@ -0,0 +1,550 @@
+"""
+Numerical analyses behind the bulk RNA views.
+
+numpy and scikit-learn are imported inside the functions that need them: importing the views
+(and so every worker serving the login or calculator pages) should not load the analytical stack.
+
+The functions taking the expression matrix first are analyses in the sense of compute.py: the
+views run them in the compute pool and they must not modify the matrix in place.
+"""
+
+import logging
+import re
+
+from digiCells_core.tracing import span
+
+from .compute import call_analysis, call_cached_result
+from .dataset_statistics import stored_log_variance
+from .datasets import dataset_cache, dataset_version, get_expression_matrix
+from .heatmaps import overview_bins
+from .payloads import pack_values
+from .utils import expand_conditions, transform_tpm_data
+
+logger = logging.getLogger(__name__)
+
+
+def compute_pca(tsv_df, n_components=3, variance_threshold=0.1, log_variance=None):
+    """
+    Runs PCA over the samples of an expression matrix.
+
+    The matrix is log1p transformed, genes with a variance at or below `variance_threshold`
+    are dropped, and the remaining genes are standardised before fitting.
+
+    Args:
+        tsv_df (DataFrame): Expression values, genes as rows and samples as columns.
+        n_components (int): Number of principal components to return.
+        variance_threshold (float): Minimum per-gene variance (after log1p) to keep a gene.
+        log_variance (ndarray): Per-gene variance after log1p, in the order of the matrix's
+            rows, if already known (see dataset_statistics.py).
+
+    Returns:
+        tuple: (pca_result, conditions)
+            - pca_result: array of shape (samples, n_components).
+            - conditions: list of sample names, in the same order as the rows of pca_result.
+    """
+    import numpy as np
+    from sklearn.decomposition import PCA
+    from sklearn.preprocessing import StandardScaler
+
+    if log_variance is not None and len(log_variance) != len(tsv_df):
+        # Stored for another version than the file now holds
+        logger.warning(
+            "Stored variance of %d genes does not match the matrix's %d, ignoring it", len(log_variance), len(tsv_df)
+        )
+        log_variance = None
+
+    # Preprocessing: Log-transform and scale
+    with span("pca_preprocess"):
+        if log_variance is None:
+            log_tpm_df = np.log1p(tsv_df)
+            log_tpm_df = log_tpm_df.loc[
+                log_tpm_df.var(axis=1) > variance_threshold
+            ]  # Optional low-variance filtering
+        else:
+            # Only the genes kept are transformed
+            log_tpm_df = np.log1p(tsv_df.loc[log_variance > variance_threshold])
+
+        scaler = StandardScaler()
+        scaled_data = scaler.fit_transform(log_tpm_df.T)  # Transpose for PCA
+
+    # Perform PCA
+    with span("pca_fit"):
+        pca_result = PCA(n_components=n_components).fit_transform(scaled_data)
+
+    return pca_result, log_tpm_df.columns.tolist()
+
+
+def subset_pca(tsv_df, gene_df_ids, n_components=3):
+    """
+    compute_pca() over a subset of the genes, e.g. a marker panel or the most variable genes.
+    The subset's rows are looked up in the matrix's index and copied before anything is
+    transformed, so on a shared matrix (see compute.py) only they are read. Genes missing from
+    the dataset are ignored; every gene of the subset that varies across samples is kept.
+
+    Args:
+        gene_df_ids (list of str): Genes as in the matrix's index.
+
+    Returns:
+        tuple: (pca_result, conditions, n_genes), see compute_pca(). n_genes is the number of
+            genes the PCA used.
+
+    Raises:
+        ValueError: Fewer than `n_components` genes of the subset vary.
+    """
+    import numpy as np
+
+    with span("pca_subset", genes=len(gene_df_ids)):
+        rows = tsv_df.index.get_indexer_for(list(gene_df_ids))
+        # In the matrix's order, so the rows are read front to back
+        subset = tsv_df.iloc[np.unique(rows[rows >= 0])]
+        log_variance = np.log1p(subset.to_numpy(dtype=float)).var(axis=1, ddof=1)
+    n_genes = int((log_variance > 0).sum())
+    if n_genes < n_components:
+        raise ValueError(f"{n_genes} of the selected genes vary across samples, the PCA needs {n_components}")
+
+    pca_result, conditions = compute_pca(subset, n_components, variance_threshold=0.0, log_variance=log_variance)
+    return pca_result, conditions, n_genes
+
+
+def get_pca(path_to_tsv, n_components=3, in_process=False, generation=None, version=None):
+    """
+    PCA of a dataset with the default settings of compute_pca(), kept in the result cache
+    (see compute.py). In the compute pool it reads the dataset's shared export: this process
+    does not load the matrix.
+
+    Args:
+        in_process (bool): Compute in this process rather than in the compute pool.
+        generation (int): file_generation of the analysis, see datasets.py.
+        version (str): file_version of the analysis, looked up when not given.
+
+    Returns:
+        tuple: (pca_result, conditions), see compute_pca().
+    """
+    if not version:
+        version = dataset_cache.version(path_to_tsv) or dataset_version(path_to_tsv)
+
+    def compute():
+        log_variance = stored_log_variance(path_to_tsv, version)
+        if in_process:
+            return compute_pca(
+                get_expression_matrix(path_to_tsv, generation), n_components=n_components, log_variance=log_variance
+            )
+        return call_analysis(
+            compute_pca, path_to_tsv, n_components=n_components, log_variance=log_variance, generation=generation
+        )
+
+    return call_cached_result(
+        compute_pca, path_to_tsv, (n_components,), compute, generation=generation, version=version
+    )
+
+
+def benjamini_hochberg(p_values):
+    """
+    Benjamini-Hochberg adjusted p-values (false discovery rate). NaN p-values are left out of
+    the correction and stay NaN.
+
+    Args:
+        p_values (ndarray): One p-value per test.
+
+    Returns:
+        ndarray: Adjusted p-values, in the order of `p_values`.
+    """
+    import numpy as np
+
+    adjusted = np.full(len(p_values), np.nan)
+    tested = np.flatnonzero(~np.isnan(p_values))
+    order = tested[np.argsort(p_values[tested], kind="stable")]
+    ranked = p_values[order] * len(order) / np.arange(1, len(order) + 1)
+    # Each adjusted p-value is the smallest of the ranked values from its rank on
+    adjusted[order] = np.minimum(np.minimum.accumulate(ranked[::-1])[::-1], 1.0)
+    return adjusted
+
+
+def differential_expression(tsv_df, group_a, group_b, pseudocount=1.0):
+    """
+    Differential expression of every gene between two groups of samples: Welch's t-test on
+    log2(TPM + pseudocount), with Benjamini-Hochberg adjusted p-values.
+
+    Args:
+        tsv_df (DataFrame): Expression values, genes as rows and samples as columns.
+        group_a (list of str): Samples of the reference group, at least two.
+        group_b (list of str): Samples compared to it, at least two.
+        pseudocount (float): Added to the values before the log transform.
+
+    Returns:
+        DataFrame: One row per gene, sorted by adjusted p-value, with columns
+            mean_a, mean_b (mean TPM), log2_fold_change (b over a, difference of the mean
+            log2 values), t, p_value and p_adjusted. Genes that do not vary within either
+            group (e.g. not expressed) have no test: they are left out of the correction,
+            reported with a NaN t and p-values of 1, and sorted last.
+    """
+    import numpy as np
+    import pandas as pd
+    from scipy.special import stdtr
+
+    with span("slice", genes=len(tsv_df), samples=len(group_a) + len(group_b)):
+        values_a = tsv_df[group_a].to_numpy(dtype=float)
+        values_b = tsv_df[group_b].to_numpy(dtype=float)
+
+    with span("welch_t_test", genes=len(tsv_df)):
+        log_a = np.log2(values_a + pseudocount)
+        log_b = np.log2(values_b + pseudocount)
+        n_a, n_b = len(group_a), len(group_b)
+        # Squared standard errors of the two means
+        se2_a = log_a.var(axis=1, ddof=1) / n_a
+        se2_b = log_b.var(axis=1, ddof=1) / n_b
+        log2_fold_change = log_b.mean(axis=1) - log_a.mean(axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = log2_fold_change / np.sqrt(se2_a + se2_b)
+            # Welch-Satterthwaite degrees of freedom
+            dof = (se2_a + se2_b) ** 2 / (se2_a**2 / (n_a - 1) + se2_b**2 / (n_b - 1))
+            p_value = 2 * stdtr(dof, -np.abs(t))
+
+    with span("fdr"):
+        p_adjusted = benjamini_hochberg(p_value)
+        untested = np.isnan(p_value)
+        t[untested] = np.nan
+        p_value[untested] = 1.0
+        p_adjusted[untested] = 1.0
+
+    result = pd.DataFrame(
+        {
+            "mean_a": values_a.mean(axis=1),
+            "mean_b": values_b.mean(axis=1),
+            "log2_fold_change": log2_fold_change,
+            "t": t,
+            "p_value": p_value,
+            "p_adjusted": p_adjusted,
+        },
+        index=tsv_df.index,
+    )
+    return result.iloc[np.lexsort((p_value, p_adjusted, untested))]
+
+
+def coexpression_profiles(tsv_df, method="pearson", chunk_rows=4096):
+    """
+    Expression profiles of every gene, centred and scaled to unit length, so that the
+    correlation of two genes is the dot product of their profiles. With method="spearman"
+    the samples are ranked within each gene first.
+
+    Built `chunk_rows` genes at a time: besides the float32 result, only one chunk is held in
+    float64.
+
+    Args:
+        tsv_df (DataFrame): Expression values, genes as rows and samples as columns.
+        method (str): "pearson" or "spearman".
+
+    Returns:
+        tuple: (genes, profiles, varies)
+            - genes: the index of `tsv_df`.
+            - profiles: float32 array of shape (genes, samples). Rows of genes with constant
+              expression are zero.
+            - varies: boolean array, False for the genes with constant expression, whose
+              correlation is undefined.
+    """
+    import numpy as np
+    from scipy.stats import rankdata
+
+    if method not in ("pearson", "spearman"):
+        raise ValueError(f"Unknown correlation method {method!r}")
+
+    values = tsv_df.to_numpy()
+    profiles = np.zeros(values.shape, dtype=np.float32)
+    varies = np.zeros(len(values), dtype=bool)
+    with span("standardise", genes=len(values), method=method):
+        for start in range(0, len(values), chunk_rows):
+            chunk = np.asarray(values[start : start + chunk_rows], dtype=float)
+            if method == "spearman":
+                chunk = rankdata(chunk, axis=1)
+            chunk = chunk - chunk.mean(axis=1, keepdims=True)
+            norms = np.linalg.norm(chunk, axis=1, keepdims=True)
+            rows = slice(start, start + len(chunk))
+            varies[rows] = norms[:, 0] > 0
+            np.divide(chunk, norms, out=profiles[rows], where=norms > 0)
+    return tsv_df.index, profiles, varies
+
+
+def top_correlated(profiles, gene_df_id, k, allowed=None, candidates=None):
+    """
+    The genes whose expression correlates best with a query gene, with a single matrix-vector
+    product over the profiles.
+
+    Args:
+        profiles (tuple): (genes, profiles, varies), see coexpression_profiles().
+        gene_df_id (str): Query gene, as in the matrix's index.
+        k (int): Number of genes to return.
+        allowed (list of str): Only return these genes, None for any gene.
+        candidates (ndarray): Only score these rows, e.g. those found by a similarity index.
+            None scores every gene.
+
+    Returns:
+        dict: {"genes": [str], "correlations": [float]}, best correlated first, without the
+            query gene and the genes with constant expression. Empty when the query gene has
+            constant expression.
+
+    Raises:
+        KeyError: The query gene is not in the matrix.
+    """
+    import numpy as np
+
+    genes, matrix, varies = profiles
+    row = genes.get_loc(gene_df_id)
+    if not varies[row]:
+        return {"genes": [], "correlations": []}
+
+    rows = np.arange(len(genes)) if candidates is None else np.asarray(candidates)
+    with span("correlate", genes=len(rows)):
+        scores = matrix @ matrix[row] if candidates is None else matrix[rows] @ matrix[row]
+
+    keep = varies[rows] & (rows != row)
+    if allowed is not None:
+        keep &= genes.isin(allowed)[rows]
+    scores[~keep] = -np.inf
+
+    k = min(k, int(keep.sum()))
+    if k <= 0:
+        return {"genes": [], "correlations": []}
+    best = np.argpartition(-scores, k - 1)[:k]
+    best = best[np.argsort(-scores[best], kind="stable")]
+    return {
+        "genes": genes[rows[best]].tolist(),
+        # Rounding errors of float32 can take a correlation slightly past 1
+        "correlations": np.clip(scores[best], -1.0, 1.0).astype(float).tolist(),
+    }
+
+
+def get_coexpression_profiles(path_to_tsv, method="pearson", generation=None):
+    """coexpression_profiles() of a dataset, built once per worker and cached with the dataset."""
+    return dataset_cache.artifact(
+        path_to_tsv, f"coexpression:{method}", lambda tsv_df: coexpression_profiles(tsv_df, method), generation
+    )
+
+
+def get_coexpression(path_to_tsv, gene_df_id, method, k, allowed=None, generation=None):
+    """
+    top_correlated() on the profiles of a dataset. Queries run in-process on the worker's
+    profiles: a single product is cheaper than sending it to the compute pool.
+
+    Args:
+        generation (int): file_generation of the analysis, see datasets.py.
+    """
+    profiles = get_coexpression_profiles(path_to_tsv, method, generation)
+    return top_correlated(profiles, gene_df_id, k, allowed)
+
+
+GENE_SET_METHODS = ("mean_z", "rank")
+
+
+def gene_set_scores(tsv_df, gene_sets, method="mean_z"):
+    """
+    Scores gene sets in every sample, with one product of a sparse set membership matrix and
+    the expression matrix.
+
+    - mean_z: mean z-score of the set's genes, each gene z-scored across the samples as by
+      the explore page's center and scale.
+    - rank: single-sample rank score, after singscore: mean rank of the set's genes among all
+      the genes of the sample (ties get their average rank), scaled to [0, 1] between the
+      lowest and highest mean rank a set of that size can have.
+
+    Args:
+        tsv_df (DataFrame): Expression values, genes as rows and samples as columns.
+        gene_sets (list of list of str): Genes of each set, as in the matrix's index. Genes
+            missing from the matrix are ignored.
+        method (str): One of GENE_SET_METHODS.
+
+    Returns:
+        dict: {"samples": [str], "sizes": [number of genes of each set in the matrix],
+            "scores": packed values, sets x samples}. Sets with no genes in the matrix score NaN.
+    """
+    import numpy as np
+    from scipy import sparse
+    from scipy.stats import rankdata
+
+    if method not in GENE_SET_METHODS:
+        raise ValueError(f"Unknown gene set scoring method {method!r}")
+
+    with span("membership", sets=len(gene_sets)):
+        set_rows = np.repeat(np.arange(len(gene_sets)), [len(genes) for genes in gene_sets])
+        gene_rows = tsv_df.index.get_indexer([gene for genes in gene_sets for gene in genes])
+        found = gene_rows >= 0
+        membership = sparse.csr_matrix(
+            (np.ones(found.sum()), (set_rows[found], gene_rows[found])), shape=(len(gene_sets), len(tsv_df))
+        )
+        # A gene listed twice in a set counts once
+        membership.data[:] = 1.0
+        sizes = np.diff(membership.indptr)
+
+    with span("gene_set_transform", method=method):
+        if method == "mean_z":
+            values = transform_tpm_data(tsv_df, center=True, scale=True).to_numpy()
+        else:
+            values = rankdata(tsv_df.to_numpy(), axis=0)
+
+    with span("gene_set_product", sets=len(gene_sets), genes=len(tsv_df)):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            scores = (membership @ values) / sizes[:, None]
+            if method == "rank":
+                lowest = (sizes + 1) / 2
+                highest = (2 * len(tsv_df) - sizes + 1) / 2
+                scores = (scores - lowest[:, None]) / (highest - lowest)[:, None]
+
+    return {"samples": list(tsv_df.columns), "sizes": sizes.tolist(), "scores": pack_values(scores)}
+
+
+def box_plot_data(tsv_df, gene_df_id, conditions, normalisation):
+    """
+    Normalised expression of one gene across `conditions`, in their order, packed by
+    payloads.pack_values().
+    """
+    with span("normalise"):
+        processed_tsv_df = transform_tpm_data(
+            tsv_df,
+            center=normalisation["center"],
+            scale=normalisation["scale"],
+        )
+    with span("slice", genes=1, conditions=len(conditions)):
+        gene_series = processed_tsv_df.loc[gene_df_id, conditions]
+    with span("serialise"):
+        return pack_values(gene_series.values)
+
+
+def _normalised_rows(tsv_df, gene_df_ids, normalisation):
+    # Normalisation is per gene, over all the samples: only the selected genes need it
+    with span("slice", genes=len(gene_df_ids)):
+        rows = tsv_df.loc[gene_df_ids]
+    with span("normalise"):
+        return transform_tpm_data(
+            rows,
+            center=normalisation["center"],
+            scale=normalisation["scale"],
+        )
+
+
+def heatmap_data(tsv_df, gene_df_ids, conditions, normalisation):
+    """
+    Normalised expression of several genes across `conditions`, one row per gene, packed by
+    payloads.pack_values(). Also serves the tiles of tiled heatmaps (see heatmaps.py).
+    """
+    heatmap_df = _normalised_rows(tsv_df, gene_df_ids, normalisation)[conditions]
+    with span("serialise"):
+        return pack_values(heatmap_df.values)
+
+
+def heatmap_overview(tsv_df, gene_df_ids, conditions, normalisation, max_rows):
+    """
+    heatmap_data() of many genes, mean-pooled into at most `max_rows` rows of consecutive genes
+    (see heatmaps.overview_bins()).
+    """
+    import numpy as np
+
+    values = _normalised_rows(tsv_df, gene_df_ids, normalisation)[conditions].to_numpy(dtype=float)
+    with span("pool", genes=len(gene_df_ids), rows=max_rows):
+        starts = overview_bins(len(gene_df_ids), max_rows)
+        sizes = np.diff(starts + [len(gene_df_ids)])
+        pooled = np.add.reduceat(values, starts, axis=0) / sizes[:, None]
+    with span("serialise"):
+        return pack_values(pooled)
+
+
+BOX_STATISTICS = ("min", "q1", "median", "q3", "max", "mean", "sd")
+
+
+def condition_group(sample):
+    """The condition of a sample: its name without the replicate suffix ("ioA_D0_R1" -> "ioA_D0")."""
+    return re.sub(r"_R\d+$", "", sample)
+
+
+def box_summaries(tsv_df, gene_df_ids, samples, normalisation, points=False):
+    """
+    Box plot statistics of several genes per condition, the replicates of a condition forming
+    one box. Each statistic is computed for every gene at once.
+
+    Args:
+        samples (list of str): Samples to summarise; boxes follow the order of their conditions.
+        points (bool): Also return the values of each sample.
+
+    Returns:
+        dict:
+            - groups: condition names, one per box.
+            - sizes: number of samples in each box.
+            - stats: for each of BOX_STATISTICS, a genes x groups matrix packed by
+              payloads.pack_values(). Quartiles are interpolated linearly, as Plotly does;
+              sd is the sample standard deviation, 0 for a single replicate.
+            - points (with `points`): the genes x samples values, packed.
+    """
+    import numpy as np
+
+    values = _normalised_rows(tsv_df, gene_df_ids, normalisation)[samples].to_numpy(dtype=float)
+    sample_groups = [condition_group(sample) for sample in samples]
+    groups = list(dict.fromkeys(sample_groups))
+
+    with span("summarise", genes=len(gene_df_ids), groups=len(groups)):
+        stats = {name: np.empty((len(gene_df_ids), len(groups))) for name in BOX_STATISTICS}
+        sizes = []
+        for column, group in enumerate(groups):
+            block = values[:, [i for i, sample_group in enumerate(sample_groups) if sample_group == group]]
+            sizes.append(block.shape[1])
+            quantiles = np.quantile(block, [0, 0.25, 0.5, 0.75, 1], axis=1)
+            for name, quantile in zip(("min", "q1", "median", "q3", "max"), quantiles):
+                stats[name][:, column] = quantile
+            stats["mean"][:, column] = block.mean(axis=1)
+            stats["sd"][:, column] = block.std(axis=1, ddof=1) if block.shape[1] > 1 else 0.0
+
+    with span("serialise"):
+        result = {
+            "groups": groups,
+            "sizes": sizes,
+            "stats": {name: pack_values(matrix) for name, matrix in stats.items()},
+        }
+        if points:
+            result["points"] = pack_values(values)
+        return result
+
+
+def condition_means(tsv_df, gene_df_ids, selected_conditions_raw, normalisation):
+    """
+    Expression of the selected genes averaged over the replicates of each selected condition,
+    as offered by the CSV download.
+
+    Args:
+        selected_conditions_raw (list of str): Conditions, with ("ioA_D0_R1") or without
+            ("ioA_D0") replicate; the latter stand for all their replicates.
+
+    Returns:
+        DataFrame: Genes as rows, one column per condition and timepoint.
+    """
+    processed_tsv_df = _normalised_rows(tsv_df, gene_df_ids, normalisation)
+
+    # Get replicates
+    selected_conditions = expand_conditions(selected_conditions_raw, list(tsv_df.columns))
+
+    logger.debug("Selected conditions %s", selected_conditions)
+
+    # Filter data for selected conditions
+    filtered_df = processed_tsv_df[selected_conditions]
+
+    # Calculate the average expression values across replicates
+    # Assuming replicate names end with _R1, _R2, etc.
+    return (
+        filtered_df.T.groupby(
+            # Group by condition and timepoint
+            by=[f"{col.split('_')[0]}_{col.split('_')[1]}" for col in filtered_df.columns],
+        )
+        .mean()
+        .T
+    )
+
+
+def encode_labels(labels):
+    """
+    Maps each label to the index of its value in the sorted unique labels, as
+    sklearn's LabelEncoder.fit_transform does.
+
+    Args:
+        labels (list of str): Labels to encode.
+
+    Returns:
+        list of int: One code per label.
+    """
+    codes = {label: code for code, label in enumerate(sorted(set(labels)))}
+    return [codes[label] for label in labels]
@@ -0,0 +1,636 @@
+"""
+Synthetic data and a benchmark harness for the bulk RNA hot paths.
+
+Used by the ``generate_synthetic_dataset`` and ``run_benchmarks`` management commands.
+Datasets follow the naming used by real analyses: genes are indexed as
+``<ensembl id>_<gene name>`` and samples are named ``<cell type>_<day>_R<replicate>``.
+"""
+
+import gzip
+import hashlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+
+from .models import Gene
+
+DEFAULT_CELL_TYPES = ("ioGABA", "ioMicroglia", "ioMyocytes", "ioGlutamatergic")
+DEFAULT_DAYS = ("D0", "D3", "D7", "D14", "D21", "D28")
+
+# Where load_genes_from_gtf looks for its annotation file
+GTF_BUCKET = "bitbio-ref-data"
+GTF_KEY = "Genomes/GRCh38-GENCODE/release-45/gencode.v45.primary_assembly.annotation.sorted.gtf.gz"
+
+
+def synthetic_sample_names(n_samples, cell_types=DEFAULT_CELL_TYPES, replicates=3):
+    """
+    Returns `n_samples` sample names in the cell_day_R# convention, filling replicates
+    first, then days, then cell types. Extra days (D35, D42, ...) are added if needed.
+    """
+    names = []
+    day_index = 0
+    while len(names) < n_samples:
+        day = DEFAULT_DAYS[day_index] if day_index < len(DEFAULT_DAYS) else f"D{7 * (day_index - 1)}"
+        for cell_type in cell_types:
+            for replicate in range(1, replicates + 1):
+                names.append(f"{cell_type}_{day}_R{replicate}")
+        day_index += 1
+    return names[:n_samples]
+
+
+def synthetic_genes(n_genes):
+    """Returns a list of (ensembl_id, gene_name) pairs, with a version suffix on the Ensembl ID."""
+    return [(f"ENSG{i:011d}.{1 + i % 3}", f"SYN{i}") for i in range(n_genes)]
+
+
+def df_string(ensembl_id, gene_name):
+    return f"{ensembl_id.split('.')[0]}_{gene_name}"
+
+
+def generate_expression_matrix(n_genes, n_samples, seed=0, cell_types=DEFAULT_CELL_TYPES):
+    """
+    Builds a TPM-like matrix (genes x samples) with a long-tailed expression distribution,
+    a per-cell-type effect and replicate noise, so that PCA and differential expression
+    have real structure to find.
+    """
+    rng = np.random.default_rng(seed)
+    samples = synthetic_sample_names(n_samples, cell_types)
+    genes = synthetic_genes(n_genes)
+
+    base = rng.lognormal(mean=1.0, sigma=1.5, size=(n_genes, 1))
+    sample_cell_types = [name.split("_")[0] for name in samples]
+    effects = {cell_type: rng.lognormal(0.0, 0.5, size=(n_genes, 1)) for cell_type in set(sample_cell_types)}
+    effect_matrix = np.hstack([effects[cell_type] for cell_type in sample_cell_types])
+    noise = rng.lognormal(0.0, 0.2, size=(n_genes, n_samples))
+    values = (base * effect_matrix * noise).astype(np.float64)
+
+    # A share of genes is not expressed at all, as in real data
+    values[rng.random(n_genes) < 0.15] = 0.0
+
+    return pd.DataFrame(values, index=[df_string(*gene) for gene in genes], columns=samples)
+
+
+def write_matrix(df, path):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    df.to_csv(path, sep="\t", float_format="%.4f")
+
+
+def write_gtf(path, n_genes):
+    """Writes a gzipped GTF with one gene record per synthetic gene, as parsed by load_genes_from_gtf."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with gzip.open(path, "wt") as gtf_file:
+        gtf_file.write("##description: synthetic annotation\n")
+        for i, (ensembl_id, gene_name) in enumerate(synthetic_genes(n_genes)):
+            start = 1000 + i * 1000
+            gtf_file.write(
+                f"chr1\tHAVANA\tgene\t{start}\t{start + 500}\t.\t+\t.\t"
+                f'gene_id "{ensembl_id}"; gene_type "protein_coding"; gene_name "{gene_name}"; level 2;\n'
+            )
+
+
+def create_gene_rows(n_genes, batch_size=5000):
+    """Creates Gene rows for the synthetic genes that do not exist yet. Returns the number created."""
+    existing = set(Gene.objects.filter(gene_name__startswith="SYN").values_list("ensembl_id", flat=True))
+    new_genes = [
+        Gene(gene_name=gene_name, ensembl_id=ensembl_id)
+        for ensembl_id, gene_name in synthetic_genes(n_genes)
+        if ensembl_id not in existing
+    ]
+    Gene.objects.bulk_create(new_genes, batch_size=batch_size)
+    return len(new_genes)
+
+
+class LocalS3:
+    """
+    Minimal stand-in for a boto3 S3 client, serving objects from ``<root>/<bucket>/<key>``.
+
+    Implements the calls the data layer makes (get_object with optional Range, head_object,
+    download_file, put_object). ``latency`` adds a fixed delay per call to mimic a remote store.
+    """
+
+    def __init__(self, root, latency=0.0):
+        self.root = root
+        self.latency = latency
+
+    def _path(self, bucket, key):
+        return os.path.join(self.root, bucket, key)
+
+    def _wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _etag(self, path):
+        stat = os.stat(path)
+        return '"' + hashlib.md5(f"{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest() + '"'
+
+    def get_object(self, Bucket, Key, Range=None):
+        self._wait()
+        path = self._path(Bucket, Key)
+        with open(path, "rb") as handle:
+            if Range:
+                start, _, end = Range.replace("bytes=", "").partition("-")
+                handle.seek(int(start))
+                data = handle.read(int(end) - int(start) + 1 if end else -1)
+            else:
+                data = handle.read()
+        return {"Body": io.BytesIO(data), "ContentLength": len(data), "ETag": self._etag(path)}
+
+    def head_object(self, Bucket, Key):
+        self._wait()
+        path = self._path(Bucket, Key)
+        stat = os.stat(path)
+        return {
+            "ContentLength": stat.st_size,
+            "ETag": self._etag(path),
+            "LastModified": datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc),
+        }
+
+    def download_file(self, Bucket, Key, Filename):
+        self._wait()
+        shutil.copyfile(self._path(Bucket, Key), Filename)
+
+    def put_object(self, Bucket, Key, Body):
+        self._wait()
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as handle:
+            handle.write(Body if isinstance(Body, bytes) else Body.encode())
+        return {"ETag": self._etag(path)}
+
+
+class BenchmarkSuite:
+    """
+    End-to-end benchmarks of the bulk RNA hot paths against a synthetic dataset.
+
+    Expects an empty database (run_benchmarks creates a throwaway test database). ``setup()``
+    writes the matrix and a GTF under `workdir`, serves them through a LocalS3 stand-in, and
+    creates the Gene rows, an AnalysisOutput and a Researcher user. View benchmarks go through
+    the Django test client, so middleware, ORM and template costs are included.
+    """
+
+    def __init__(self, workdir, n_genes, n_samples, heatmap_genes=100, gtf_genes=2000, s3_latency=0.0, seed=0):
+        self.workdir = workdir
+        self.n_genes = n_genes
+        self.n_samples = n_samples
+        self.heatmap_genes = min(heatmap_genes, n_genes)
+        # Enough genes for a tiled heatmap
+        self.tiled_genes = min(max(heatmap_genes, settings.BULK_RNA_HEATMAP_TILE_THRESHOLD + 1), n_genes)
+        self.gtf_genes = gtf_genes
+        self.s3 = LocalS3(os.path.join(workdir, "s3"), latency=s3_latency)
+        self.seed = seed
+
+    def setup(self):
+        from django.contrib.auth.models import User
+        from django.test import Client
+
+        from .models import AnalysisOutput, Tier, UserTier
+
+        self.matrix = generate_expression_matrix(self.n_genes, self.n_samples, seed=self.seed)
+        self.local_path = os.path.join(self.workdir, "matrix.tsv")
+        write_matrix(self.matrix, self.local_path)
+        self.s3_path = "s3://bench-data/matrix.tsv"
+        os.makedirs(os.path.join(self.s3.root, "bench-data"), exist_ok=True)
+        shutil.copyfile(self.local_path, os.path.join(self.s3.root, "bench-data", "matrix.tsv"))
+        write_gtf(os.path.join(self.s3.root, GTF_BUCKET, GTF_KEY), self.gtf_genes)
+
+        create_gene_rows(self.n_genes)
+        self.analysis = AnalysisOutput.objects.create(
+            metadata={"synthetic": True},
+            file_path=self.s3_path,
+            product="ioGABA",
+            conditions=",".join(DEFAULT_DAYS),
+            is_visible_in_commercial_app=True,
+        )
+
+        researcher_tier, _ = Tier.objects.get_or_create(name="Researcher", defaults={"max_genes": 10**9})
+        self.user = User.objects.create_user("benchmark", password="benchmark")
+        UserTier.objects.create(user=self.user, tier=researcher_tier)
+        self.client = Client()
+        self.client.force_login(self.user)
+
+        self.gene_ids = list(self.matrix.index)
+        self.conditions = sorted({"_".join(name.split("_")[:-1]) for name in self.matrix.columns})
+
+    def cases(self):
+        """Returns a list of (name, callable) pairs."""
+        from django.urls import reverse
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        from asgiref.sync import async_to_sync
+        from django.core.cache import cache
+
+        from .analytics import (
+            coexpression_profiles,
+            compute_pca,
+            condition_group,
+            differential_expression,
+            gene_set_scores,
+            subset_pca,
+            top_correlated,
+        )
+        from .compute import call_analysis
+        from .dataset_statistics import compute_dataset_statistics
+        from .datasets import columns_cache_key, dataset_cache, get_expression_matrix, load_expression_matrix
+        from .heatmaps import save_heatmap
+        from .similarity import SimilarityIndex, index_bits
+        from .utils import transform_tpm_data
+
+        explore_url = reverse("bulk_rna:explore_analysis", args=[self.analysis.id])
+        heatmap_genes = self.gene_ids[: self.heatmap_genes]
+        tiled_genes = self.gene_ids[: self.tiled_genes]
+        zscore = {"center": "true", "scale": "true"}
+        # 200 gene sets of 5 to 300 genes, as a pathway collection would have
+        rng = np.random.default_rng(self.seed)
+        gene_sets = [
+            list(rng.choice(self.gene_ids, rng.integers(5, 300), replace=False)) for _ in range(200)
+        ]
+        # The first gene whose expression varies: others have no correlations
+        query_gene = self.gene_ids[int(np.flatnonzero(self.matrix.to_numpy().std(axis=1) > 0)[0])]
+        de_groups = [
+            [sample for sample in self.matrix.columns if condition_group(sample) == condition]
+            for condition in self.conditions[:2]
+        ]
+
+        panel_genes = list(self.matrix.index[:: max(1, len(self.matrix) // 500)])
+
+        # Co-expression queries run against profiles built beforehand, as cached per worker
+        profiles = {}
+        similarity = {}
+        stored = {}
+
+        def pearson_profiles():
+            if "pearson" not in profiles:
+                profiles["pearson"] = coexpression_profiles(self.matrix)
+            return profiles["pearson"]
+
+        def build_similarity_index():
+            genes, matrix, varies = pearson_profiles()
+            return SimilarityIndex.build(
+                matrix, settings.BULK_RNA_SIMILARITY_TABLES,
+                index_bits(len(genes), settings.BULK_RNA_SIMILARITY_BUCKET_SIZE),
+            )
+
+        def similarity_queries(probes=None, k=20):
+            # The same 20 genes each time; the exact scan (probes=None) is the reference
+            genes, matrix, varies = pearson_profiles()
+            if "queries" not in similarity:
+                rng = np.random.default_rng(self.seed)
+                similarity["queries"] = list(genes[rng.choice(np.flatnonzero(varies), 20, replace=False)])
+                similarity["exact"] = {
+                    gene: set(top_correlated(profiles["pearson"], gene, k)["genes"]) for gene in similarity["queries"]
+                }
+                similarity["index"] = build_similarity_index()
+            found = 0
+            for gene in similarity["queries"]:
+                if probes is None:
+                    result = top_correlated(profiles["pearson"], gene, k)
+                else:
+                    candidates = similarity["index"].candidates(matrix[genes.get_loc(gene)], probes)
+                    result = top_correlated(profiles["pearson"], gene, k, candidates=candidates)
+                found += len(similarity["exact"][gene] & set(result["genes"]))
+            return {"recall_at_k": found / (k * len(similarity["queries"]))}
+
+        def dataset_statistics():
+            # Not returned: time_callable would report the arrays
+            compute_dataset_statistics(self.matrix)
+
+        def log_variance():
+            if "log_variance" not in stored:
+                stored["log_variance"] = compute_dataset_statistics(self.matrix)["log_variance"]
+            return stored["log_variance"]
+
+        def cold_concurrent_load(threads=8):
+            # A cold dataset requested by several users at once: one download and parse, shared
+            dataset_cache.clear()
+            shutil.rmtree(settings.BULK_RNA_DATASET_SPOOL_DIR, ignore_errors=True)
+            with ThreadPoolExecutor(threads) as pool:
+                list(pool.map(lambda _: get_expression_matrix(self.s3_path), range(threads)))
+
+        def cold_explore_get():
+            # First visit of the explore page: nothing cached in this worker or the shared cache.
+            # Only the dataset's header is dropped from the shared cache, it also holds the
+            # selections of tiled heatmaps.
+            dataset_cache.clear()
+            self.analysis.refresh_from_db(fields=["file_generation"])
+            cache.delete(columns_cache_key(self.s3_path, self.analysis.file_generation))
+            get(explore_url)
+
+        def heatmap_tile():
+            # Saved here rather than once: the selection expires, and other cases may evict it
+            heatmap_id, _ = async_to_sync(save_heatmap)(
+                self.user, self.analysis, tiled_genes, sorted(self.matrix.columns), zscore, "Researcher"
+            )
+            get(reverse("bulk_rna:heatmap_tile", args=[self.analysis.id, heatmap_id]), {"tile": 1})
+
+        def post(url, data):
+            response = self.client.post(url, data)
+            assert response.status_code == 200, (url, response.status_code, response.content[:200])
+            return response
+
+        def get(url, data=None):
+            response = self.client.get(url, data)
+            assert response.status_code == 200, (url, response.status_code, response.content[:200])
+            return response
+
+        return [
+            ("dataset_load_local", lambda: load_expression_matrix(self.local_path)),
+            ("dataset_load_s3", lambda: load_expression_matrix(self.s3_path)),
+            ("dataset_cached", lambda: get_expression_matrix(self.s3_path)),
+            ("dataset_cold_concurrent", cold_concurrent_load),
+            ("normalise_zscore", lambda: transform_tpm_data(self.matrix, center=True, scale=True)),
+            ("explore_get", lambda: get(explore_url)),
+            ("explore_get_cold", cold_explore_get),
+            (
+                "explore_single_gene",
+                lambda: post(explore_url, {
+                    "selection_type": "individual", "genes": heatmap_genes[:1], "display_field": "x",
+                }),
+            ),
+            (
+                "explore_heatmap",
+                lambda: post(explore_url, {
+                    "selection_type": "individual", "genes": heatmap_genes, "display_field": "x",
+                }),
+            ),
+            (
+                # z-scores have full-precision values, unlike the TPMs read from the file
+                "explore_heatmap_zscore",
+                lambda: post(explore_url, {
+                    "selection_type": "individual", "genes": heatmap_genes, "display_field": "x",
+                    **zscore,
+                }),
+            ),
+            (
+                "explore_heatmap_tiled",
+                lambda: post(explore_url, {
+                    "selection_type": "individual", "genes": tiled_genes, "display_field": "x", **zscore,
+                }),
+            ),
+            # The next window of a tiled heatmap, as fetched when paging through it
+            ("heatmap_tile", heatmap_tile),
+            (
+                # 20 genes compared as box plots in one request
+                "box_summaries",
+                lambda: post(reverse("bulk_rna:box_plot_summaries", args=[self.analysis.id]), {
+                    "genes": heatmap_genes[:20], "display_field": "x", "points": "1",
+                }),
+            ),
+            (
+                # Every gene, the replicates of two conditions against each other
+                "differential_expression_compute",
+                lambda: differential_expression(self.matrix, de_groups[0], de_groups[1]),
+            ),
+            (
+                "differential_expression",
+                lambda: get(reverse("bulk_rna:differential_expression_view", args=[self.analysis.id]), {
+                    "group_a": self.conditions[0], "group_b": self.conditions[1],
+                }),
+            ),
+            ("coexpression_profiles", lambda: coexpression_profiles(self.matrix)),
+            ("coexpression_profiles_spearman", lambda: coexpression_profiles(self.matrix, "spearman")),
+            ("coexpression_query", lambda: top_correlated(pearson_profiles(), query_gene, 50)),
+            (
+                "coexpression",
+                lambda: get(reverse("bulk_rna:coexpression", args=[self.analysis.id]), {
+                    "gene": query_gene, "k": 50,
+                }),
+            ),
+            ("similarity_index_build", build_similarity_index),
+            # 20 top-20 co-expression queries, exact and through the similarity index, with recall@20
+            ("similarity_exact", similarity_queries),
+            ("similarity_probes_0", lambda: similarity_queries(probes=0)),
+            ("similarity_probes_2", lambda: similarity_queries(probes=2)),
+            ("similarity_probes_8", lambda: similarity_queries(probes=8)),
+            ("gene_set_scores_mean_z", lambda: gene_set_scores(self.matrix, gene_sets, "mean_z")),
+            ("gene_set_scores_rank", lambda: gene_set_scores(self.matrix, gene_sets, "rank")),
+            ("dataset_statistics_compute", dataset_statistics),
+            ("pca_compute", lambda: compute_pca(self.matrix)),
+            # The PCA's gene filter reading the variances stored by dataset_statistics
+            ("pca_compute_stored_variance", lambda: compute_pca(self.matrix, log_variance=log_variance())),
+            # Same PCA in the compute pool, on the shared export: the round trip and mapping overhead
+            ("pca_compute_pool", lambda: call_analysis(compute_pca, self.s3_path)),
+            ("pca", lambda: get(reverse("bulk_rna:pca_view", args=[self.analysis.id]))),
+            # PCA over 500 genes spread through the matrix, e.g. a marker panel
+            ("pca_subset_compute", lambda: subset_pca(self.matrix, panel_genes, 3)),
+            ("pca_subset_pool", lambda: call_analysis(subset_pca, self.s3_path, panel_genes, 3)),
+            (
+                "csv_export",
+                lambda: post(reverse("bulk_rna:download_csv", args=[self.analysis.id]), {
+                    "genes": ",".join(heatmap_genes), "conditions": ",".join(self.conditions),
+                }),
+            ),
+            ("gtf_load", lambda: get(reverse("bulk_rna:load_genes_from_gtf"))),
+            ("gene_autocomplete", lambda: get(reverse("bulk_rna:gene_autocomplete"), {"term": "SYN12"})),
+        ]
+
+    def run(self, repeat=5, warmup=1, only=None, progress=None):
+        from django.test import override_settings
+
+        from .datasets import use_s3_client
+        from .usage import recorder
+
+        results = {
+            "environment": environment_info(),
+            "parameters": {
+                "genes": self.n_genes,
+                "samples": self.n_samples,
+                "heatmap_genes": self.heatmap_genes,
+                "tiled_genes": self.tiled_genes,
+                "gtf_genes": self.gtf_genes,
+                "s3_latency": self.s3.latency,
+            },
+            "benchmarks": {},
+        }
+        # Usage records are flushed between benchmarks rather than by the background thread,
+        # so that flushes do not land inside another benchmark's timings
+        recorder.background_flush = False
+        try:
+            with use_s3_client(self.s3), override_settings(
+                BULK_RNA_DATASET_SPOOL_DIR=os.path.join(self.workdir, "spool"),
+                BULK_RNA_SHARED_MATRIX_DIR=os.path.join(self.workdir, "shared"),
+                # Heatmap benchmarks post one field per gene
+                DATA_UPLOAD_MAX_NUMBER_FIELDS=max(1000, self.tiled_genes + 100),
+            ):
+                for name, fn in self.cases():
+                    if only and name not in only:
+                        continue
+                    results["benchmarks"][name] = time_callable(fn, repeat=repeat, warmup=warmup)
+                    recorder.flush()
+                    if progress:
+                        progress(name, results["benchmarks"][name])
+        finally:
+            recorder.background_flush = True
+        return results
+
+
+def time_callable(fn, repeat=5, warmup=1):
+    """
+    Runs `fn` `warmup` times untimed, then `repeat` times, and returns timing statistics in seconds.
+    When `fn` returns a response, the size of its body is reported too, and when it returns a
+    dict, its items (e.g. the recall of an approximate search).
+    """
+    for _ in range(warmup):
+        fn()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - start)
+    stats = {
+        "repeat": repeat,
+        "min": min(timings),
+        "median": statistics.median(timings),
+        "mean": statistics.fmean(timings),
+        "max": max(timings),
+    }
+    if hasattr(result, "content"):
+        stats["response_bytes"] = len(result.content)
+    elif isinstance(result, dict):
+        stats.update(result)
+    return stats
+
+
+# What a process has imported at each stage, measured in a fresh interpreter
+IMPORT_TARGETS = {
+    # Settings, apps and models: every manage.py command and every gunicorn worker
+    "django_setup": "",
+    # The URLconf and all views: paid on the first request a worker serves, even for the login page
+    "urlconf": "import importlib; importlib.import_module(settings.ROOT_URLCONF)",
+    # The analytical stack, loaded on the first explore/PCA/CSV request
+    "analysis_stack": (
+        "import importlib; importlib.import_module(settings.ROOT_URLCONF); "
+        "import pandas, numpy, sklearn.decomposition, sklearn.preprocessing, boto3"
+    ),
+}
+
+_IMPORT_SCRIPT = """
+import json, os, time
+start = time.perf_counter()
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", {settings_module!r})
+import django
+django.setup()
+from django.conf import settings
+{statements}
+seconds = time.perf_counter() - start
+# Resident memory once everything is imported. ru_maxrss is not used because Linux carries
+# it over from the parent across fork/exec.
+with open("/proc/self/status") as status:
+    rss_kb = next((int(line.split()[1]) for line in status if line.startswith("VmRSS:")), None)
+print(json.dumps({{"seconds": seconds, "rss_kb": rss_kb}}))
+"""
+
+
+def parse_importtime(output):
+    """
+    Sums the self time of every module reported by ``python -X importtime`` per top-level package.
+
+    Returns:
+        dict: package name -> seconds
+    """
+    packages = {}
+    for line in output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3 or not parts[0].strip().isdigit():
+            # The header line
+            continue
+        package = parts[2].strip().split(".")[0]
+        packages[package] = packages.get(package, 0.0) + int(parts[0]) / 1e6
+    return packages
+
+
+def measure_import(statements, settings_module, cwd=None):
+    """
+    Runs django.setup() followed by `statements` in a fresh interpreter.
+
+    Returns:
+        dict: wall time in seconds, resident memory in KB and import time per top-level package.
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(path for path in sys.path if path))
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c",
+         _IMPORT_SCRIPT.format(settings_module=settings_module, statements=statements)],
+        capture_output=True, text=True, cwd=cwd, env=env, check=True,
+    )
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+    result["packages"] = parse_importtime(completed.stderr)
+    return result
+
+
+def benchmark_imports(settings_module, targets=None, repeat=5, top=15, cwd=None):
+    """
+    Measures the import cost of each stage in IMPORT_TARGETS.
+
+    Results use the same layout as BenchmarkSuite.run(), so compare_to_baseline() applies.
+    Each benchmark also carries the median resident memory and the `top` most expensive packages
+    (median self time, in seconds).
+    """
+    results = {
+        "environment": environment_info(),
+        "parameters": {"settings": settings_module, "repeat": repeat},
+        "benchmarks": {},
+    }
+    for name, statements in (targets or IMPORT_TARGETS).items():
+        runs = [measure_import(statements, settings_module, cwd=cwd) for _ in range(repeat)]
+        timings = [run["seconds"] for run in runs]
+        package_names = set().union(*(run["packages"] for run in runs))
+        packages = {
+            package: statistics.median(run["packages"].get(package, 0.0) for run in runs)
+            for package in package_names
+        }
+        results["benchmarks"][name] = {
+            "repeat": repeat,
+            "min": min(timings),
+            "median": statistics.median(timings),
+            "mean": statistics.fmean(timings),
+            "max": max(timings),
+            "rss_kb": statistics.median(run["rss_kb"] or 0 for run in runs),
+            "packages": dict(sorted(packages.items(), key=lambda item: -item[1])[:top]),
+        }
+    return results
+
+
+def environment_info():
+    return {
+        "timestamp": datetime.now(tz=timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+    }
+
+
+def write_results(results, path):
+    with open(path, "w") as handle:
+        json.dump(results, handle, indent=2, sort_keys=True)
+
+
+def compare_to_baseline(results, baseline, threshold=1.2):
+    """
+    Compares median timings against a baseline results file.
+
+    Returns a list of (name, baseline_median, current_median, ratio, regressed) tuples, where
+    `regressed` is True when the current median is more than `threshold` times the baseline.
+    Benchmarks missing from either side are skipped.
+    """
+    rows = []
+    for name, current in sorted(results["benchmarks"].items()):
+        previous = baseline.get("benchmarks", {}).get(name)
+        if not previous or "median" not in previous or "median" not in current:
+            continue
+        ratio = current["median"] / previous["median"] if previous["median"] else float("inf")
+        rows.append((name, previous["median"], current["median"], ratio, ratio > threshold))
+    return rows
@@ -0,0 +1,210 @@
+"""
+Runs the CPU-bound analyses of the bulk RNA views off the request thread.
+
+With BULK_RNA_COMPUTE_PROCESSES above zero, analyses run in a persistent pool of worker
+processes (digiCells_core.processes.ProcessPool) that map the dataset from its shared export
+(datasets.get_shared_matrix) instead of receiving a copy. Otherwise, or when a dataset cannot
+be shared, they run in the worker's CPU thread pool on the cached matrix.
+
+An analysis is a module-level function taking the expression matrix as its first argument and
+returning a small, picklable result. The matrix it receives must not be modified in place.
+
+``run_cached_analysis`` also keeps results in the BULK_RNA_RESULT_CACHE cache for
+BULK_RNA_RESULT_CACHE_TTL seconds, shared by every worker. The key covers the dataset version
+and generation and every argument, so a re-uploaded dataset or a different gene selection (e.g.
+after a gene collection changed) never hits an older result. The version and generation are
+those recorded on the analysis the caller fetched, so a lookup costs no request to S3: a file
+replaced without a bump is caught by the dataset cache's periodic revalidation, which records
+its new version and moves the generation on.
+
+The entry points take the ``generation`` of the analysis the caller fetched (see datasets.py),
+it is not passed on to the analysis.
+"""
+
+import hashlib
+import json
+import logging
+import pickle
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+from digiCells_core import metrics
+from digiCells_core.executors import run_cpu, run_io
+from digiCells_core.processes import ProcessPool, setup_django
+from digiCells_core.tracing import add_spans, capture_spans, span
+
+from .datasets import get_expression_matrix, get_shared_matrix
+
+logger = logging.getLogger(__name__)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_compute_pool():
+    """The worker's compute pool, or None when BULK_RNA_COMPUTE_PROCESSES is 0."""
+    global _pool
+    if _pool is None and settings.BULK_RNA_COMPUTE_PROCESSES > 0:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ProcessPool(
+                    "bulk_rna",
+                    size=settings.BULK_RNA_COMPUTE_PROCESSES,
+                    max_queue=settings.BULK_RNA_COMPUTE_QUEUE,
+                    task_timeout=settings.BULK_RNA_COMPUTE_TASK_TIMEOUT,
+                    initializer=setup_django,
+                    initargs=(settings.SETTINGS_MODULE,),
+                )
+    return _pool
+
+
+def _run_task(fn, shared, args, kwargs):
+    # Runs in a pool process; its spans are sent back to the request's trace
+    with capture_spans() as spans:
+        result = fn(shared.open(), *args, **kwargs)
+    return result, spans
+
+
+def _shared_matrix(path_to_tsv, generation):
+    try:
+        return get_shared_matrix(path_to_tsv, generation)
+    except TypeError:
+        logger.warning("Cannot share %s, analysing it in-process", path_to_tsv, exc_info=True)
+        return None
+
+
+def call_analysis(fn, path_to_tsv, *args, generation=None, **kwargs):
+    """
+    Runs ``fn(matrix, *args, **kwargs)`` on the dataset at `path_to_tsv` and waits for the
+    result. For threads; async code uses run_analysis().
+    """
+    pool = get_compute_pool()
+    shared = _shared_matrix(path_to_tsv, generation) if pool is not None else None
+    if shared is None:
+        return fn(get_expression_matrix(path_to_tsv, generation), *args, **kwargs)
+
+    start = time.perf_counter()
+    result, spans = pool.call(_run_task, (fn, shared, args, kwargs))
+    add_spans(spans, start)
+    return result
+
+
+async def run_analysis(fn, path_to_tsv, *args, generation=None, **kwargs):
+    """
+    Async counterpart of call_analysis(). When the awaiting request is cancelled, the
+    analysis is stopped.
+    """
+    pool = get_compute_pool()
+    shared = await run_io(_shared_matrix, path_to_tsv, generation) if pool is not None else None
+    if shared is None:
+        matrix = await run_io(get_expression_matrix, path_to_tsv, generation)
+        return await run_cpu(fn, matrix, *args, **kwargs)
+
+    start = time.perf_counter()
+    result, spans = await pool.run(_run_task, (fn, shared, args, kwargs))
+    add_spans(spans, start)
+    return result
+
+
+_MISSING = object()
+
+# Part of every result key: bump it when an analysis changes the form of its result, so that
+# results cached by the previous release are not served to the new code
+RESULT_FORMAT = 3
+
+
+def result_key(fn, path_to_tsv, version, generation, args, scope=None):
+    """Cache key of the result of ``fn(matrix, *args)`` for a dataset version."""
+    raw = json.dumps(
+        [RESULT_FORMAT, fn.__module__, fn.__qualname__, path_to_tsv, version, generation, list(args), scope],
+        default=str,
+    )
+    return "bulk_rna:result:" + hashlib.sha256(raw.encode()).hexdigest()
+
+
+async def run_cached_analysis(fn, path_to_tsv, *args, scope=None, generation=None, version=None):
+    """
+    run_analysis() through the result cache.
+
+    Args:
+        scope (str): Extra key component for results that differ by caller, e.g. the tier.
+        version (str): file_version of the analysis the caller fetched.
+    """
+    return await cached_result(
+        fn,
+        path_to_tsv,
+        args,
+        lambda: run_analysis(fn, path_to_tsv, *args, generation=generation),
+        scope=scope,
+        generation=generation,
+        version=version,
+    )
+
+
+async def cached_result(fn, path_to_tsv, args, compute, scope=None, generation=None, version=None):
+    """
+    The result cache of run_cached_analysis(), for results computed some other way, e.g. from
+    a per-worker artifact of the dataset rather than the matrix.
+
+    Args:
+        fn (callable): Names the result in its key, with `args`.
+        compute (callable): Coroutine function returning the result on a miss.
+        version (str): file_version of the analysis the caller fetched.
+    """
+    if settings.BULK_RNA_RESULT_CACHE_TTL <= 0:
+        return await compute()
+
+    results = caches[settings.BULK_RNA_RESULT_CACHE]
+    key = result_key(fn, path_to_tsv, version, generation, args, scope)
+    with span("result_cache", analysis=fn.__name__) as attributes:
+        try:
+            result = await results.aget(key, _MISSING)
+        except Exception:
+            logger.warning("Result cache unavailable, computing %s", fn.__name__, exc_info=True)
+            result = _MISSING
+        attributes["hit"] = result is not _MISSING
+    metrics.record_cache_lookup("result", result is not _MISSING)
+    if result is not _MISSING:
+        return result
+
+    result = await compute()
+    size = len(pickle.dumps(result, pickle.HIGHEST_PROTOCOL))
+    if size <= settings.BULK_RNA_RESULT_CACHE_MAX_ENTRY_BYTES:
+        try:
+            await results.aset(key, result, settings.BULK_RNA_RESULT_CACHE_TTL)
+        except Exception:
+            logger.warning("Could not cache the result of %s", fn.__name__, exc_info=True)
+    return result
+
+
+def call_cached_result(fn, path_to_tsv, args, compute, scope=None, generation=None, version=None):
+    """
+    cached_result() for threads: `compute` is a plain function returning the result on a miss.
+    """
+    if settings.BULK_RNA_RESULT_CACHE_TTL <= 0:
+        return compute()
+
+    results = caches[settings.BULK_RNA_RESULT_CACHE]
+    key = result_key(fn, path_to_tsv, version, generation, args, scope)
+    with span("result_cache", analysis=fn.__name__) as attributes:
+        try:
+            result = results.get(key, _MISSING)
+        except Exception:
+            logger.warning("Result cache unavailable, computing %s", fn.__name__, exc_info=True)
+            result = _MISSING
+        attributes["hit"] = result is not _MISSING
+    metrics.record_cache_lookup("result", result is not _MISSING)
+    if result is not _MISSING:
+        return result
+
+    result = compute()
+    size = len(pickle.dumps(result, pickle.HIGHEST_PROTOCOL))
+    if size <= settings.BULK_RNA_RESULT_CACHE_MAX_ENTRY_BYTES:
+        try:
+            results.set(key, result, settings.BULK_RNA_RESULT_CACHE_TTL)
+        except Exception:
+            logger.warning("Could not cache the result of %s", fn.__name__, exc_info=True)
+    return result
@@ -0,0 +1,206 @@
+"""
+Summary statistics of datasets, computed once per file version.
+
+``compute_dataset_statistics`` makes a single pass over the expression matrix:
+
+- per gene: mean, variance and dispersion (variance / mean) of the TPMs, the variance of
+  log1p(TPM) used by the PCA's gene filter, and a highly-variable-gene ranking by dispersion
+  normalised within bins of genes of similar mean expression (as in Seurat);
+- per sample: library size (sum of TPMs), number of detected genes, and the Pearson
+  correlation of every pair of samples on log1p(TPM).
+
+They are stored in DatasetStatistics, the arrays as one compressed .npz archive, so that the
+analysis list, the statistics endpoint and the PCA read them without loading the matrix.
+``manage.py compute_dataset_statistics`` computes them when a dataset is added or re-uploaded;
+otherwise the first request that needs them does.
+"""
+
+import io
+import logging
+
+from django.db import IntegrityError, transaction
+
+from digiCells_core.tracing import span
+
+from .compute import call_analysis
+from .datasets import dataset_cache, dataset_version
+from .models import DatasetStatistics
+
+logger = logging.getLogger(__name__)
+
+# Genes are split into this many bins of mean expression to normalise their dispersion
+HVG_BINS = 20
+
+
+def compute_dataset_statistics(tsv_df, hvg_bins=HVG_BINS):
+    """
+    Args:
+        tsv_df (DataFrame): Expression values, genes as rows and samples as columns.
+
+    Returns:
+        dict: numpy arrays. genes and samples (labels), mean, variance, dispersion,
+            log_variance and normalised_dispersion (per gene, NaN where undefined), hvg_order
+            (rows of the expressed genes, most variable first), library_size and detected
+            (per sample), correlation (samples x samples).
+    """
+    import numpy as np
+    import pandas as pd
+
+    values = tsv_df.to_numpy(dtype=float)
+    with span("gene_statistics", genes=len(values)):
+        mean = values.mean(axis=1)
+        variance = values.var(axis=1, ddof=1)
+        logs = np.log1p(values)
+        log_variance = logs.var(axis=1, ddof=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            dispersion = np.where(mean > 0, variance / mean, np.nan)
+            log_dispersion = np.log(dispersion)
+
+        varies = np.isfinite(log_dispersion)
+        normalised_dispersion = np.full(len(values), np.nan)
+        if varies.any():
+            dispersions = pd.Series(log_dispersion[varies])
+            bins = pd.cut(np.log1p(mean[varies]), min(hvg_bins, int(varies.sum())), labels=False)
+            grouped = dispersions.groupby(bins)
+            # A bin of one gene has no spread: its gene is not singled out
+            spread = grouped.transform("std").fillna(0.0).replace(0.0, 1.0)
+            normalised_dispersion[varies] = ((dispersions - grouped.transform("mean")) / spread).to_numpy()
+        expressed = np.flatnonzero(varies)
+        hvg_order = expressed[np.argsort(-normalised_dispersion[expressed], kind="stable")]
+
+    with span("sample_statistics", samples=values.shape[1]):
+        library_size = values.sum(axis=0)
+        detected = (values > 0).sum(axis=0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            correlation = np.corrcoef(logs, rowvar=False).reshape(values.shape[1], values.shape[1])
+
+    return {
+        "genes": np.array(tsv_df.index, dtype=str),
+        "samples": np.array(tsv_df.columns, dtype=str),
+        "mean": mean,
+        "variance": variance,
+        "dispersion": dispersion,
+        "log_variance": log_variance,
+        "normalised_dispersion": normalised_dispersion,
+        "hvg_order": hvg_order.astype(np.int32),
+        "library_size": library_size,
+        "detected": detected.astype(np.int32),
+        "correlation": correlation.astype(np.float32),
+    }
+
+
+def pack_statistics(statistics):
+    """The arrays of compute_dataset_statistics() as a compressed .npz archive."""
+    import numpy as np
+
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, **statistics)
+    return buffer.getvalue()
+
+
+def unpack_statistics(data, names=None):
+    """
+    Inverse of pack_statistics().
+
+    Args:
+        names (list of str): Only decompress these arrays.
+    """
+    import numpy as np
+
+    with np.load(io.BytesIO(bytes(data))) as archive:
+        return {name: archive[name] for name in (names or archive.files)}
+
+
+def save_dataset_statistics(path_to_tsv, version, statistics):
+    """
+    Stores the statistics of a dataset version, replacing those of its other versions.
+
+    Returns:
+        DatasetStatistics
+    """
+    import numpy as np
+
+    row = DatasetStatistics(
+        file_path=path_to_tsv,
+        file_version=version,
+        n_genes=len(statistics["genes"]),
+        n_samples=len(statistics["samples"]),
+        detected_genes=int((statistics["mean"] > 0).sum()),
+        median_library_size=float(np.median(statistics["library_size"])) if len(statistics["samples"]) else 0.0,
+        data=pack_statistics(statistics),
+    )
+    try:
+        with transaction.atomic():
+            DatasetStatistics.objects.filter(file_path=path_to_tsv).delete()
+            row.save(force_insert=True)
+    except IntegrityError:
+        # Another worker stored this version meanwhile
+        return DatasetStatistics.objects.get(file_path=path_to_tsv, file_version=version)
+    return row
+
+
+def ensure_dataset_statistics(path_to_tsv, generation=None, force=False):
+    """
+    The statistics of the current version of a dataset, computed in the compute pool and
+    stored if they are missing. For threads.
+
+    Returns:
+        DatasetStatistics
+    """
+    version = dataset_cache.version(path_to_tsv) or dataset_version(path_to_tsv)
+    if not force:
+        row = DatasetStatistics.objects.filter(file_path=path_to_tsv, file_version=version).first()
+        if row is not None:
+            return row
+    statistics = call_analysis(compute_dataset_statistics, path_to_tsv, generation=generation)
+    return save_dataset_statistics(path_to_tsv, version, statistics)
+
+
+def stored_statistics(analyses):
+    """
+    The stored statistics of the file version recorded on each analysis, in one query.
+
+    Returns:
+        dict: analysis ID -> DatasetStatistics, without the analyses that have none
+    """
+    analyses = [analysis for analysis in analyses if analysis.file_path and analysis.file_version]
+    rows = DatasetStatistics.objects.filter(
+        file_path__in={analysis.file_path for analysis in analyses}
+    ).defer("data")
+    by_file = {(row.file_path, row.file_version): row for row in rows}
+    return {
+        analysis.id: by_file[(analysis.file_path, analysis.file_version)]
+        for analysis in analyses
+        if (analysis.file_path, analysis.file_version) in by_file
+    }
+
+
+def stored_log_variance(path_to_tsv, version):
+    """
+    Per-gene variance of log1p(TPM) from the stored statistics of a dataset version, or None
+    when they have not been computed (or do not cover every gene of the version).
+    """
+    row = (
+        DatasetStatistics.objects.filter(file_path=path_to_tsv, file_version=version)
+        .only("n_genes", "data")
+        .first()
+    )
+    if row is None:
+        return None
+    log_variance = unpack_statistics(row.data, ["log_variance"])["log_variance"]
+    if len(log_variance) != row.n_genes:
+        logger.warning("Stored statistics of %s do not cover its %d genes, ignoring them", path_to_tsv, row.n_genes)
+        return None
+    return log_variance
+
+
+def highly_variable_genes(path_to_tsv, n, generation=None):
+    """
+    The `n` most highly variable genes of the current version of a dataset, most variable
+    first, from its stored statistics. For threads.
+
+    Returns:
+        list of str: Genes as in the matrix's index.
+    """
+    statistics = unpack_statistics(ensure_dataset_statistics(path_to_tsv, generation).data, ["genes", "hvg_order"])
+    return statistics["genes"][statistics["hvg_order"][:n]].tolist()
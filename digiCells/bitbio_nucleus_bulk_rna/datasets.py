@@ -0,0 +1,720 @@
+"""
+Dataset access for the bulk RNA views.
+
+boto3 and pandas are imported on first use rather than at module import, so that workers and
+management commands that never touch a dataset do not pay for them.
+
+Cold loads are coalesced: concurrent requests for the same dataset version in a worker wait
+for a single load, and S3 downloads are shared between workers through a spool directory on
+local disk (BULK_RNA_DATASET_SPOOL_DIR) guarded by a file lock, so each version is downloaded
+once per host.
+
+Parsed matrices are kept in a per-process, memory-bounded LRU (``dataset_cache``) together with
+artifacts derived from them, such as PCA results. Cached objects are shared between requests and
+must not be modified in place. Entries are keyed by file path and stay coherent across workers
+and nodes through the version recorded on AnalysisOutput:
+
+- every entry carries the file's generation (AnalysisOutput.file_generation). Requests pass the
+  generation of the analysis they fetched, and an entry from an older generation is dropped
+  without asking S3. ``manage.py bump_dataset_generation`` bumps it after a re-upload;
+- as a backstop for uploads nobody bumped, entries are revalidated against the file's version
+  (local mtime and size, or the S3 ETag) at most every BULK_RNA_DATASET_CACHE_REVALIDATE_SECONDS.
+  A worker that sees a new version, on revalidation or on a load, records it and bumps the
+  generation, so the other workers learn about it from the database.
+
+Pages that only need the sample names, such as the explore page before anything is plotted, use
+``get_dataset_columns``: the header line alone is read (a ranged GET on S3) and kept in the
+default cache per dataset generation.
+
+For the compute pool's processes, a dataset version is also exported once per host as a raw
+numpy array in BULK_RNA_SHARED_MATRIX_DIR (``get_shared_matrix``). The processes map it
+read-only instead of receiving a pickled copy, so the operating system keeps one copy in memory.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from io import StringIO
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from digiCells_core import metrics
+from digiCells_core.locks import SingleFlight, file_lock
+from digiCells_core.tracing import span
+
+from .models import AnalysisOutput
+
+logger = logging.getLogger(__name__)
+
+# Overrides get_s3_client(), see use_s3_client()
+_s3_client_override = None
+
+
+def get_s3_client():
+    """
+    S3 client used by the bulk RNA data layer. Honours BULK_RNA_S3_ENDPOINT_URL so a local
+    S3-compatible server can stand in for AWS.
+    """
+    if _s3_client_override is not None:
+        return _s3_client_override
+
+    import boto3
+
+    return boto3.client("s3", endpoint_url=settings.BULK_RNA_S3_ENDPOINT_URL)
+
+
+@contextmanager
+def use_s3_client(client):
+    """Temporarily route every S3 call of the data layer to ``client`` (benchmarks, load tests)."""
+    global _s3_client_override
+    previous, _s3_client_override = _s3_client_override, client
+    try:
+        yield client
+    finally:
+        _s3_client_override = previous
+
+
+def split_s3_path(path):
+    """Split "s3://bucket/key" into (bucket, key)."""
+    bucket_name, key = path[5:].split("/", 1)
+    return bucket_name, key
+
+
+def is_s3_path(path):
+    return path[:2].lower() == "s3"
+
+
+def load_expression_matrix(path_to_tsv):
+    """
+    Load an expression matrix (genes x samples TSV, first column is the gene index)
+    from S3 or local disk.
+
+    Load time, file size and S3 latency are recorded in Prometheus.
+
+    Args:
+        path_to_tsv (str): "s3://bucket/key" or a local file path.
+
+    Returns:
+        DataFrame: Expression values indexed by gene, one column per sample.
+    """
+    import pandas as pd
+
+    start = time.perf_counter()
+
+    if is_s3_path(path_to_tsv):
+        # Read in from S3
+        source = "s3"
+        with span("load", source=source):
+            s3 = get_s3_client()
+            bucket_name, key = split_s3_path(path_to_tsv)
+            with metrics.time_s3("get_object"):
+                response = s3.get_object(Bucket=bucket_name, Key=key)
+                file_content = response["Body"].read().decode("utf-8")
+            size = len(file_content)
+        with span("parse", bytes=size):
+            tsv_df = pd.read_csv(StringIO(file_content), sep="\t", index_col=0)
+    else:
+        # read from local file
+        source = "local"
+        size = os.path.getsize(path_to_tsv)
+        with span("parse", source=source, bytes=size):
+            tsv_df = pd.read_csv(path_to_tsv, sep="\t", index_col=0)
+
+    metrics.DATASET_LOAD_SECONDS.labels(source).observe(time.perf_counter() - start)
+    metrics.DATASET_LOAD_BYTES.labels(source).observe(size)
+    return tsv_df
+
+
+def read_dataset_header(path_to_tsv, chunk_size=64 * 1024):
+    """
+    Reads only the header line of an expression matrix: a ranged GET on S3, growing the range
+    until it holds a whole line.
+
+    Returns:
+        list of str: The sample names, as the columns of load_expression_matrix().
+    """
+    if is_s3_path(path_to_tsv):
+        s3 = get_s3_client()
+        bucket_name, key = split_s3_path(path_to_tsv)
+        header = b""
+        while b"\n" not in header:
+            start = len(header)
+            with metrics.time_s3("get_object_range"):
+                response = s3.get_object(Bucket=bucket_name, Key=key, Range=f"bytes={start}-{start + chunk_size - 1}")
+                chunk = response["Body"].read()
+            header += chunk
+            if len(chunk) < chunk_size:
+                # End of the object
+                break
+            chunk_size *= 2
+        line = header.split(b"\n", 1)[0].decode("utf-8")
+    else:
+        with open(path_to_tsv, encoding="utf-8") as handle:
+            line = handle.readline()
+    return line.rstrip("\r\n").split("\t")[1:]
+
+
+def dataset_version(path_to_tsv):
+    """
+    Cheap identifier of the current content of a dataset: the ETag for S3 objects, the
+    modification time and size for local files.
+    """
+    if is_s3_path(path_to_tsv):
+        bucket_name, key = split_s3_path(path_to_tsv)
+        with metrics.time_s3("head_object"):
+            response = get_s3_client().head_object(Bucket=bucket_name, Key=key)
+        return response["ETag"]
+    stat = os.stat(path_to_tsv)
+    return f"{stat.st_mtime_ns}:{stat.st_size}"
+
+
+def record_dataset_version(path_to_tsv, version, force=False):
+    """
+    Records the version of a dataset file on the analyses using it. When it differs from the
+    recorded one, or with `force`, their generation moves past the highest one recorded for the
+    file, so that analyses sharing a file share its generation. Analyses with no version recorded
+    yet (a file never loaded) only take it: nothing was cached from an older version.
+
+    Returns:
+        int or None: The file's current generation, None when no analysis uses it.
+    """
+    with transaction.atomic():
+        rows = list(
+            AnalysisOutput.objects.select_for_update()
+            .filter(file_path=path_to_tsv)
+            .values_list("file_version", "file_generation")
+        )
+        if not rows:
+            return None
+        generation = max(row_generation for _, row_generation in rows)
+        if force or any(row_version and row_version != version for row_version, _ in rows):
+            generation += 1
+            AnalysisOutput.objects.filter(file_path=path_to_tsv).update(
+                file_version=version, file_generation=generation
+            )
+            logger.info("%s is now at version %s, generation %d", path_to_tsv, version, generation)
+        elif any(row_version != version for row_version, _ in rows):
+            AnalysisOutput.objects.filter(file_path=path_to_tsv, file_version="").update(
+                file_version=version, file_generation=generation
+            )
+    return generation
+
+
+def estimate_size(value):
+    """Approximate memory held by a cached value, in bytes."""
+    if hasattr(value, "columns"):
+        # DataFrame
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if hasattr(value, "memory_usage"):
+        # Series or Index
+        return int(value.memory_usage(deep=True))
+    if hasattr(value, "nbytes"):
+        # numpy array
+        return int(value.nbytes)
+    if isinstance(value, (tuple, list)):
+        return sys.getsizeof(value) + sum(estimate_size(item) for item in value)
+    return sys.getsizeof(value)
+
+
+class _CacheEntry:
+    def __init__(self, version, generation, matrix):
+        self.version = version
+        self.generation = generation
+        self.checked_at = time.monotonic()
+        self.matrix = matrix
+        self.artifacts = {}
+        self.size = estimate_size(matrix)
+
+
+class DatasetCache:
+    """
+    Per-process LRU of parsed expression matrices and their derived artifacts, bounded by
+    `max_bytes`. A dataset whose matrix alone exceeds the budget is served but not kept.
+
+    Lookups take the generation the caller knows of (None if unknown): entries from an older
+    generation are reloaded.
+    """
+
+    def __init__(self, max_bytes, revalidate_seconds=60):
+        self.max_bytes = max_bytes
+        self.revalidate_seconds = revalidate_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._flights = SingleFlight()
+        self.bytes = 0
+
+    def get(self, path_to_tsv, generation=None):
+        """Returns the parsed matrix for `path_to_tsv`, loading it on a miss."""
+        entry = self._entry(path_to_tsv, generation)
+        if entry is not None:
+            metrics.record_cache_lookup("dataset", True)
+            return entry.matrix
+        metrics.record_cache_lookup("dataset", False)
+
+        version = dataset_version(path_to_tsv)
+        matrix, shared = self._flights.do(("dataset", path_to_tsv, version), lambda: self._load(path_to_tsv, version))
+        if shared:
+            metrics.DATASET_COALESCED.labels("dataset", "thread").inc()
+        return matrix
+
+    def _load(self, path_to_tsv, version):
+        if is_s3_path(path_to_tsv) and settings.BULK_RNA_DATASET_SPOOL_DIR:
+            with span("load", source="s3", spooled=True):
+                local_path = fetch_to_spool(path_to_tsv, version)
+            try:
+                matrix = load_expression_matrix(local_path)
+            except FileNotFoundError:
+                # A worker that saw a newer version removed this one in the meantime
+                matrix = load_expression_matrix(path_to_tsv)
+        else:
+            matrix = load_expression_matrix(path_to_tsv)
+        try:
+            generation = record_dataset_version(path_to_tsv, version)
+        except Exception:
+            logger.warning("Could not record the version of %s", path_to_tsv, exc_info=True)
+            generation = None
+        self._store(path_to_tsv, _CacheEntry(version, generation, matrix))
+        return matrix
+
+    def artifact(self, path_to_tsv, name, compute, generation=None):
+        """
+        Returns the artifact `name` of a dataset, computing it with ``compute(matrix)`` on a
+        miss. Artifacts are dropped together with their dataset.
+        """
+        entry = self._entry(path_to_tsv, generation)
+        if entry is not None and name in entry.artifacts:
+            metrics.record_cache_lookup("artifact", True)
+            return entry.artifacts[name]
+        metrics.record_cache_lookup("artifact", False)
+
+        value, shared = self._flights.do(
+            ("artifact", path_to_tsv, name), lambda: self._compute_artifact(path_to_tsv, name, compute, generation)
+        )
+        if shared:
+            metrics.DATASET_COALESCED.labels("artifact", "thread").inc()
+        return value
+
+    def _compute_artifact(self, path_to_tsv, name, compute, generation):
+        matrix = self.get(path_to_tsv, generation)
+        with self._lock:
+            entry = self._entries.get(path_to_tsv)
+        value = compute(matrix)
+        with self._lock:
+            # Only onto the entry of that matrix: a newer version may have replaced it meanwhile
+            current = entry is not None and entry.matrix is matrix and self._entries.get(path_to_tsv) is entry
+            if current and name not in entry.artifacts:
+                entry.artifacts[name] = value
+                size = estimate_size(value)
+                entry.size += size
+                self.bytes += size
+                self._evict()
+        return value
+
+    def peek(self, path_to_tsv, generation=None):
+        """The cached matrix for `path_to_tsv`, revalidated as by get(), or None: never loads it."""
+        entry = self._entry(path_to_tsv, generation)
+        return entry.matrix if entry is not None else None
+
+    def contains(self, path_to_tsv):
+        with self._lock:
+            return path_to_tsv in self._entries
+
+    def version(self, path_to_tsv):
+        """Version of the cached copy of a dataset, None when it is not cached."""
+        with self._lock:
+            entry = self._entries.get(path_to_tsv)
+            return entry.version if entry else None
+
+    def generation(self, path_to_tsv):
+        """Generation of the cached copy of a dataset, None when it is not cached or unknown."""
+        with self._lock:
+            entry = self._entries.get(path_to_tsv)
+            return entry.generation if entry else None
+
+    def entry_size(self, path_to_tsv):
+        with self._lock:
+            entry = self._entries.get(path_to_tsv)
+            return entry.size if entry else 0
+
+    def discard(self, path_to_tsv, reason="discarded"):
+        with self._lock:
+            self._drop(path_to_tsv, reason)
+
+    def clear(self):
+        with self._lock:
+            for path_to_tsv in list(self._entries):
+                self._drop(path_to_tsv, "cleared")
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self.bytes, "max_bytes": self.max_bytes}
+
+    def _entry(self, path_to_tsv, generation=None):
+        with self._lock:
+            entry = self._entries.get(path_to_tsv)
+            if entry is None:
+                return None
+            if generation is not None and entry.generation is not None and generation > entry.generation:
+                self._drop(path_to_tsv, "stale")
+                return None
+            self._entries.move_to_end(path_to_tsv)
+            if time.monotonic() - entry.checked_at < self.revalidate_seconds:
+                return entry
+
+        # Revalidate outside the lock, it may be an S3 round trip
+        try:
+            current_version = dataset_version(path_to_tsv)
+        except Exception:
+            logger.warning("Could not revalidate %s, serving the cached copy", path_to_tsv, exc_info=True)
+            current_version = entry.version
+
+        if current_version != entry.version:
+            # Uploaded without a bump: tell the other workers
+            try:
+                record_dataset_version(path_to_tsv, current_version)
+            except Exception:
+                logger.warning("Could not record the new version of %s", path_to_tsv, exc_info=True)
+        with self._lock:
+            if current_version != entry.version:
+                self._drop(path_to_tsv, "stale")
+                return None
+            entry.checked_at = time.monotonic()
+            return entry
+
+    def _store(self, path_to_tsv, entry):
+        if entry.size > self.max_bytes:
+            logger.info("%s (%d bytes) exceeds the dataset cache budget, not caching it", path_to_tsv, entry.size)
+            return
+        with self._lock:
+            self._drop(path_to_tsv, "replaced")
+            self._entries[path_to_tsv] = entry
+            self.bytes += entry.size
+            self._evict()
+            metrics.DATASET_CACHE_BYTES.set(self.bytes)
+
+    def _evict(self):
+        while self.bytes > self.max_bytes and len(self._entries) > 1:
+            self._drop(next(iter(self._entries)), "capacity")
+        metrics.DATASET_CACHE_BYTES.set(self.bytes)
+
+    def _drop(self, path_to_tsv, reason):
+        entry = self._entries.pop(path_to_tsv, None)
+        if entry is not None:
+            self.bytes -= entry.size
+            metrics.DATASET_CACHE_EVICTIONS.labels(reason).inc()
+            metrics.DATASET_CACHE_BYTES.set(self.bytes)
+
+
+def _remove_other_versions(directory, prefix, current_path, suffixes):
+    current_name = os.path.basename(current_path)
+    for name in os.listdir(directory):
+        if name.startswith(prefix + "-") and name.endswith(suffixes[0]) and name != current_name:
+            for suffix in suffixes:
+                try:
+                    os.remove(os.path.join(directory, name[: -len(suffixes[0])] + suffix))
+                except OSError:
+                    pass
+
+
+def fetch_to_spool(path_to_tsv, version):
+    """
+    Downloads an S3 dataset version into the spool directory, once per host: workers that
+    need the same version while it downloads wait on a file lock and then read the spooled
+    copy. Older spooled versions of the dataset are removed.
+
+    Returns:
+        str: Local path of the spooled file.
+    """
+    spool_dir = settings.BULK_RNA_DATASET_SPOOL_DIR
+    os.makedirs(spool_dir, exist_ok=True)
+    prefix = hashlib.md5(path_to_tsv.encode()).hexdigest()
+    spool_path = os.path.join(spool_dir, f"{prefix}-{hashlib.md5(version.encode()).hexdigest()}.tsv")
+    if os.path.exists(spool_path):
+        metrics.DATASET_COALESCED.labels("dataset", "worker").inc()
+        return spool_path
+
+    with file_lock(spool_path + ".lock", timeout=settings.BULK_RNA_DATASET_LOCK_TIMEOUT) as acquired:
+        if os.path.exists(spool_path):
+            metrics.DATASET_COALESCED.labels("dataset", "worker").inc()
+            return spool_path
+        if not acquired:
+            logger.warning("Could not lock %s, downloading %s without coordination", spool_path, path_to_tsv)
+            metrics.DATASET_DUPLICATE_LOADS.labels("lock_unavailable").inc()
+
+        bucket_name, key = split_s3_path(path_to_tsv)
+        # Unique name, so that an uncoordinated download cannot clobber another one midway
+        partial_path = f"{spool_path}.{os.getpid()}.{threading.get_ident()}.partial"
+        try:
+            with metrics.time_s3("download_file"):
+                get_s3_client().download_file(Bucket=bucket_name, Key=key, Filename=partial_path)
+            os.replace(partial_path, spool_path)
+        finally:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+
+    _remove_other_versions(spool_dir, prefix, spool_path, (".tsv", ".tsv.lock"))
+    return spool_path
+
+
+class SharedMatrix:
+    """
+    Picklable handle on a matrix exported by share_matrix(). ``open()`` maps the values
+    read-only rather than reading them, so every process opening the same version shares its
+    memory. Opened matrices are kept per process (a few at a time).
+    """
+
+    _opened = OrderedDict()
+    _max_opened = 4
+
+    def __init__(self, values_path, labels_path):
+        self.values_path = values_path
+        self.labels_path = labels_path
+
+    def open(self):
+        """
+        Returns:
+            DataFrame: Read-only expression values indexed by gene, one column per sample.
+        """
+        matrix = self._opened.get(self.values_path)
+        if matrix is not None:
+            self._opened.move_to_end(self.values_path)
+            return matrix
+
+        import numpy as np
+        import pandas as pd
+
+        values = np.load(self.values_path, mmap_mode="r")
+        with open(self.labels_path) as handle:
+            labels = json.load(handle)
+        matrix = pd.DataFrame(
+            values, index=pd.Index(labels["index"], name=labels["index_name"]), columns=labels["columns"], copy=False
+        )
+        self._opened[self.values_path] = matrix
+        while len(self._opened) > self._max_opened:
+            self._opened.popitem(last=False)
+        return matrix
+
+
+def shared_matrix(path_to_tsv, version):
+    """SharedMatrix where share_matrix() exports a dataset version, whether it exists or not."""
+    prefix = hashlib.md5(path_to_tsv.encode()).hexdigest()
+    name = f"{prefix}-{hashlib.md5(version.encode()).hexdigest()}"
+    base_path = os.path.join(settings.BULK_RNA_SHARED_MATRIX_DIR, name)
+    return SharedMatrix(base_path + ".npy", base_path + ".json")
+
+
+def share_matrix(path_to_tsv, version, matrix):
+    """
+    Exports a dataset version to BULK_RNA_SHARED_MATRIX_DIR, once per host: the values as a
+    .npy file and the gene and sample labels as JSON. Older exports of the dataset are removed.
+
+    Returns:
+        SharedMatrix
+
+    Raises:
+        TypeError: The matrix is not entirely numeric.
+    """
+    import numpy as np
+
+    share_dir = settings.BULK_RNA_SHARED_MATRIX_DIR
+    os.makedirs(share_dir, exist_ok=True)
+    prefix = hashlib.md5(path_to_tsv.encode()).hexdigest()
+    shared = shared_matrix(path_to_tsv, version)
+    base_path = shared.values_path[: -len(".npy")]
+    if os.path.exists(shared.values_path):
+        return shared
+
+    values = matrix.to_numpy()
+    if values.dtype.kind not in "biuf":
+        raise TypeError(f"{path_to_tsv} has non-numeric values ({values.dtype}), it cannot be shared")
+
+    with file_lock(base_path + ".lock", timeout=settings.BULK_RNA_DATASET_LOCK_TIMEOUT), span("share", bytes=values.nbytes):
+        if os.path.exists(shared.values_path):
+            return shared
+        partial = f".{os.getpid()}.{threading.get_ident()}.partial"
+        labels = {
+            "index": matrix.index.tolist(),
+            "index_name": matrix.index.name,
+            "columns": matrix.columns.tolist(),
+        }
+        try:
+            with open(shared.labels_path + partial, "w") as handle:
+                json.dump(labels, handle)
+            os.replace(shared.labels_path + partial, shared.labels_path)
+            # The .npy file appears last: once it exists the export is complete
+            with open(shared.values_path + partial, "wb") as handle:
+                np.save(handle, np.ascontiguousarray(values))
+            os.replace(shared.values_path + partial, shared.values_path)
+        finally:
+            for leftover in (shared.labels_path + partial, shared.values_path + partial):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+
+    _remove_other_versions(share_dir, prefix, shared.values_path, (".npy", ".json", ".lock"))
+    return shared
+
+
+dataset_cache = DatasetCache(
+    max_bytes=settings.BULK_RNA_DATASET_CACHE_MAX_BYTES,
+    revalidate_seconds=settings.BULK_RNA_DATASET_CACHE_REVALIDATE_SECONDS,
+)
+
+
+def get_expression_matrix(path_to_tsv, generation=None):
+    """
+    Cached counterpart of load_expression_matrix(), used by the views. The returned DataFrame
+    is shared, callers must not modify it in place.
+
+    Args:
+        generation (int): file_generation of the analysis the caller fetched, if any.
+    """
+    note_dataset_use(path_to_tsv)
+    return dataset_cache.get(path_to_tsv, generation)
+
+
+# The export used for each dataset generation and when its version was last checked, so that a
+# worker without the dataset finds the export of another worker without asking S3 for the
+# dataset's version on every analysis. Checked again as often as dataset_cache entries are.
+_exports = OrderedDict()
+_exports_lock = threading.Lock()
+_MAX_EXPORTS = 64
+
+
+def _remember_export(path_to_tsv, generation, shared):
+    if generation is None:
+        return
+    with _exports_lock:
+        _exports[(path_to_tsv, generation)] = (shared, time.monotonic())
+        _exports.move_to_end((path_to_tsv, generation))
+        while len(_exports) > _MAX_EXPORTS:
+            _exports.popitem(last=False)
+
+
+def _remembered_export(path_to_tsv, generation):
+    """The export remembered for a dataset generation, None if unknown or due a version check."""
+    with _exports_lock:
+        remembered = _exports.get((path_to_tsv, generation))
+        if remembered is None:
+            return None
+        shared, checked_at = remembered
+        if time.monotonic() - checked_at >= dataset_cache.revalidate_seconds:
+            return None
+        _exports.move_to_end((path_to_tsv, generation))
+    # Removed by a worker that saw a newer version
+    return shared if os.path.exists(shared.values_path) else None
+
+
+def get_shared_matrix(path_to_tsv, generation=None):
+    """
+    SharedMatrix of the current version of a dataset, exported on first use and cached with
+    the dataset. A worker without the dataset uses the export another worker of the host made,
+    if any, rather than loading the dataset: the compute pool reads only what it needs of it.
+    That export is looked up once per generation, and its version checked again after
+    BULK_RNA_DATASET_CACHE_REVALIDATE_SECONDS in case the file was replaced in place.
+    """
+    note_dataset_use(path_to_tsv)
+    if dataset_cache.peek(path_to_tsv, generation) is None:
+        shared = _remembered_export(path_to_tsv, generation)
+        if shared is not None:
+            return shared
+        shared = shared_matrix(path_to_tsv, dataset_version(path_to_tsv))
+        if os.path.exists(shared.values_path):
+            _remember_export(path_to_tsv, generation, shared)
+            return shared
+
+    def export(matrix):
+        version = dataset_cache.version(path_to_tsv) or dataset_version(path_to_tsv)
+        return share_matrix(path_to_tsv, version, matrix)
+
+    shared = dataset_cache.artifact(path_to_tsv, "shared", export, generation)
+    if not os.path.exists(shared.values_path):
+        # Removed by a worker that saw a newer version of the dataset
+        dataset_cache.discard(path_to_tsv, reason="stale")
+        shared = dataset_cache.artifact(path_to_tsv, "shared", export, generation)
+    _remember_export(path_to_tsv, generation, shared)
+    return shared
+
+
+def columns_cache_key(path_to_tsv, generation):
+    """Key of the header of a dataset generation in the shared cache."""
+    return f"bulk_rna:columns:{hashlib.md5(path_to_tsv.encode()).hexdigest()}:{generation}"
+
+
+def get_dataset_columns(path_to_tsv, generation=None):
+    """
+    Sample names of a dataset, without loading it: from the cached matrix if this worker has
+    it, else from the header cached for this generation, else from a header-only read.
+
+    Args:
+        generation (int): file_generation of the analysis the caller fetched, if any.
+
+    Returns:
+        list of str
+    """
+    matrix = dataset_cache.peek(path_to_tsv, generation)
+    if matrix is not None:
+        metrics.record_cache_lookup("header", True)
+        return list(matrix.columns)
+
+    key = columns_cache_key(path_to_tsv, generation)
+    try:
+        columns = cache.get(key)
+    except Exception:
+        logger.warning("Could not read the cached header of %s", path_to_tsv, exc_info=True)
+        columns = None
+    metrics.record_cache_lookup("header", columns is not None)
+    if columns is not None:
+        return columns
+
+    with span("header", path=path_to_tsv):
+        columns = read_dataset_header(path_to_tsv)
+    try:
+        # Expires like a cached matrix is revalidated, in case the file changed without a bump
+        cache.set(key, columns, settings.BULK_RNA_DATASET_CACHE_REVALIDATE_SECONDS)
+    except Exception:
+        logger.warning("Could not cache the header of %s", path_to_tsv, exc_info=True)
+    return columns
+
+
+# Dataset popularity, used to pick what to warm up. Counts are kept per process and added to
+# the shared cache at most once a minute per dataset, to keep the request path free of writes.
+_USE_PUBLISH_INTERVAL = 60
+_use_counts = {}
+_use_lock = threading.Lock()
+
+
+def _use_count_key(path_to_tsv):
+    return "bulk_rna:dataset_uses:" + hashlib.md5(path_to_tsv.encode()).hexdigest()
+
+
+def note_dataset_use(path_to_tsv):
+    now = time.monotonic()
+    with _use_lock:
+        count, published_at = _use_counts.get(path_to_tsv, (0, now))
+        count += 1
+        if now - published_at < _USE_PUBLISH_INTERVAL:
+            _use_counts[path_to_tsv] = (count, published_at)
+            return
+        _use_counts[path_to_tsv] = (0, now)
+
+    key = _use_count_key(path_to_tsv)
+    try:
+        if cache.add(key, count, None):
+            return
+        cache.incr(key, count)
+    except Exception:
+        logger.debug("Could not publish usage of %s", path_to_tsv, exc_info=True)
+
+
+def dataset_use_counts(paths):
+    """Recorded request counts for each of `paths` (0 when unknown)."""
+    values = cache.get_many([_use_count_key(path) for path in paths])
+    return {path: values.get(_use_count_key(path), 0) for path in paths}
@@ -32,9 +32,10 @@ class GeneCollectionForm(forms.ModelForm):
 
         # Pre-populate included_genes field
         if self.instance and self.instance.pk:
-            existing_genes = []
-            for a_gene in self.instance.included_genes.all():
-                existing_genes.append(a_gene.ensembl_id + " - " + a_gene.gene_name)
+            existing_genes = [
+                ensembl_id + " - " + gene_name
+                for ensembl_id, gene_name in self.instance.included_genes.values_list('ensembl_id', 'gene_name')
+            ]
             self.fields['gene_input'].initial = "\n".join(existing_genes)
 
         # Autopopulate the linked_analysis hidden field
@@ -44,7 +45,6 @@ class GeneCollectionForm(forms.ModelForm):
     def clean_gene_input(self):
         gene_input = self.cleaned_data['gene_input']
         input_lines = gene_input.strip().splitlines()
-        print(input_lines)
         valid_genes = []
         invalid_genes = []
         duplicated_genes = []
@@ -0,0 +1,92 @@
+"""
+Tiled heatmaps for large gene selections.
+
+A heatmap of more than BULK_RNA_HEATMAP_TILE_THRESHOLD genes is not sent to the browser cell by
+cell. The explore page gets a mean-pooled overview of at most BULK_RNA_HEATMAP_OVERVIEW_ROWS
+rows, and fetches the genes it shows at full resolution from the tile view, one window of
+BULK_RNA_HEATMAP_TILE_ROWS genes at a time.
+
+The selection behind a tiled heatmap (genes in display order, conditions, normalisation) is
+saved in the BULK_RNA_RESULT_CACHE cache when the explore page has checked the user's access
+and charged their quota. Tile requests only name it, so they serve exactly what the page
+showed. Tiles and overviews go through compute.run_cached_analysis, which caches them per
+dataset version, selection, ordering and normalisation.
+"""
+
+import hashlib
+import json
+import logging
+
+from django.conf import settings
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+
+def overview_bins(n_rows, max_bins):
+    """
+    Splits `n_rows` consecutive rows into at most `max_bins` bins of near-equal size.
+
+    Returns:
+        list of int: The first row of each bin.
+    """
+    bins = min(n_rows, max_bins)
+    return [i * n_rows // bins for i in range(bins)]
+
+
+def tile_bounds(heatmap, tile):
+    """(start, stop) rows of `tile`, or None when the heatmap has no such tile."""
+    start = tile * heatmap["tile_rows"]
+    if tile < 0 or start >= len(heatmap["gene_df_ids"]):
+        return None
+    return start, min(start + heatmap["tile_rows"], len(heatmap["gene_df_ids"]))
+
+
+def _key(heatmap_id):
+    return f"bulk_rna:heatmap:{heatmap_id}"
+
+
+async def save_heatmap(user, analysis, gene_df_ids, conditions, normalisation, scope):
+    """
+    Saves a tiled heatmap selection for the tile view.
+
+    Args:
+        user (User): The only user allowed to fetch its tiles.
+        analysis (AnalysisOutput): Dataset. Tiles are read from its current version.
+        gene_df_ids (list of str): Genes in display order.
+        conditions (list of str): Samples, in display order.
+        normalisation (dict): As applied by the explore page.
+        scope (str): Result cache scope, the user's tier.
+
+    Returns:
+        tuple: (heatmap_id, heatmap), or (None, heatmap) when it could not be saved. The
+            same selection always gets the same ID.
+    """
+    heatmap = {
+        "user": user.id,
+        "analysis": analysis.id,
+        "gene_df_ids": gene_df_ids,
+        "conditions": conditions,
+        "normalisation": normalisation,
+        "scope": scope,
+        "tile_rows": settings.BULK_RNA_HEATMAP_TILE_ROWS,
+    }
+    heatmap_id = hashlib.sha256(json.dumps(heatmap, default=str).encode()).hexdigest()[:32]
+    try:
+        await caches[settings.BULK_RNA_RESULT_CACHE].aset(_key(heatmap_id), heatmap, settings.BULK_RNA_HEATMAP_TTL)
+    except Exception:
+        logger.warning("Could not save tiled heatmap %s", heatmap_id, exc_info=True)
+        return None, heatmap
+    return heatmap_id, heatmap
+
+
+async def load_heatmap(heatmap_id, user, analysis_id):
+    """The selection saved by save_heatmap(), or None if it expired or belongs to another user or dataset."""
+    try:
+        heatmap = await caches[settings.BULK_RNA_RESULT_CACHE].aget(_key(heatmap_id))
+    except Exception:
+        logger.warning("Could not load tiled heatmap %s", heatmap_id, exc_info=True)
+        return None
+    if heatmap is None or heatmap["user"] != user.id or heatmap["analysis"] != analysis_id:
+        return None
+    return heatmap
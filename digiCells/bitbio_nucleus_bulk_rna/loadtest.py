@@ -0,0 +1,391 @@
+"""
+Concurrent HTTP load tests of the bulk RNA explore workflow.
+
+Used by the ``run_load_test`` management command. Unlike the benchmarks, requests go over
+real HTTP to a running server (the Django dev server or the docker-compose stack), so
+contention between workers, database sessions and dataset loads shows up in the numbers.
+
+``setup_fixtures()`` creates everything a run needs in the database the server uses: a
+synthetic dataset on local disk (hidden from the commercial app), its Gene rows, and one user
+per tier profile. The tiers read their genes from the "Free access"/"Premium access"
+collections, so the synthetic genes are added to those: fixtures are therefore only set up
+with DEBUG on or a local database (SQLite or a database server on this host), never in a
+shared one. A JSON manifest describing the fixtures is written next to the dataset so that
+later runs can reuse them without another setup.
+"""
+
+import json
+import os
+import random
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from http.cookiejar import CookieJar
+
+from .benchmarking import create_gene_rows, generate_expression_matrix, write_matrix
+
+# Profile name -> (tier name, in the "Customer" group)
+TIER_PROFILES = {
+    "free": ("Free", False),
+    "premium": ("Premium", False),
+    "researcher": ("Researcher", False),
+    "customer": ("Free", True),
+}
+
+TIER_LIMITS = {"Free": 100, "Premium": 1000, "Researcher": 10**9}
+
+# Relative weights of the scenarios in a run
+DEFAULT_MIX = {
+    "analysis_list": 3,
+    "explore": 4,
+    "pca": 1,
+    "autocomplete": 4,
+    "csv": 1,
+}
+
+MANIFEST_NAME = "loadtest_fixtures.json"
+
+
+class UnsafeDatabase(Exception):
+    """The fixtures would be written to a shared database."""
+
+
+def is_local_database(alias="default"):
+    """Whether the database is SQLite or a server on this host."""
+    from django.db import connections
+
+    database = connections.databases[alias]
+    if database["ENGINE"].endswith("sqlite3"):
+        return True
+    return database.get("HOST", "") in ("", "localhost", "127.0.0.1", "::1")
+
+
+def setup_fixtures(data_dir, n_genes=2000, n_samples=36, password="loadtest", seed=0):
+    """
+    Creates (or refreshes) the load test fixtures and writes their manifest.
+
+    Existing load test users keep their accounts but have their gene usage reset, so every
+    run starts with a full quota.
+
+    Args:
+        data_dir (str): Directory for the dataset and manifest. Must be readable by the server.
+        n_genes (int): Genes in the synthetic dataset.
+        n_samples (int): Samples in the synthetic dataset.
+        password (str): Password given to every load test user.
+        seed (int): Seed of the synthetic dataset.
+
+    Returns:
+        dict: The manifest (analysis id, gene ids, conditions and users by profile).
+
+    Raises:
+        UnsafeDatabase: DEBUG is off and the database is not local.
+    """
+    from django.conf import settings
+    from django.contrib.auth.models import Group, User
+
+    if not (settings.DEBUG or is_local_database()):
+        raise UnsafeDatabase(
+            "Load test fixtures add synthetic genes to the tier collections: set them up with DEBUG on "
+            "or against a local database only"
+        )
+
+    from .models import AnalysisOutput, Gene, GeneCollection, Tier, UserGeneRequest, UserTier
+
+    matrix = generate_expression_matrix(n_genes, n_samples, seed=seed)
+    dataset_path = os.path.abspath(os.path.join(data_dir, "loadtest_matrix.tsv"))
+    write_matrix(matrix, dataset_path)
+    create_gene_rows(n_genes)
+
+    analysis, _ = AnalysisOutput.objects.update_or_create(
+        file_path=dataset_path,
+        defaults={
+            "metadata": {"synthetic": True, "load_test": True},
+            "product": "LoadTest",
+            "description": f"Load test dataset ({n_genes} x {n_samples})",
+            "conditions": ",".join(sorted({column.split("_")[1] for column in matrix.columns})),
+            "is_visible_in_commercial_app": False,
+        },
+    )
+
+    # Free users may see the first 10% of the genes, Premium users the first half
+    genes = list(Gene.objects.filter(gene_name__startswith="SYN").order_by("id")[:n_genes])
+    for collection_name, share in (("Free access", 0.1), ("Premium access", 0.5)):
+        collection, _ = GeneCollection.objects.get_or_create(
+            collection_name=collection_name,
+            defaults={"description": collection_name, "private_collection": False, "customer_visible": True},
+        )
+        collection.included_genes.add(*genes[: max(1, int(len(genes) * share))])
+
+    customer_group, _ = Group.objects.get_or_create(name="Customer")
+    users = {}
+    for profile, (tier_name, is_customer) in TIER_PROFILES.items():
+        tier, _ = Tier.objects.get_or_create(name=tier_name, defaults={"max_genes": TIER_LIMITS[tier_name]})
+        username = f"loadtest_{profile}"
+        user, created = User.objects.get_or_create(username=username)
+        if created or not user.check_password(password):
+            user.set_password(password)
+            user.save()
+        UserTier.objects.update_or_create(user=user, defaults={"tier": tier})
+        if is_customer:
+            user.groups.add(customer_group)
+        UserGeneRequest.objects.filter(user=user).delete()
+        users[profile] = username
+
+    manifest = {
+        "analysis_id": analysis.id,
+        "dataset": dataset_path,
+        "genes": list(matrix.index),
+        "conditions": sorted({"_".join(column.split("_")[:-1]) for column in matrix.columns}),
+        "users": users,
+        "password": password,
+    }
+    with open(os.path.join(data_dir, MANIFEST_NAME), "w") as handle:
+        json.dump(manifest, handle)
+    return manifest
+
+
+def load_manifest(data_dir):
+    with open(os.path.join(data_dir, MANIFEST_NAME)) as handle:
+        return json.load(handle)
+
+
+def parse_mix(value):
+    """Parses "explore=4,pca=1" into a weights dict. Unknown scenario names raise ValueError."""
+    mix = {}
+    for item in value.split(","):
+        name, _, weight = item.partition("=")
+        name = name.strip()
+        if name not in DEFAULT_MIX:
+            raise ValueError(f"Unknown scenario '{name}', expected one of {', '.join(DEFAULT_MIX)}")
+        mix[name] = float(weight) if weight else 1.0
+    return mix
+
+
+class LoginFailed(Exception):
+    pass
+
+
+class HttpSession:
+    """A cookie-keeping HTTP client that logs in through the login form, like a browser."""
+
+    def __init__(self, base_url, timeout=60):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.cookies = CookieJar()
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(self.cookies))
+
+    def _cookie(self, name):
+        for cookie in self.cookies:
+            if cookie.name == name:
+                return cookie.value
+        return None
+
+    def login(self, username, password):
+        login_url = self.base_url + "/login/"
+        self.request("GET", "/login/")
+        status, _, final_url = self.request(
+            "POST", "/login/", {"username": username, "password": password}, headers={"Referer": login_url}
+        )
+        if status != 200 or self._cookie("sessionid") is None:
+            raise LoginFailed(f"Could not log in as {username} (status {status}, ended at {final_url})")
+
+    def request(self, method, path, data=None, headers=None):
+        """
+        Sends a request, following redirects.
+
+        Returns:
+            tuple: (status, body size in bytes, final URL)
+        """
+        url = self.base_url + path
+        body = None
+        headers = dict(headers or {})
+        if method == "GET" and data:
+            url += "?" + urllib.parse.urlencode(data, doseq=True)
+        elif method == "POST":
+            data = dict(data or {})
+            csrf_token = self._cookie("csrftoken")
+            if csrf_token:
+                data.setdefault("csrfmiddlewaretoken", csrf_token)
+                headers.setdefault("Referer", url)
+            body = urllib.parse.urlencode(data, doseq=True).encode()
+
+        request = urllib.request.Request(url, data=body, headers=headers, method=method)
+        try:
+            with self.opener.open(request, timeout=self.timeout) as response:
+                return response.status, len(response.read()), response.geturl()
+        except urllib.error.HTTPError as e:
+            return e.code, len(e.read() or b""), url
+
+
+class LoadTest:
+    """
+    Replays a weighted mix of scenarios from `concurrency` virtual users, each logged in as
+    one of the tier profiles (assigned round-robin), until `duration` seconds have passed or
+    `max_requests` requests have been sent.
+    """
+
+    def __init__(
+        self,
+        base_url,
+        manifest,
+        concurrency=8,
+        duration=30.0,
+        max_requests=None,
+        mix=None,
+        profiles=None,
+        heatmap_genes=50,
+        think_time=0.0,
+        seed=0,
+    ):
+        self.base_url = base_url
+        self.manifest = manifest
+        self.concurrency = concurrency
+        self.duration = duration
+        self.max_requests = max_requests
+        self.mix = mix or DEFAULT_MIX
+        self.profiles = profiles or list(TIER_PROFILES)
+        self.heatmap_genes = heatmap_genes
+        self.think_time = think_time
+        self.seed = seed
+        self._samples = []
+        self._samples_lock = threading.Lock()
+        self._sent = 0
+
+    def scenario_request(self, name, rng):
+        """Returns (method, path, data) for one request of scenario `name`."""
+        analysis_id = self.manifest["analysis_id"]
+        genes = self.manifest["genes"]
+        if name == "analysis_list":
+            return "GET", "/bulk-rna/", None
+        if name == "explore":
+            # Half single-gene box plots, half heatmaps
+            n_genes = 1 if rng.random() < 0.5 else rng.randint(2, max(2, self.heatmap_genes))
+            return "POST", f"/bulk-rna/explore/{analysis_id}/", {
+                "selection_type": "individual",
+                "genes": rng.sample(genes, min(n_genes, len(genes))),
+                "display_field": "x",
+            }
+        if name == "pca":
+            return "GET", f"/bulk-rna/pca/{analysis_id}/", None
+        if name == "autocomplete":
+            return "GET", "/bulk-rna/gene-autocomplete/", {"term": f"SYN{rng.randint(0, 999)}"}
+        if name == "csv":
+            return "POST", f"/bulk-rna/download_csv/{analysis_id}/", {
+                "genes": ",".join(rng.sample(genes, min(self.heatmap_genes, len(genes)))),
+                "conditions": ",".join(self.manifest["conditions"]),
+            }
+        raise ValueError(f"Unknown scenario '{name}'")
+
+    def _next_slot(self, deadline):
+        with self._samples_lock:
+            if time.monotonic() >= deadline:
+                return False
+            if self.max_requests is not None and self._sent >= self.max_requests:
+                return False
+            self._sent += 1
+            return True
+
+    def _virtual_user(self, session, profile, rng, deadline):
+        names = list(self.mix)
+        weights = [self.mix[name] for name in names]
+        while self._next_slot(deadline):
+            name = rng.choices(names, weights)[0]
+            method, path, data = self.scenario_request(name, rng)
+            start = time.perf_counter()
+            try:
+                status, size, final_url = session.request(method, path, data)
+                error = None
+                if "/login/" in urllib.parse.urlsplit(final_url).path:
+                    # The session was lost and the request bounced to the login page
+                    status, error = 401, "redirected to login"
+                elif status != 200:
+                    error = f"HTTP {status}"
+            except OSError as e:
+                status, size, error = 0, 0, str(e)
+            elapsed = time.perf_counter() - start
+            with self._samples_lock:
+                self._samples.append(
+                    {"scenario": name, "profile": profile, "status": status, "seconds": elapsed, "bytes": size,
+                     "error": error}
+                )
+            if self.think_time:
+                time.sleep(rng.uniform(0, 2 * self.think_time))
+
+    def run(self):
+        sessions = []
+        for i in range(self.concurrency):
+            profile = self.profiles[i % len(self.profiles)]
+            session = HttpSession(self.base_url)
+            session.login(self.manifest["users"][profile], self.manifest["password"])
+            sessions.append((session, profile, random.Random(self.seed + i)))
+
+        self._samples = []
+        self._sent = 0
+        start = time.monotonic()
+        deadline = start + self.duration
+        threads = [
+            threading.Thread(target=self._virtual_user, args=(session, profile, rng, deadline), daemon=True)
+            for session, profile, rng in sessions
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - start
+
+        return {
+            "parameters": {
+                "base_url": self.base_url,
+                "concurrency": self.concurrency,
+                "duration": self.duration,
+                "max_requests": self.max_requests,
+                "mix": self.mix,
+                "profiles": self.profiles,
+                "heatmap_genes": self.heatmap_genes,
+                "think_time": self.think_time,
+                "genes": len(self.manifest["genes"]),
+            },
+            "elapsed": elapsed,
+            "total": summarise(self._samples, elapsed),
+            "scenarios": {
+                name: summarise([s for s in self._samples if s["scenario"] == name], elapsed)
+                for name in self.mix
+            },
+            "profiles": {
+                profile: summarise([s for s in self._samples if s["profile"] == profile], elapsed)
+                for profile in self.profiles
+            },
+        }
+
+
+def percentile(sorted_values, q):
+    """Linear-interpolated percentile (0-100) of an already sorted list."""
+    if not sorted_values:
+        return None
+    position = (len(sorted_values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def summarise(samples, elapsed):
+    """Throughput, error count and latency percentiles (seconds) of a list of samples."""
+    timings = sorted(sample["seconds"] for sample in samples if not sample["error"])
+    errors = [sample for sample in samples if sample["error"]]
+    error_counts = {}
+    for sample in errors:
+        error_counts[sample["error"]] = error_counts.get(sample["error"], 0) + 1
+    return {
+        "requests": len(samples),
+        "errors": len(errors),
+        "error_types": error_counts,
+        "throughput": len(samples) / elapsed if elapsed else 0.0,
+        "mean": statistics.fmean(timings) if timings else None,
+        "p50": percentile(timings, 50),
+        "p95": percentile(timings, 95),
+        "p99": percentile(timings, 99),
+        "max": timings[-1] if timings else None,
+    }
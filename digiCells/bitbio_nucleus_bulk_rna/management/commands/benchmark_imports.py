@@ -0,0 +1,75 @@
+import json
+import os
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from bitbio_nucleus_bulk_rna.benchmarking import IMPORT_TARGETS, benchmark_imports, compare_to_baseline, write_results
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure the import time and memory of each boot stage (django.setup, URLconf, analysis stack) "
+        "in fresh interpreters, with the cost broken down per top-level package."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--repeat", type=int, default=5)
+        parser.add_argument("--top", type=int, default=10, help="Packages to report per stage.")
+        parser.add_argument("--only", nargs="+", choices=list(IMPORT_TARGETS), help="Only measure these stages.")
+        parser.add_argument(
+            "--settings-module", default=settings.SETTINGS_MODULE,
+            help="Settings the child interpreters use (default: the current settings).",
+        )
+        parser.add_argument("--output", default="import_benchmark_results.json")
+        parser.add_argument("--baseline", help="Results file to compare against.")
+        parser.add_argument(
+            "--threshold", type=float, default=1.2,
+            help="Fail when a median is more than this many times the baseline median.",
+        )
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options["baseline"]:
+            try:
+                with open(options["baseline"]) as handle:
+                    baseline = json.load(handle)
+            except OSError as e:
+                raise CommandError(f"Cannot read baseline: {e}")
+
+        targets = IMPORT_TARGETS
+        if options["only"]:
+            targets = {name: IMPORT_TARGETS[name] for name in options["only"]}
+
+        results = benchmark_imports(
+            options["settings_module"],
+            targets=targets,
+            repeat=options["repeat"],
+            top=options["top"],
+            cwd=os.fspath(settings.BASE_DIR),
+        )
+        for name, stats in results["benchmarks"].items():
+            self.stdout.write(
+                f"\n{name:<16} median {stats['median'] * 1000:8.1f} ms   RSS {stats['rss_kb'] / 1024:7.1f} MB"
+            )
+            for package, seconds in stats["packages"].items():
+                self.stdout.write(f"    {package:<28} {seconds * 1000:8.1f} ms")
+
+        write_results(results, options["output"])
+        self.stdout.write(f"\nResults written to {options['output']}")
+
+        if baseline:
+            regressions = 0
+            self.stdout.write("\nCompared to baseline (median):")
+            for name, previous, current, ratio, regressed in compare_to_baseline(
+                results, baseline, options["threshold"]
+            ):
+                marker = "  REGRESSION" if regressed else ""
+                self.stdout.write(
+                    f"{name:<16} {previous * 1000:8.1f} ms -> {current * 1000:8.1f} ms  ({ratio:.2f}x){marker}"
+                )
+                regressions += regressed
+            if regressions:
+                self.stderr.write(f"{regressions} stage(s) regressed beyond {options['threshold']}x")
+                sys.exit(1)
@@ -0,0 +1,41 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from bitbio_nucleus_bulk_rna.models import AnalysisOutput
+from bitbio_nucleus_bulk_rna.similarity import get_similarity_index
+
+
+class Command(BaseCommand):
+    help = (
+        "Build the similarity index (approximate co-expression search) of datasets and save it in "
+        "BULK_RNA_SHARED_MATRIX_DIR, so that the first query does not pay for it. Run it on each host "
+        "after adding or re-uploading a dataset."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("analysis", type=int, nargs="*", help="Analysis IDs to index.")
+        parser.add_argument("--all", action="store_true", help="Every analysis with a file.")
+
+    def handle(self, *args, **options):
+        analyses = AnalysisOutput.objects.exclude(file_path__isnull=True).exclude(file_path="")
+        if not options["all"]:
+            if not options["analysis"]:
+                raise CommandError("Give analysis IDs or --all")
+            analyses = analyses.filter(id__in=options["analysis"])
+
+        failures = 0
+        for path, generation in sorted(set(analyses.values_list("file_path", "file_generation"))):
+            start = time.perf_counter()
+            try:
+                index = get_similarity_index(path, generation)
+            except Exception as e:
+                self.stderr.write(f"[ failed] {path}\n          {e}")
+                failures += 1
+                continue
+            self.stdout.write(
+                f"[indexed] {path}  {index.tables} tables x {index.bits} bits, "
+                f"{index.nbytes / 1024**2:.1f} MB, {time.perf_counter() - start:.2f}s"
+            )
+        if failures:
+            raise CommandError(f"{failures} dataset(s) could not be indexed")
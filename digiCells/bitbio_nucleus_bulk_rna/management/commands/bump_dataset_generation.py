@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from bitbio_nucleus_bulk_rna.datasets import dataset_version, record_dataset_version
+from bitbio_nucleus_bulk_rna.models import AnalysisOutput
+
+
+class Command(BaseCommand):
+    help = (
+        "Record the current version of dataset files and bump their generation, so that every worker "
+        "drops its cached matrices, PCA and plot results for them. Run it after re-uploading a file."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("analysis", type=int, nargs="*", help="Analysis IDs whose file changed.")
+        parser.add_argument("--path", nargs="+", default=[], help="File paths (s3://bucket/key or local) that changed.")
+        parser.add_argument("--all", action="store_true", help="Every analysis with a file.")
+        parser.add_argument(
+            "--if-changed", action="store_true",
+            help="Only bump files whose version differs from the recorded one.",
+        )
+
+    def handle(self, *args, **options):
+        analyses = AnalysisOutput.objects.exclude(file_path__isnull=True).exclude(file_path="")
+        if not options["all"]:
+            if not options["analysis"] and not options["path"]:
+                raise CommandError("Give analysis IDs, --path or --all")
+            missing = set(options["analysis"]) - set(analyses.filter(id__in=options["analysis"]).values_list("id", flat=True))
+            if missing:
+                raise CommandError(f"No analysis with a file for ID(s) {', '.join(map(str, sorted(missing)))}")
+            analyses = analyses.filter(id__in=options["analysis"]) | analyses.filter(file_path__in=options["path"])
+
+        paths = sorted(set(analyses.values_list("file_path", flat=True)) | set(options["path"]))
+        failures = 0
+        for path in paths:
+            previous = set(AnalysisOutput.objects.filter(file_path=path).values_list("file_generation", flat=True))
+            try:
+                version = dataset_version(path)
+            except Exception as e:
+                self.stderr.write(f"[ failed] {path}\n          {e}")
+                failures += 1
+                continue
+            generation = record_dataset_version(path, version, force=not options["if_changed"])
+            if generation is None:
+                self.stderr.write(f"[unknown] {path}: no analysis uses this file")
+                failures += 1
+            elif generation in previous:
+                self.stdout.write(f"[  same ] {path}  generation {generation}, version {version}")
+            else:
+                self.stdout.write(f"[ bumped] {path}  generation {generation}, version {version}")
+        if failures:
+            raise CommandError(f"{failures} file(s) could not be bumped")
@@ -0,0 +1,43 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from bitbio_nucleus_bulk_rna.dataset_statistics import ensure_dataset_statistics
+from bitbio_nucleus_bulk_rna.models import AnalysisOutput
+
+
+class Command(BaseCommand):
+    help = (
+        "Compute and store the summary statistics (gene variability, sample QC) of dataset files, so that "
+        "the analysis list, the statistics endpoint and the PCA read them instead of scanning the matrix. "
+        "Run it after adding or re-uploading a dataset."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("analysis", type=int, nargs="*", help="Analysis IDs whose file to summarise.")
+        parser.add_argument("--all", action="store_true", help="Every analysis with a file.")
+        parser.add_argument("--force", action="store_true", help="Recompute statistics already stored.")
+
+    def handle(self, *args, **options):
+        analyses = AnalysisOutput.objects.exclude(file_path__isnull=True).exclude(file_path="")
+        if not options["all"]:
+            if not options["analysis"]:
+                raise CommandError("Give analysis IDs or --all")
+            analyses = analyses.filter(id__in=options["analysis"])
+
+        failures = 0
+        for path, generation in sorted(set(analyses.values_list("file_path", "file_generation"))):
+            start = time.perf_counter()
+            try:
+                statistics = ensure_dataset_statistics(path, generation, force=options["force"])
+            except Exception as e:
+                self.stderr.write(f"[ failed] {path}\n          {e}")
+                failures += 1
+                continue
+            self.stdout.write(
+                f"[  done ] {path}  {statistics.n_genes} genes ({statistics.detected_genes} detected), "
+                f"{statistics.n_samples} samples, {len(statistics.data) / 1024:.0f} KB, "
+                f"{time.perf_counter() - start:.2f}s"
+            )
+        if failures:
+            raise CommandError(f"{failures} dataset(s) could not be summarised")
@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand
+
+from bitbio_nucleus_bulk_rna.benchmarking import (
+    create_gene_rows,
+    generate_expression_matrix,
+    write_gtf,
+    write_matrix,
+)
+from bitbio_nucleus_bulk_rna.models import AnalysisOutput
+
+
+class Command(BaseCommand):
+    help = "Generate a synthetic expression matrix (cell_day_R# samples) and, optionally, matching Gene rows."
+
+    def add_arguments(self, parser):
+        parser.add_argument("output", help="Path of the TSV file to write.")
+        parser.add_argument("--genes", type=int, default=60000)
+        parser.add_argument("--samples", type=int, default=36)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--create-genes", action="store_true", help="Create the matching Gene rows.")
+        parser.add_argument(
+            "--create-analysis", action="store_true", help="Create an AnalysisOutput pointing at the file."
+        )
+        parser.add_argument("--gtf", help="Also write a gzipped GTF describing the synthetic genes to this path.")
+
+    def handle(self, *args, **options):
+        df = generate_expression_matrix(options["genes"], options["samples"], seed=options["seed"])
+        write_matrix(df, options["output"])
+        self.stdout.write(f"Wrote {df.shape[0]} genes x {df.shape[1]} samples to {options['output']}")
+
+        if options["gtf"]:
+            write_gtf(options["gtf"], options["genes"])
+            self.stdout.write(f"Wrote GTF to {options['gtf']}")
+
+        if options["create_genes"]:
+            created = create_gene_rows(options["genes"])
+            self.stdout.write(f"Created {created} Gene rows")
+
+        if options["create_analysis"]:
+            analysis = AnalysisOutput.objects.create(
+                metadata={"synthetic": True, "genes": df.shape[0], "samples": df.shape[1]},
+                file_path=options["output"],
+                product="Synthetic",
+                description=f"Synthetic dataset ({df.shape[0]} x {df.shape[1]})",
+                conditions=",".join(sorted({column.split("_")[1] for column in df.columns})),
+            )
+            self.stdout.write(f"Created AnalysisOutput {analysis.id}")
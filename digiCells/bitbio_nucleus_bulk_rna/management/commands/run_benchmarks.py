@@ -0,0 +1,92 @@
+import json
+import sys
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from bitbio_nucleus_bulk_rna.benchmarking import BenchmarkSuite, compare_to_baseline, write_results
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the bulk RNA hot paths against a synthetic dataset served from a local S3 stand-in. "
+        "Runs in a throwaway test database and writes machine-readable results."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--genes", type=int, default=60000)
+        parser.add_argument("--samples", type=int, default=36)
+        parser.add_argument("--heatmap-genes", type=int, default=100)
+        parser.add_argument("--gtf-genes", type=int, default=2000)
+        parser.add_argument("--repeat", type=int, default=5)
+        parser.add_argument("--warmup", type=int, default=1)
+        parser.add_argument("--s3-latency", type=float, default=0.0, help="Seconds added to every S3 call.")
+        parser.add_argument("--only", nargs="+", help="Only run these benchmarks.")
+        parser.add_argument("--output", default="benchmark_results.json")
+        parser.add_argument("--baseline", help="Results file to compare against.")
+        parser.add_argument(
+            "--threshold", type=float, default=1.2,
+            help="Fail when a median is more than this many times the baseline median.",
+        )
+        parser.add_argument("--workdir", help="Directory for generated files (default: a temporary directory).")
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options["baseline"]:
+            try:
+                with open(options["baseline"]) as handle:
+                    baseline = json.load(handle)
+            except OSError as e:
+                raise CommandError(f"Cannot read baseline: {e}")
+
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                suite = BenchmarkSuite(
+                    options["workdir"] or tmp,
+                    n_genes=options["genes"],
+                    n_samples=options["samples"],
+                    heatmap_genes=options["heatmap_genes"],
+                    gtf_genes=options["gtf_genes"],
+                    s3_latency=options["s3_latency"],
+                )
+                self.stdout.write(f"Setting up {options['genes']} genes x {options['samples']} samples...")
+                suite.setup()
+                results = suite.run(
+                    repeat=options["repeat"],
+                    warmup=options["warmup"],
+                    only=options["only"],
+                    progress=self._progress,
+                )
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        write_results(results, options["output"])
+        self.stdout.write(f"Results written to {options['output']}")
+
+        if baseline:
+            regressions = self._report(compare_to_baseline(results, baseline, options["threshold"]))
+            if regressions:
+                self.stderr.write(f"{regressions} benchmark(s) regressed beyond {options['threshold']}x")
+                sys.exit(1)
+
+    def _progress(self, name, stats):
+        size = f"   {stats['response_bytes'] / 1024:9.1f} KB" if "response_bytes" in stats else ""
+        if "recall_at_k" in stats:
+            size += f"   recall {stats['recall_at_k']:.3f}"
+        self.stdout.write(
+            f"{name:<24} median {stats['median'] * 1000:9.1f} ms   "
+            f"min {stats['min'] * 1000:9.1f} ms   max {stats['max'] * 1000:9.1f} ms{size}"
+        )
+
+    def _report(self, rows):
+        regressions = 0
+        self.stdout.write("\nCompared to baseline (median):")
+        for name, previous, current, ratio, regressed in rows:
+            marker = "  REGRESSION" if regressed else ""
+            self.stdout.write(
+                f"{name:<24} {previous * 1000:9.1f} ms -> {current * 1000:9.1f} ms  ({ratio:.2f}x){marker}"
+            )
+            regressions += regressed
+        return regressions
@@ -0,0 +1,119 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from bitbio_nucleus_bulk_rna.benchmarking import write_results
+from bitbio_nucleus_bulk_rna.loadtest import (
+    DEFAULT_MIX,
+    TIER_PROFILES,
+    LoadTest,
+    LoginFailed,
+    UnsafeDatabase,
+    load_manifest,
+    parse_mix,
+    setup_fixtures,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Replay a concurrent mix of bulk RNA requests (analysis list, explore, PCA, autocomplete, CSV) "
+        "against a running server, with one user per tier, and report throughput and latency percentiles. "
+        "Run with --setup first to create the fixtures in the database the server uses."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+        parser.add_argument(
+            "--setup", action="store_true",
+            help="Create or refresh the dataset, collections and tier users before running.",
+        )
+        parser.add_argument("--setup-only", action="store_true", help="Create the fixtures and exit.")
+        parser.add_argument(
+            "--data-dir", default=os.path.join(settings.TMP_DIR, "loadtest"),
+            help="Where the dataset and fixture manifest live. Must be readable by the server.",
+        )
+        parser.add_argument("--genes", type=int, default=2000)
+        parser.add_argument("--samples", type=int, default=36)
+        parser.add_argument("--password", default="loadtest")
+        parser.add_argument("--concurrency", type=int, default=8)
+        parser.add_argument("--duration", type=float, default=30.0, help="Seconds to run for.")
+        parser.add_argument("--requests", type=int, help="Stop after this many requests.")
+        parser.add_argument(
+            "--mix", type=parse_mix,
+            help=f"Scenario weights, e.g. explore=4,pca=1 (default {','.join(f'{k}={v}' for k, v in DEFAULT_MIX.items())}).",
+        )
+        parser.add_argument(
+            "--profiles", nargs="+", choices=list(TIER_PROFILES),
+            help="Tier profiles to log in as, assigned round-robin to the virtual users (default: all).",
+        )
+        parser.add_argument("--heatmap-genes", type=int, default=50, help="Most genes per explore/CSV request.")
+        parser.add_argument("--think-time", type=float, default=0.0, help="Mean pause between requests per user.")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--output", help="Write the results as JSON to this file.")
+
+    def handle(self, *args, **options):
+        data_dir = options["data_dir"]
+        if options["setup"] or options["setup_only"]:
+            os.makedirs(data_dir, exist_ok=True)
+            try:
+                manifest = setup_fixtures(
+                    data_dir, n_genes=options["genes"], n_samples=options["samples"], password=options["password"]
+                )
+            except UnsafeDatabase as e:
+                raise CommandError(str(e))
+            self.stdout.write(
+                f"Fixtures ready: analysis {manifest['analysis_id']}, users {', '.join(manifest['users'].values())}"
+            )
+            if options["setup_only"]:
+                return
+        else:
+            try:
+                manifest = load_manifest(data_dir)
+            except OSError:
+                raise CommandError(f"No fixtures in {data_dir}, run with --setup first")
+
+        load_test = LoadTest(
+            options["base_url"],
+            manifest,
+            concurrency=options["concurrency"],
+            duration=options["duration"],
+            max_requests=options["requests"],
+            mix=options["mix"],
+            profiles=options["profiles"],
+            heatmap_genes=options["heatmap_genes"],
+            think_time=options["think_time"],
+            seed=options["seed"],
+        )
+        self.stdout.write(
+            f"Running {options['concurrency']} users against {options['base_url']} for {options['duration']}s..."
+        )
+        try:
+            results = load_test.run()
+        except LoginFailed as e:
+            raise CommandError(str(e))
+
+        self._report("Scenario", results["scenarios"])
+        self._report("Profile", results["profiles"])
+        self._report("", {"total": results["total"]})
+
+        if options["output"]:
+            write_results(results, options["output"])
+            self.stdout.write(f"Results written to {options['output']}")
+
+    def _report(self, title, rows):
+        self.stdout.write(
+            f"\n{title:<14} {'requests':>8} {'errors':>6} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}"
+        )
+        for name, stats in rows.items():
+            self.stdout.write(
+                f"{name:<14} {stats['requests']:>8} {stats['errors']:>6} {stats['throughput']:>8.2f} "
+                f"{self._ms(stats['p50'])} {self._ms(stats['p95'])} {self._ms(stats['p99'])}"
+            )
+            for error, count in stats["error_types"].items():
+                self.stdout.write(f"{'':<14} {count:>8} x {error}")
+
+    @staticmethod
+    def _ms(seconds):
+        return f"{seconds * 1000:>9.1f}" if seconds is not None else f"{'-':>9}"
@@ -0,0 +1,47 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from bitbio_nucleus_bulk_rna.warmup import prepare_datasets, select_datasets
+
+
+class Command(BaseCommand):
+    help = (
+        "Build the spool copy and the shared export of the most used and commercially visible datasets on "
+        "this host, and store their statistics, reporting the time and disk each one takes. This does not "
+        "warm the workers' in-memory dataset caches, which end with this process: set "
+        "BULK_RNA_WARM_ON_BOOT for gunicorn to warm them."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--analysis", type=int, nargs="+", help="Prepare these analysis IDs instead of the default selection."
+        )
+        parser.add_argument("--limit", type=int, help=f"Most datasets to prepare (default {settings.BULK_RNA_WARM_LIMIT}).")
+
+    def handle(self, *args, **options):
+        analyses = select_datasets(limit=options["limit"], analysis_ids=options["analysis"])
+        if not analyses:
+            self.stdout.write("No datasets to prepare")
+            return
+
+        self.stdout.write(f"Preparing {len(analyses)} dataset(s)...")
+        start = time.perf_counter()
+        results = prepare_datasets(analyses, progress=self._progress)
+
+        prepared = [result for result in results if result["status"] == "prepared"]
+        self.stdout.write(
+            f"Prepared {len(prepared)} of {len(results)} in {time.perf_counter() - start:.1f}s, "
+            f"{sum(result['bytes'] for result in prepared) / 1024**2:.1f} MB exported"
+        )
+
+    def _progress(self, result):
+        line = (
+            f"[{result['status']:>8}] analysis {result['analysis_id']:<6} "
+            f"{result['seconds']:7.2f}s {result['bytes'] / 1024**2:9.1f} MB  {result['path']}"
+        )
+        if result["status"] == "failed":
+            self.stderr.write(f"{line}\n           {result['error']}")
+        else:
+            self.stdout.write(line)
@@ -0,0 +1,73 @@
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def copy_requested_genes_to_ledger(apps, schema_editor):
+    """Move the rows of the implicit M2M table into UserGeneAccess and fill gene_count."""
+    UserGeneRequest = apps.get_model('bitbio_nucleus_bulk_rna', 'UserGeneRequest')
+    UserGeneAccess = apps.get_model('bitbio_nucleus_bulk_rna', 'UserGeneAccess')
+    LegacyThrough = UserGeneRequest.genes.through
+
+    for user_request in UserGeneRequest.objects.all().iterator():
+        gene_ids = list(
+            LegacyThrough.objects.filter(usergenerequest_id=user_request.id).values_list('gene_id', flat=True)
+        )
+        UserGeneAccess.objects.bulk_create(
+            [
+                UserGeneAccess(
+                    user_request_id=user_request.id,
+                    gene_id=gene_id,
+                    first_requested_at=user_request.created_at,
+                    last_requested_at=user_request.created_at,
+                )
+                for gene_id in gene_ids
+            ],
+            ignore_conflicts=True,
+        )
+        user_request.gene_count = len(set(gene_ids))
+        user_request.save(update_fields=['gene_count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bitbio_nucleus_bulk_rna', '0007_genecollection_customer_visible_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tier',
+            name='quota_window_days',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='usergenerequest',
+            name='gene_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='UserGeneAccess',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('first_requested_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_requested_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('gene', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='bitbio_nucleus_bulk_rna.gene')),
+                ('user_request', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='accesses', to='bitbio_nucleus_bulk_rna.usergenerequest')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user_request', 'last_requested_at'], name='user_gene_access_window_idx')],
+                'constraints': [models.UniqueConstraint(fields=('user_request', 'gene'), name='unique_user_gene_access')],
+            },
+        ),
+        migrations.RunPython(copy_requested_genes_to_ledger, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='usergenerequest',
+            name='genes',
+        ),
+        migrations.AddField(
+            model_name='usergenerequest',
+            name='genes',
+            field=models.ManyToManyField(blank=True, through='bitbio_nucleus_bulk_rna.UserGeneAccess', to='bitbio_nucleus_bulk_rna.gene'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.3 on 2026-10-19 04:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bitbio_nucleus_bulk_rna', '0008_usergeneaccess_ledger'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='analysisoutput',
+            name='file_generation',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='analysisoutput',
+            name='file_version',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.1.3 on 2026-10-19 05:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bitbio_nucleus_bulk_rna', '0009_analysisoutput_file_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DatasetStatistics',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file_path', models.TextField()),
+                ('file_version', models.CharField(max_length=255)),
+                ('computed_at', models.DateTimeField(auto_now=True)),
+                ('n_genes', models.PositiveIntegerField()),
+                ('n_samples', models.PositiveIntegerField()),
+                ('detected_genes', models.PositiveIntegerField()),
+                ('median_library_size', models.FloatField()),
+                ('data', models.BinaryField()),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('file_path', 'file_version'), name='unique_dataset_statistics')],
+            },
+        ),
+    ]
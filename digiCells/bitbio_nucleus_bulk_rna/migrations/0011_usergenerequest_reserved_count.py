@@ -0,0 +1,23 @@
+# Generated by Django 5.1.3 on 2026-10-19 05:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bitbio_nucleus_bulk_rna', '0010_datasetstatistics'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='usergenerequest',
+            name='reserved_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='usergenerequest',
+            name='reserved_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.1.3 on 2026-10-19 06:12
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bitbio_nucleus_bulk_rna', '0011_usergenerequest_reserved_count'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='usergenerequest',
+            name='reserved_at',
+        ),
+        migrations.RemoveField(
+            model_name='usergenerequest',
+            name='reserved_count',
+        ),
+        migrations.CreateModel(
+            name='UsageReservation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('reserved_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('gene', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='bitbio_nucleus_bulk_rna.gene')),
+                ('user_request', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reservations', to='bitbio_nucleus_bulk_rna.usergenerequest')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('user_request', 'gene'), name='unique_usage_reservation')],
+            },
+        ),
+    ]
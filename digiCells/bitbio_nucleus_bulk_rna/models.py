@@ -1,5 +1,8 @@
+from datetime import timedelta
+
 from django.db import models
 from django.contrib.auth.models import User, Group
+from django.utils import timezone
 
 
 class AnalysisOutput(models.Model):
@@ -26,11 +29,40 @@ class AnalysisOutput(models.Model):
     is_visible_in_commercial_app = models.BooleanField(default=False)
     metadata = models.JSONField()
     file_path = models.TextField(null=True, blank=True)
+    # Version of the file last seen (S3 ETag, or mtime and size of a local file), and a counter
+    # bumped whenever it changes. Cached matrices and results carry the generation they were
+    # computed from, so every worker drops them as soon as it reads a newer generation here.
+    file_version = models.CharField(max_length=255, blank=True, default="")
+    file_generation = models.PositiveIntegerField(default=0)
 
     def __str__(self):
         return f"{self.get_analysis_type_display()} Analysis - {self.created_at}"
 
 
+class DatasetStatistics(models.Model):
+    """
+    Summary statistics of one version of a dataset file, see dataset_statistics.py. The per-gene
+    and per-sample arrays are kept in `data` as a compressed .npz archive.
+    """
+    file_path = models.TextField()
+    file_version = models.CharField(max_length=255)
+    computed_at = models.DateTimeField(auto_now=True)
+    n_genes = models.PositiveIntegerField()
+    n_samples = models.PositiveIntegerField()
+    # Genes expressed in at least one sample
+    detected_genes = models.PositiveIntegerField()
+    median_library_size = models.FloatField()
+    data = models.BinaryField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['file_path', 'file_version'], name='unique_dataset_statistics'),
+        ]
+
+    def __str__(self):
+        return f"{self.file_path} ({self.n_genes} genes, {self.n_samples} samples)"
+
+
 class Gene(models.Model):
     gene_name = models.CharField(max_length=100)
     ensembl_id = models.CharField(max_length=100)
@@ -68,6 +100,14 @@ class Tier(models.Model):
     name = models.CharField(max_length=50, unique=True)
     description = models.TextField(blank=True, null=True)  # Optional field for tier details
     max_genes = models.PositiveIntegerField(default=100)  # Gene limit for the tier
+    # Optional rolling window for the quota, e.g. 30 for "max_genes per 30 days". Empty means all-time.
+    quota_window_days = models.PositiveIntegerField(null=True, blank=True)
+
+    def quota_window_start(self):
+        """Start of the current quota window, or None for an all-time quota."""
+        if not self.quota_window_days:
+            return None
+        return timezone.now() - timedelta(days=self.quota_window_days)
 
     def __str__(self):
         return f"{self.name} (Limit: {self.max_genes})"
@@ -83,16 +123,67 @@ class UserTier(models.Model):
 
 class UserGeneRequest(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
-    genes = models.ManyToManyField(Gene, blank=True)
+    genes = models.ManyToManyField(Gene, blank=True, through='UserGeneAccess')
+    # Denormalised number of distinct genes in the ledger, kept in step with UserGeneAccess rows
+    gene_count = models.PositiveIntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    def genes_used(self, tier):
+        """
+        Number of genes counted against the given tier's quota.
+
+        All-time quotas read the denormalised counter; windowed quotas count ledger rows
+        touched inside the window, which is served by the (user_request, last_requested_at) index.
+        """
+        if not tier.quota_window_days:
+            return self.gene_count
+        return self.accesses.filter(last_requested_at__gte=tier.quota_window_start()).count()
+
     def is_within_limit(self):
         """
         Check if the number of requested genes is within the user's tier limit.
         """
         try:
-            user_tier = UserTier.objects.get(user=self.user)
-            return self.genes.count() <= user_tier.tier.max_genes
+            user_tier = UserTier.objects.select_related('tier').get(user=self.user)
+            return self.genes_used(user_tier.tier) <= user_tier.tier.max_genes
         except UserTier.DoesNotExist:
             return False  # Handle case where the user has no assigned tier
 
+
+class UserGeneAccess(models.Model):
+    """
+    Ledger row recording that a user has been served a gene. One row per (user request, gene).
+    """
+    user_request = models.ForeignKey(UserGeneRequest, on_delete=models.CASCADE, related_name='accesses')
+    gene = models.ForeignKey(Gene, on_delete=models.CASCADE)
+    first_requested_at = models.DateTimeField(default=timezone.now)
+    last_requested_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user_request', 'gene'], name='unique_user_gene_access'),
+        ]
+        indexes = [
+            models.Index(fields=['user_request', 'last_requested_at'], name='user_gene_access_window_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_request.user} - {self.gene}"
+
+
+class UsageReservation(models.Model):
+    """
+    A gene served to a user but not yet written to the ledger by the usage recorder, which
+    counts against their quota until it is. See usage.py.
+    """
+    user_request = models.ForeignKey(UserGeneRequest, on_delete=models.CASCADE, related_name='reservations')
+    gene = models.ForeignKey(Gene, on_delete=models.CASCADE)
+    reserved_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user_request', 'gene'], name='unique_usage_reservation'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_request.user} - {self.gene} (reserved)"
@@ -0,0 +1,195 @@
+"""
+Approximate search of genes with similar expression profiles.
+
+An exact co-expression query (analytics.top_correlated) scores every gene of the dataset.
+``SimilarityIndex`` narrows the search down with random-projection locality-sensitive hashing
+over the same standardised profiles: in each of its hash tables a gene gets a code made of the
+signs of its profile's projections on random hyperplanes, so genes with correlated profiles
+are likely to share a bucket in at least one table. A query then scores only the genes of its
+buckets, exactly.
+
+`probes` is the recall/latency knob: a query also looks, in every table, at the buckets whose
+code differs from its own by one of the `probes` bits whose hyperplanes it is closest to
+(multi-probe LSH). 0 is the fastest; more probes find more of the true neighbours at the cost
+of scoring more candidates. ``manage.py run_benchmarks --only similarity_exact
+similarity_probes_0 ...`` reports recall@k against the exact scan.
+
+Indexes are built once per dataset version and host, saved next to the dataset's shared export
+in BULK_RNA_SHARED_MATRIX_DIR, and loaded by the workers that query them.
+``manage.py build_similarity_index`` builds them when a dataset is added or re-uploaded;
+otherwise the first query builds it.
+"""
+
+import hashlib
+import logging
+import math
+import os
+import threading
+
+from django.conf import settings
+
+from digiCells_core.locks import file_lock
+from digiCells_core.tracing import span
+
+from .analytics import get_coexpression_profiles, top_correlated
+from .datasets import _remove_other_versions, dataset_cache, dataset_version
+
+logger = logging.getLogger(__name__)
+
+
+def index_bits(n_genes, bucket_size):
+    """Bits per code giving buckets of about `bucket_size` genes."""
+    return min(max(round(math.log2(max(n_genes, 1) / bucket_size)), 1), 30)
+
+
+class SimilarityIndex:
+    """
+    Random-projection LSH index over the rows of a profile matrix.
+
+    Args:
+        planes (ndarray): Hyperplane normals, (samples, tables * bits) float32.
+        codes (ndarray): Sorted codes of the genes in each table, (tables, genes) int64.
+        order (ndarray): Row of the gene holding each sorted code, (tables, genes) int32.
+        bits (int): Bits per code.
+    """
+
+    def __init__(self, planes, codes, order, bits):
+        self.planes = planes
+        self.codes = codes
+        self.order = order
+        self.bits = bits
+        self.tables = len(codes)
+        self.nbytes = planes.nbytes + codes.nbytes + order.nbytes
+
+    @classmethod
+    def build(cls, matrix, tables, bits, seed=0):
+        """
+        Args:
+            matrix (ndarray): Standardised profiles, see analytics.coexpression_profiles().
+        """
+        import numpy as np
+
+        rng = np.random.default_rng(seed)
+        planes = rng.standard_normal((matrix.shape[1], tables * bits)).astype(np.float32)
+        with span("similarity_index_build", genes=len(matrix), tables=tables, bits=bits):
+            gene_codes = cls._codes(matrix @ planes, tables, bits)
+            order = np.argsort(gene_codes, axis=1, kind="stable").astype(np.int32)
+            codes = np.take_along_axis(gene_codes, order, axis=1)
+        return cls(planes, codes, order, bits)
+
+    @staticmethod
+    def _codes(projections, tables, bits):
+        import numpy as np
+
+        signs = (projections > 0).reshape(len(projections), tables, bits)
+        # (tables, genes): bit b of a code is the sign on the table's b-th hyperplane
+        return np.moveaxis((signs.astype(np.int64) << np.arange(bits)).sum(axis=2), 0, 1)
+
+    def candidates(self, profile, probes=0):
+        """
+        Rows sharing a bucket with `profile` in any table, or a bucket one bit away along the
+        `probes` hyperplanes closest to it.
+
+        Returns:
+            ndarray: Sorted row numbers.
+        """
+        import numpy as np
+
+        projections = (profile @ self.planes).reshape(self.tables, self.bits)
+        own = self._codes(projections.reshape(1, -1), self.tables, self.bits)[:, 0]
+        probe_codes = [own]
+        if probes > 0:
+            closest = np.argsort(np.abs(projections), axis=1)[:, : min(probes, self.bits)]
+            probe_codes.extend((own ^ (np.int64(1) << closest[:, i].astype(np.int64))) for i in range(closest.shape[1]))
+        probe_codes = np.stack(probe_codes, axis=1)
+
+        found = []
+        for table in range(self.tables):
+            starts = np.searchsorted(self.codes[table], probe_codes[table], side="left")
+            stops = np.searchsorted(self.codes[table], probe_codes[table], side="right")
+            found.extend(self.order[table, start:stop] for start, stop in zip(starts, stops) if stop > start)
+        if not found:
+            return np.empty(0, dtype=np.int32)
+        return np.unique(np.concatenate(found))
+
+    def save(self, path):
+        import numpy as np
+
+        with open(path, "wb") as handle:
+            np.savez(handle, planes=self.planes, codes=self.codes, order=self.order, bits=self.bits)
+
+    @classmethod
+    def load(cls, path):
+        import numpy as np
+
+        with np.load(path) as saved:
+            return cls(saved["planes"], saved["codes"], saved["order"], int(saved["bits"]))
+
+
+def index_path(path_to_tsv, version, tables, bits):
+    prefix = hashlib.md5(path_to_tsv.encode()).hexdigest()
+    name = f"{prefix}-{hashlib.md5(version.encode()).hexdigest()}.lsh{tables}x{bits}"
+    return os.path.join(settings.BULK_RNA_SHARED_MATRIX_DIR, name + ".npz")
+
+
+def load_or_build_index(path_to_tsv, profiles, version):
+    """
+    The similarity index of a dataset version, loaded from BULK_RNA_SHARED_MATRIX_DIR or built
+    and saved there, once per host. Indexes of older versions of the dataset are removed.
+
+    Args:
+        profiles (tuple): The dataset's Pearson profiles, see analytics.coexpression_profiles().
+    """
+    genes, matrix, varies = profiles
+    tables = settings.BULK_RNA_SIMILARITY_TABLES
+    bits = index_bits(len(genes), settings.BULK_RNA_SIMILARITY_BUCKET_SIZE)
+    path = index_path(path_to_tsv, version, tables, bits)
+    if os.path.exists(path):
+        return SimilarityIndex.load(path)
+
+    os.makedirs(settings.BULK_RNA_SHARED_MATRIX_DIR, exist_ok=True)
+    with file_lock(path[: -len(".npz")] + ".lock", timeout=settings.BULK_RNA_DATASET_LOCK_TIMEOUT):
+        if os.path.exists(path):
+            return SimilarityIndex.load(path)
+        index = SimilarityIndex.build(matrix, tables, bits)
+        partial = f"{path}.{os.getpid()}.{threading.get_ident()}.partial"
+        try:
+            index.save(partial)
+            os.replace(partial, path)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+
+    prefix = os.path.basename(path).split("-")[0]
+    _remove_other_versions(settings.BULK_RNA_SHARED_MATRIX_DIR, prefix, path, (".npz", ".lock"))
+    return index
+
+
+def get_similarity_index(path_to_tsv, generation=None):
+    """SimilarityIndex of the current version of a dataset, cached with the dataset."""
+    profiles = get_coexpression_profiles(path_to_tsv, "pearson", generation)
+
+    def load(matrix):
+        version = dataset_cache.version(path_to_tsv) or dataset_version(path_to_tsv)
+        return load_or_build_index(path_to_tsv, profiles, version)
+
+    return dataset_cache.artifact(path_to_tsv, "similarity_index", load, generation)
+
+
+def get_similar_genes(path_to_tsv, gene_df_id, k, probes, allowed=None, generation=None):
+    """
+    Approximate counterpart of analytics.get_coexpression() for Pearson correlation: the
+    candidates found by the dataset's similarity index are scored exactly.
+
+    Args:
+        probes (int): Extra buckets looked at per table, see the module docstring.
+        generation (int): file_generation of the analysis, see datasets.py.
+    """
+    profiles = get_coexpression_profiles(path_to_tsv, "pearson", generation)
+    index = get_similarity_index(path_to_tsv, generation)
+    genes, matrix, varies = profiles
+    row = genes.get_loc(gene_df_id)
+    with span("similarity_candidates", probes=probes) as attributes:
+        candidates = index.candidates(matrix[row], probes)
+        attributes["candidates"] = len(candidates)
+    return top_correlated(profiles, gene_df_id, k, allowed, candidates=candidates)
@@ -95,22 +95,23 @@ class GeneCollectionTable(tables.Table):
         Render the dataset column to show the product values
         from the related AnalysisOutput objects.
         """
-        # Get the product values from related AnalysisOutput objects
-        products = record.linked_analyses.values_list('product', flat=True)
+        # Get the product values from related AnalysisOutput objects.
+        # Uses .all() so the view's prefetch_related('linked_analyses') is reused.
+        products = [analysis.product for analysis in record.linked_analyses.all()]
 
         # Join the product names into a single string, separated by commas
         return ", ".join(products)
 
     def render_edit(self, record):
         # Show edit button if the user is the owner
-        if record.created_by == self.request.user:
+        if record.created_by_id == self.request.user.id:
             edit_url = reverse('bulk_rna:edit_gene_collection', args=[record.id])
             return format_html('<a href="{}" class="btn btn-warning btn-sm">Edit</a>', edit_url)
         return ''
 
     def render_delete(self, record):
         # Show delete button if the user is the owner
-        if record.created_by == self.request.user:
+        if record.created_by_id == self.request.user.id:
             delete_url = reverse('bulk_rna:delete_gene_collection', args=[record.id])
             return format_html('<a href="{}" class="btn btn-danger btn-sm">Delete</a>', delete_url)
         return ''
@@ -0,0 +1,755 @@
+import base64
+import csv
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from digiCells_core.testing import QueryBudgetTestMixin, assert_max_queries
+
+from .analytics import GENE_SET_METHODS, compute_pca, differential_expression, gene_set_scores, get_pca
+from .datasets import (
+    DatasetCache,
+    dataset_cache,
+    dataset_version,
+    get_expression_matrix,
+    get_shared_matrix,
+    record_dataset_version,
+)
+from .models import (
+    AnalysisOutput,
+    DatasetStatistics,
+    Gene,
+    GeneCollection,
+    Tier,
+    UsageReservation,
+    UserGeneAccess,
+    UserGeneRequest,
+    UserTier,
+)
+from .similarity import SimilarityIndex, index_bits
+from .usage import UsageRecorder, recorder
+from .utils import transform_tpm_data
+from .warmup import prepare_datasets
+
+
+def unpack(payload):
+    """The array packed by payloads.pack_values()."""
+    return np.frombuffer(base64.b64decode(payload["data"]), dtype="<f4").reshape(payload["shape"])
+
+
+class DatasetFileMixin:
+    """Writes a dataset file of the test's `genes` to a temporary directory before each test."""
+
+    @classmethod
+    def setUpClass(cls):
+        # Before super(), which runs setUpTestData()
+        cls.workdir = tempfile.mkdtemp()
+        cls.dataset_path = os.path.join(cls.workdir, "dataset.tsv")
+        cls.settings_override = override_settings(
+            BULK_RNA_DATASET_SPOOL_DIR=os.path.join(cls.workdir, "spool"),
+            BULK_RNA_SHARED_MATRIX_DIR=os.path.join(cls.workdir, "shared"),
+            BULK_RNA_COMPUTE_PROCESSES=0,
+        )
+        cls.settings_override.enable()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.settings_override.disable()
+        shutil.rmtree(cls.workdir, ignore_errors=True)
+        super().tearDownClass()
+
+    @staticmethod
+    def create_genes():
+        return Gene.objects.bulk_create([Gene(ensembl_id=f"ENSG{i:011d}", gene_name=f"GENE{i}") for i in range(20)])
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        dataset_cache.clear()
+        with open(self.dataset_path, "w") as handle:
+            handle.write("\t".join(["gene", "ioA_D0_R1", "ioA_D0_R2", "ioA_D3_R1", "ioA_D3_R2"]) + "\n")
+            for number, gene in enumerate(self.genes):
+                values = [1.0, 2.0, 3.0 + number, 4.0 + 2 * number]
+                handle.write("\t".join([gene.df_string] + [str(value) for value in values]) + "\n")
+
+
+class ViewQueryBudgetTests(QueryBudgetTestMixin, DatasetFileMixin, TestCase):
+    """
+    Pins the query cost of the list and explore pages to their QUERY_BUDGETS, and checks that
+    it does not grow with the number of analyses and collections shown (no N+1).
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.genes = cls.create_genes()
+        researcher = Tier.objects.create(name="Researcher", max_genes=100000)
+        cls.user = User.objects.create_user("researcher", password="password")
+        UserTier.objects.create(user=cls.user, tier=researcher)
+        cls.analysis = cls.add_analysis(0)
+
+    @classmethod
+    def add_analysis(cls, number):
+        return AnalysisOutput.objects.create(
+            metadata={},
+            file_path=cls.dataset_path,
+            product=f"io{number}",
+            conditions="D0,D3",
+            is_visible_in_commercial_app=True,
+        )
+
+    def add_collection(self, number):
+        collection = GeneCollection.objects.create(
+            collection_name=f"collection {number}",
+            description="",
+            created_by=self.user,
+            private_collection=False,
+            customer_visible=True,
+        )
+        collection.included_genes.set(self.genes[number : number + 5])
+        collection.linked_analyses.add(self.analysis)
+        return collection
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.user)
+
+    def assertQueriesDoNotGrow(self, url, add_rows):
+        small = self.client.get(url)
+        self.assertEqual(small.status_code, 200)
+        add_rows()
+        # Same requests again, with the sessions and the user's tier already set up
+        small = self.client.get(url)
+        add_rows()
+        large = self.client.get(url)
+        self.assertEqual(large.status_code, 200)
+        self.assertLessEqual(large.query_stats.count, small.query_stats.count)
+        self.assertWithinQueryBudget(large)
+
+    def test_analysis_list(self):
+        url = reverse("bulk_rna:bulk_rna_analysis_list")
+        self.assertQueriesDoNotGrow(url, lambda: [self.add_analysis(number) for number in range(1, 6)])
+
+    def test_gene_collection_list(self):
+        url = reverse("bulk_rna:gene_collection_list")
+        self.assertQueriesDoNotGrow(url, lambda: [self.add_collection(number) for number in range(5)])
+
+    def test_explore_analysis(self):
+        url = reverse("bulk_rna:explore_analysis", args=[self.analysis.id])
+        self.assertQueriesDoNotGrow(url, lambda: [self.add_collection(number) for number in range(5)])
+
+    def test_gene_collection_list_has_no_repeated_queries(self):
+        url = reverse("bulk_rna:gene_collection_list")
+        for number in range(3):
+            self.add_collection(number)
+        self.client.get(url)
+        with assert_max_queries(settings.QUERY_BUDGETS["bulk_rna:gene_collection_list"], allow_duplicates=False):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+
+
+class DatasetVersionTests(TestCase):
+    path = "/data/dataset.tsv"
+
+    def add_analysis(self):
+        return AnalysisOutput.objects.create(metadata={}, file_path=self.path, product="io", conditions="D0")
+
+    def test_first_version_is_recorded_without_a_bump(self):
+        analysis = self.add_analysis()
+        self.assertEqual(record_dataset_version(self.path, "v1"), 0)
+        self.assertEqual(record_dataset_version(self.path, "v1"), 0)
+        analysis.refresh_from_db()
+        self.assertEqual((analysis.file_version, analysis.file_generation), ("v1", 0))
+
+    def test_changed_version_bumps_every_analysis_of_the_file(self):
+        first = self.add_analysis()
+        record_dataset_version(self.path, "v1")
+        second = self.add_analysis()
+        self.assertEqual(record_dataset_version(self.path, "v2"), 1)
+        for analysis in (first, second):
+            analysis.refresh_from_db()
+            self.assertEqual((analysis.file_version, analysis.file_generation), ("v2", 1))
+
+    def test_new_analysis_of_a_known_file_takes_its_generation(self):
+        self.add_analysis()
+        record_dataset_version(self.path, "v1")
+        record_dataset_version(self.path, "v2")
+        analysis = self.add_analysis()
+        self.assertEqual(record_dataset_version(self.path, "v2"), 1)
+        analysis.refresh_from_db()
+        self.assertEqual((analysis.file_version, analysis.file_generation), ("v2", 1))
+
+
+class DatasetCacheTests(DatasetFileMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.genes = cls.create_genes()
+
+    def replace_dataset(self):
+        with open(self.dataset_path, "a") as handle:
+            handle.write("\t".join(["ENSG99999999999_EXTRA", "1.0", "1.0", "1.0", "1.0"]) + "\n")
+
+    def test_artifacts_stay_with_the_version_they_were_computed_from(self):
+        datasets = DatasetCache(max_bytes=10**9, revalidate_seconds=0)
+
+        def count_genes(matrix):
+            # Another request loads a new version of the file meanwhile
+            self.replace_dataset()
+            datasets.get(self.dataset_path)
+            return len(matrix)
+
+        self.assertEqual(datasets.artifact(self.dataset_path, "genes", count_genes), 20)
+        self.assertEqual(datasets.artifact(self.dataset_path, "genes", len), 21)
+
+    def test_exports_of_a_file_replaced_in_place_are_revalidated(self):
+        first = get_shared_matrix(self.dataset_path, generation=7)
+        # A worker without the dataset, after the file changed without a generation bump
+        dataset_cache.clear()
+        self.replace_dataset()
+        self.assertEqual(get_shared_matrix(self.dataset_path, generation=7).values_path, first.values_path)
+        with mock.patch.object(dataset_cache, "revalidate_seconds", 0):
+            second = get_shared_matrix(self.dataset_path, generation=7)
+        self.assertNotEqual(second.values_path, first.values_path)
+        self.assertEqual(len(second.open()), 21)
+
+
+class PrepareDatasetsTests(DatasetFileMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.genes = cls.create_genes()
+        cls.analysis = AnalysisOutput.objects.create(
+            metadata={}, file_path=cls.dataset_path, product="ioA", conditions="D0,D3"
+        )
+
+    def test_exports_and_statistics_are_built_without_keeping_the_matrix(self):
+        [result] = prepare_datasets([self.analysis, self.analysis])
+        self.assertEqual(result["status"], "prepared")
+        self.assertGreater(result["bytes"], 0)
+        self.assertTrue(DatasetStatistics.objects.filter(file_path=self.dataset_path).exists())
+        self.assertFalse(dataset_cache.contains(self.dataset_path))
+        self.assertTrue(os.path.exists(get_shared_matrix(self.dataset_path).values_path))
+
+
+class DatasetStatisticsViewTests(QueryBudgetTestMixin, DatasetFileMixin, TransactionTestCase):
+    # The statistics are stored from a pool thread, which a TestCase's transaction would block
+
+    def setUp(self):
+        self.genes = self.create_genes()
+        super().setUp()
+        self.analysis = AnalysisOutput.objects.create(
+            metadata={}, file_path=self.dataset_path, product="ioA", conditions="D0,D3"
+        )
+        free_access = GeneCollection.objects.create(
+            collection_name="Free access", description="", private_collection=False, customer_visible=False
+        )
+        free_access.included_genes.set(self.genes[:10])
+        self.users = {}
+        for name, max_genes in (("Free", 5), ("Researcher", 100000)):
+            tier = Tier.objects.create(name=name, max_genes=max_genes)
+            self.users[name] = User.objects.create_user(name.lower(), password="password")
+            UserTier.objects.create(user=self.users[name], tier=tier)
+
+    def top_variable_genes(self, tier):
+        self.client.force_login(self.users[tier])
+        response = self.client.get(
+            reverse("bulk_rna:dataset_statistics_view", args=[self.analysis.id]), {"top": 20}
+        )
+        self.assertEqual(response.status_code, 200)
+        # The first request computes and stores the statistics
+        self.assertWithinQueryBudget(response)
+        return response.json()["top_variable_genes"]
+
+    def test_researchers_get_the_statistics_of_every_gene(self):
+        genes = self.top_variable_genes("Researcher")
+        self.assertGreater(len(genes), 10)
+        self.assertEqual([gene["rank"] for gene in genes], list(range(1, len(genes) + 1)))
+        self.assertIn("variance", genes[0])
+
+    def test_tiers_with_a_quota_only_get_names_and_ranks(self):
+        free_genes = {gene.df_string for gene in self.genes[:10]}
+        genes = self.top_variable_genes("Free")
+        self.assertTrue(genes)
+        for gene in genes:
+            self.assertEqual(set(gene), {"gene", "rank"})
+            self.assertIn(gene["gene"], free_genes)
+
+
+class PcaTests(DatasetFileMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.genes = cls.create_genes()
+
+    def test_pca_is_kept_in_the_result_cache(self):
+        version = dataset_version(self.dataset_path)
+        first = get_pca(self.dataset_path, n_components=2, version=version)
+        dataset_cache.clear()
+        os.remove(self.dataset_path)
+        pca_result, conditions = get_pca(self.dataset_path, n_components=2, version=version)
+        self.assertEqual(conditions, first[1])
+        self.assertTrue((pca_result == first[0]).all())
+
+    def test_stored_variance_of_another_version_is_ignored(self):
+        matrix = get_expression_matrix(self.dataset_path)
+        pca_result, conditions = compute_pca(matrix, n_components=2, log_variance=np.ones(3))
+        self.assertEqual(pca_result.shape, (4, 2))
+
+
+class DifferentialExpressionTests(TestCase):
+    def test_genes_without_variance_are_reported_untested(self):
+        import pandas as pd
+
+        matrix = pd.DataFrame(
+            {
+                "A_R1": [5.0, 10.0, 0.0, 3.0, 7.0],
+                "A_R2": [5.0, 11.0, 0.0, 3.0, 8.0],
+                "A_R3": [5.0, 12.0, 0.0, 3.0, 6.0],
+                "B_R1": [5.0, 100.0, 0.0, 9.0, 7.5],
+                "B_R2": [5.0, 110.0, 0.0, 9.0, 6.5],
+                "B_R3": [5.0, 120.0, 0.0, 9.0, 7.0],
+            },
+            index=["constant", "up", "unexpressed", "constant_shift", "unchanged"],
+        )
+        result = differential_expression(matrix, ["A_R1", "A_R2", "A_R3"], ["B_R1", "B_R2", "B_R3"])
+
+        self.assertEqual(list(result.index), ["up", "unchanged", "constant", "unexpressed", "constant_shift"])
+        self.assertFalse(result[["p_value", "p_adjusted"]].isna().any().any())
+        untested = result.loc[["constant", "unexpressed", "constant_shift"]]
+        self.assertTrue(untested["t"].isna().all())
+        self.assertTrue((untested[["p_value", "p_adjusted"]] == 1.0).all().all())
+        # Corrected over the two tested genes only
+        tested = result.loc[["up", "unchanged"]]
+        self.assertLess(tested.loc["up", "p_adjusted"], 0.05)
+        self.assertAlmostEqual(tested.loc["up", "p_adjusted"], min(tested.loc["up", "p_value"] * 2, 1.0))
+
+
+class PcaViewTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.analysis = AnalysisOutput.objects.create(
+            metadata={}, file_path="/data/dataset.tsv", product="ioA", conditions="D0,D3"
+        )
+        cls.user = User.objects.create_user("researcher", password="password")
+        UserTier.objects.create(user=cls.user, tier=Tier.objects.create(name="Researcher", max_genes=100000))
+
+    def test_top_below_the_number_of_components_is_refused(self):
+        self.client.force_login(self.user)
+        for top in ("-5", "0", "2"):
+            response = self.client.get(reverse("bulk_rna:pca_view", args=[self.analysis.id]), {"top": top})
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.context["error"], "The PCA needs at least 3 variable genes")
+
+
+class UsageRecorderTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.genes = Gene.objects.bulk_create([Gene(ensembl_id=f"ENSG{i:011d}", gene_name=f"GENE{i}") for i in range(10)])
+        cls.tier = Tier.objects.create(name="Free", max_genes=5)
+        cls.user = User.objects.create_user("user", password="password")
+
+    def setUp(self):
+        self.user_request = UserGeneRequest.objects.create(user=self.user)
+
+    def recorder(self):
+        # A worker: flushed by the tests only
+        recorder = UsageRecorder(flush_size=1000, flush_interval=3600, reservation_ttl=600)
+        recorder.background_flush = False
+        return recorder
+
+    def reserve(self, recorder, genes, tier=None):
+        user_request = UserGeneRequest.objects.get(pk=self.user_request.pk)
+        return [len(result) for result in recorder.reserve(user_request, tier or self.tier, genes)]
+
+    def assertUsage(self, gene_count, reserved):
+        self.user_request.refresh_from_db()
+        self.assertEqual(self.user_request.gene_count, gene_count)
+        self.assertEqual(self.user_request.accesses.count(), gene_count)
+        self.assertEqual(UsageReservation.objects.filter(user_request=self.user_request).count(), reserved)
+
+    def test_reserve_then_flush_commits_the_genes(self):
+        recorder = self.recorder()
+        user_request = UserGeneRequest.objects.get(pk=self.user_request.pk)
+        added, skipped, over_quota = recorder.reserve(user_request, self.tier, self.genes[:3])
+        self.assertEqual((len(added), len(skipped), len(over_quota)), (3, 0, 0))
+        self.assertEqual(user_request.quota_used, 3)
+        self.assertUsage(0, 3)
+        self.assertEqual(recorder.flush(), 3)
+        self.assertUsage(3, 0)
+        # Served again: not charged
+        self.assertEqual(self.reserve(recorder, self.genes[:3]), [0, 3, 0])
+        recorder.flush()
+        self.assertUsage(3, 0)
+
+    def test_genes_over_the_quota_are_refused(self):
+        recorder = self.recorder()
+        self.assertEqual(self.reserve(recorder, self.genes[:3]), [3, 0, 0])
+        self.assertEqual(self.reserve(recorder, self.genes[3:7]), [2, 0, 2])
+        recorder.flush()
+        self.assertEqual(self.reserve(recorder, self.genes[7:]), [0, 0, 3])
+        self.assertUsage(5, 0)
+
+    def test_a_gene_is_reserved_once(self):
+        first, second = self.recorder(), self.recorder()
+        self.assertEqual(self.reserve(first, self.genes[:2]), [2, 0, 0])
+        self.assertEqual(self.reserve(first, self.genes[:2]), [0, 2, 0])
+        # Another worker serves them without charging them again
+        self.assertEqual(self.reserve(second, self.genes[:4]), [2, 2, 0])
+        self.assertUsage(0, 4)
+        second.flush()
+        first.flush()
+        self.assertUsage(4, 0)
+
+    def test_reservations_expire_one_by_one(self):
+        dead, live = self.recorder(), self.recorder()
+        self.assertEqual(self.reserve(dead, self.genes[:4]), [4, 0, 0])
+        # The worker died before flushing; the user keeps making requests on another one
+        UsageReservation.objects.update(reserved_at=timezone.now() - timedelta(seconds=601))
+        self.assertEqual(self.reserve(live, self.genes[4:6]), [2, 0, 0])
+        self.assertEqual(self.reserve(live, self.genes[6:9]), [3, 0, 0])
+        live.flush()
+        self.assertUsage(5, 0)
+
+    def test_windowed_quota_charges_old_genes_again(self):
+        tier = Tier.objects.create(name="Windowed", max_genes=2, quota_window_days=30)
+        recorder = self.recorder()
+        self.assertEqual(self.reserve(recorder, self.genes[:2], tier), [2, 0, 0])
+        recorder.flush()
+        self.assertEqual(self.reserve(recorder, self.genes[2:3], tier), [0, 0, 1])
+        UserGeneAccess.objects.filter(gene=self.genes[0]).update(last_requested_at=timezone.now() - timedelta(days=31))
+        self.assertEqual(self.reserve(recorder, self.genes[:1], tier), [1, 0, 0])
+        recorder.flush()
+        self.user_request.refresh_from_db()
+        self.assertEqual(self.user_request.genes_used(tier), 2)
+        self.assertUsage(2, 0)
+
+
+class FreeTierViewMixin(DatasetFileMixin):
+    """A dataset of the test's genes and a Free tier user, whose tier gives access to the first 10."""
+
+    def setUp(self):
+        self.genes = self.create_genes()
+        super().setUp()
+        self.analysis = AnalysisOutput.objects.create(
+            metadata={}, file_path=self.dataset_path, product="ioA", conditions="D0,D3"
+        )
+        free_access = GeneCollection.objects.create(
+            collection_name="Free access", description="", private_collection=False, customer_visible=False
+        )
+        free_access.included_genes.set(self.genes[:10])
+        self.tier = Tier.objects.create(name="Free", max_genes=5)
+        self.user = User.objects.create_user("free", password="password")
+        UserTier.objects.create(user=self.user, tier=self.tier)
+        self.client.force_login(self.user)
+
+    def tearDown(self):
+        # Written by the background flush otherwise, possibly after the test database is gone
+        recorder.flush()
+        super().tearDown()
+
+
+class UsageViewTests(FreeTierViewMixin, TransactionTestCase):
+    # Explore loads the dataset, whose version is recorded from a pool thread
+
+    def explore(self, genes):
+        response = self.client.post(
+            reverse("bulk_rna:explore_analysis", args=[self.analysis.id]),
+            {
+                "selection_type": "individual",
+                "genes": [gene.df_string for gene in genes],
+                "conditions": ["ioA_D0", "ioA_D3"],
+                "display_field": "gene_name",
+            },
+        )
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def list_usage(self):
+        response = self.client.get(reverse("bulk_rna:bulk_rna_analysis_list"))
+        return response.context["user_request"].quota_used, response.context["usage_percentage"]
+
+    def test_the_page_shows_the_usage_after_serving(self):
+        response = self.explore(self.genes[:3])
+        self.assertEqual(response.context["user_request"].quota_used, 3)
+        self.assertEqual(response.context["usage_percentage"], 60)
+        # Unflushed genes are reserved, and count on the other pages too
+        self.assertEqual(self.list_usage(), (3, 60))
+
+    def test_served_genes_are_recorded_in_the_ledger(self):
+        self.explore(self.genes[:3])
+        self.explore(self.genes[2:4])
+        recorder.flush()
+        user_request = UserGeneRequest.objects.get(user=self.user)
+        self.assertEqual(user_request.gene_count, 4)
+        self.assertEqual(
+            set(user_request.accesses.values_list("gene_id", flat=True)), {gene.id for gene in self.genes[:4]}
+        )
+        self.assertFalse(UsageReservation.objects.exists())
+        self.assertEqual(self.list_usage(), (4, 80))
+
+    def test_usage_outside_the_quota_window_is_not_counted(self):
+        self.tier.quota_window_days = 30
+        self.tier.save()
+        self.assertEqual(self.list_usage(), (0, 0))
+        self.explore(self.genes[:4])
+        recorder.flush()
+        UserGeneAccess.objects.filter(gene__in=self.genes[:3]).update(
+            last_requested_at=timezone.now() - timedelta(days=31)
+        )
+        self.assertEqual(self.list_usage(), (1, 20))
+        # The old genes are charged again
+        response = self.explore(self.genes[:3])
+        self.assertEqual(response.context["user_request"].quota_used, 4)
+
+
+class DownloadCsvTests(FreeTierViewMixin, TransactionTestCase):
+    def download(self, genes):
+        response = self.client.post(
+            reverse("bulk_rna:download_csv", args=[self.analysis.id]),
+            {"genes": ",".join(gene.df_string for gene in genes), "conditions": "ioA_D0,ioA_D3"},
+        )
+        self.assertEqual(response.status_code, 200)
+        return list(csv.reader(response.content.decode().splitlines()))
+
+    def test_only_genes_of_the_tier_within_the_quota_are_downloaded(self):
+        rows = self.download([self.genes[0], self.genes[12], *self.genes[1:6]])
+        self.assertEqual(rows[0], ["Gene", "ioA_D0", "ioA_D3"])
+        self.assertEqual([row[0] for row in rows[1:]], [gene.df_string for gene in self.genes[:5]])
+        # Replicate means: 1 and 2 at D0, 3 + n and 4 + 2n at D3 for the n-th gene
+        self.assertEqual([float(value) for value in rows[2][1:]], [1.5, 5.0])
+        recorder.flush()
+        self.assertEqual(UserGeneRequest.objects.get(user=self.user).gene_count, 5)
+
+
+@override_settings(BULK_RNA_HEATMAP_TILE_THRESHOLD=3, BULK_RNA_HEATMAP_TILE_ROWS=2, BULK_RNA_HEATMAP_OVERVIEW_ROWS=2)
+class TiledHeatmapTests(FreeTierViewMixin, TransactionTestCase):
+    def explore(self, genes):
+        response = self.client.post(
+            reverse("bulk_rna:explore_analysis", args=[self.analysis.id]),
+            {
+                "selection_type": "individual",
+                "genes": [gene.df_string for gene in genes],
+                "conditions": ["ioA_D0", "ioA_D3"],
+                "display_field": "gene_name",
+            },
+        )
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_tiles_serve_the_genes_of_the_tier_shown_by_the_page(self):
+        response = self.explore([*self.genes[:4], self.genes[12]])
+        self.assertEqual(response.context["plot_type"], "tiled_heatmap")
+        payload = response.context["plot_payload"]
+        self.assertEqual(payload["genes"], ["GENE0", "GENE1", "GENE2", "GENE3"])
+        n_conditions = len(payload["conditions"])
+        self.assertEqual(payload["overview_starts"], [0, 2])
+        self.assertEqual(unpack(payload["overview"]).shape, (2, n_conditions))
+        self.assertEqual(unpack(payload["values"]).shape, (2, n_conditions))
+
+        response = self.client.get(payload["tile_url"], {"tile": 0})
+        self.assertEqual(response.status_code, 200)
+        np.testing.assert_array_equal(unpack(response.json()["values"]), unpack(payload["values"]))
+        response = self.client.get(payload["tile_url"], {"tile": 1})
+        self.assertEqual(response.status_code, 200)
+        tile = response.json()
+        self.assertEqual((tile["start"], tile["stop"]), (2, 4))
+        self.assertEqual(unpack(tile["values"]).shape, (2, n_conditions))
+
+        self.assertEqual(self.client.get(payload["tile_url"], {"tile": 2}).status_code, 404)
+        self.assertEqual(self.client.get(payload["tile_url"], {"tile": "first"}).status_code, 404)
+
+    def test_tiles_are_only_served_to_the_user_who_plotted_them(self):
+        tile_url = self.explore(self.genes[:4]).context["plot_payload"]["tile_url"]
+        other = User.objects.create_user("other", password="password")
+        UserTier.objects.create(user=other, tier=self.tier)
+        self.client.force_login(other)
+        self.assertEqual(self.client.get(tile_url, {"tile": 0}).status_code, 404)
+
+    def test_small_selections_are_not_tiled(self):
+        response = self.explore(self.genes[:3])
+        self.assertEqual(response.context["plot_type"], "heatmap")
+        self.assertEqual(unpack(response.context["plot_payload"]["values"]).shape[0], 3)
+
+
+class BoxPlotSummariesTests(FreeTierViewMixin, TransactionTestCase):
+    def summaries(self, genes, **data):
+        return self.client.post(
+            reverse("bulk_rna:box_plot_summaries", args=[self.analysis.id]),
+            {"genes": [gene.df_string for gene in genes], "display_field": "gene_name", **data},
+        )
+
+    def test_summaries_of_the_genes_of_the_tier(self):
+        response = self.summaries([self.genes[1], self.genes[12], self.genes[2]], points="1")
+        self.assertEqual(response.status_code, 200)
+        result = response.json()
+        self.assertEqual(result["genes"], ["GENE1", "GENE2"])
+        self.assertEqual(result["non_accessible_genes"], [str(self.genes[12])])
+        self.assertEqual(result["samples"], ["ioA_D0_R1", "ioA_D0_R2", "ioA_D3_R1", "ioA_D3_R2"])
+        self.assertEqual(result["groups"], ["ioA_D0", "ioA_D3"])
+        self.assertEqual(result["sizes"], [2, 2])
+        # Not normalised for the Free tier: 1 and 2 at D0, 3 + n and 4 + 2n at D3 for the n-th gene
+        np.testing.assert_allclose(unpack(result["stats"]["median"]), [[1.5, 5.0], [1.5, 6.5]])
+        np.testing.assert_allclose(unpack(result["stats"]["max"]), [[2.0, 6.0], [2.0, 8.0]])
+        self.assertEqual(unpack(result["points"]).shape, (2, 4))
+        recorder.flush()
+        self.assertEqual(UserGeneRequest.objects.get(user=self.user).gene_count, 2)
+
+    def test_unknown_conditions_are_refused(self):
+        response = self.summaries(self.genes[:2], conditions=["ioA_D9_R1"])
+        self.assertEqual(response.status_code, 400)
+
+
+class CoexpressionViewTests(FreeTierViewMixin, TransactionTestCase):
+    def search(self, gene, **params):
+        return self.client.get(reverse("bulk_rna:coexpression", args=[self.analysis.id]), {"gene": gene.df_string, **params})
+
+    def test_only_genes_of_the_tier_are_returned(self):
+        allowed = {gene.df_string for gene in self.genes[:10]}
+        for params in ({}, {"method": "spearman"}, {"probes": "2"}):
+            with self.subTest(**params):
+                response = self.search(self.genes[1], k=30, **params)
+                self.assertEqual(response.status_code, 200)
+                result = response.json()
+                self.assertEqual(result["approximate"], "probes" in params)
+                self.assertTrue(result["genes"])
+                self.assertLessEqual(set(result["genes"]), allowed - {self.genes[1].df_string})
+                self.assertEqual(len(result["correlations"]), len(result["genes"]))
+                self.assertEqual(result["correlations"], sorted(result["correlations"], reverse=True))
+
+    def test_genes_outside_the_tier_cannot_be_queried(self):
+        self.assertEqual(self.search(self.genes[12]).status_code, 403)
+
+    def test_approximate_search_is_only_for_pearson(self):
+        self.assertEqual(self.search(self.genes[1], method="spearman", probes="1").status_code, 400)
+
+
+class GeneSetScoresViewTests(FreeTierViewMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.markers = GeneCollection.objects.create(
+            collection_name="Markers", description="", private_collection=False, customer_visible=True
+        )
+        self.markers.included_genes.set([self.genes[0], self.genes[1], self.genes[12]])
+        self.markers.linked_analyses.add(self.analysis)
+        hidden = GeneCollection.objects.create(collection_name="Someone else's", description="")
+        hidden.included_genes.set(self.genes[:3])
+        hidden.linked_analyses.add(self.analysis)
+
+    def scores(self, **params):
+        response = self.client.get(reverse("bulk_rna:gene_set_scores_view", args=[self.analysis.id]), params)
+        self.assertEqual(response.status_code, 200)
+        return response.context["plot_payload"]
+
+    def test_collections_only_count_the_genes_of_the_tier(self):
+        for method in GENE_SET_METHODS:
+            with self.subTest(method=method):
+                payload = self.scores(method=method)
+                self.assertEqual(payload["collections"], ["Markers"])
+                self.assertEqual(payload["sizes"], [2])
+                self.assertEqual(payload["samples"], ["ioA_D0_R1", "ioA_D0_R2", "ioA_D3_R1", "ioA_D3_R2"])
+                self.assertEqual(unpack(payload["values"]).shape, (1, 4))
+
+    def test_researchers_get_every_gene(self):
+        UserTier.objects.filter(user=self.user).update(tier=Tier.objects.create(name="Researcher", max_genes=100))
+        self.assertEqual(self.scores(collection=self.markers.id)["sizes"], [3])
+
+
+class GeneSetScoresTests(TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.tsv_df = pd.DataFrame(
+            rng.lognormal(size=(50, 6)),
+            index=[f"gene{i}" for i in range(50)],
+            columns=[f"ioA_D{day}_R{replicate}" for day in (0, 3, 7) for replicate in (1, 2)],
+        )
+        # With a gene listed twice, one missing from the matrix, and a set without any gene in it
+        self.gene_sets = [
+            ["gene1", "gene7", "gene7", "gene30"],
+            ["gene2", "missing"],
+            [f"gene{i}" for i in range(0, 50, 3)],
+            ["missing"],
+        ]
+
+    def dense_scores(self, values, method):
+        scores = []
+        for genes in self.gene_sets:
+            present = [gene for gene in dict.fromkeys(genes) if gene in values.index]
+            score = values.loc[present].mean() if present else pd.Series(np.nan, index=values.columns)
+            if method == "rank" and present:
+                size, n_genes = len(present), len(values)
+                lowest, highest = (size + 1) / 2, (2 * n_genes - size + 1) / 2
+                score = (score - lowest) / (highest - lowest)
+            scores.append(score.to_numpy())
+        return np.array(scores)
+
+    def test_scores_match_a_dense_computation(self):
+        dense_values = {
+            "mean_z": transform_tpm_data(self.tsv_df, center=True, scale=True),
+            "rank": self.tsv_df.rank(axis=0),
+        }
+        for method in GENE_SET_METHODS:
+            with self.subTest(method=method):
+                result = gene_set_scores(self.tsv_df, self.gene_sets, method)
+                self.assertEqual(result["samples"], list(self.tsv_df.columns))
+                self.assertEqual(result["sizes"], [3, 1, 17, 0])
+                np.testing.assert_allclose(
+                    unpack(result["scores"]), self.dense_scores(dense_values[method], method), rtol=1e-5, atol=1e-6
+                )
+
+    def test_unknown_methods_are_refused(self):
+        with self.assertRaises(ValueError):
+            gene_set_scores(self.tsv_df, self.gene_sets, "median")
+
+
+class SimilarityIndexTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        # Standardised profiles of 100 groups of 20 co-expressed genes
+        rng = np.random.default_rng(1)
+        profiles = np.repeat(rng.standard_normal((100, 24)), 20, axis=0) + 0.8 * rng.standard_normal((2000, 24))
+        profiles -= profiles.mean(axis=1, keepdims=True)
+        cls.profiles = (profiles / np.linalg.norm(profiles, axis=1, keepdims=True)).astype(np.float32)
+        cls.index = SimilarityIndex.build(cls.profiles, tables=16, bits=index_bits(len(profiles), 16))
+
+    def recall(self, probes, k=10):
+        """Mean share of each query's k most correlated genes among its candidates."""
+        recalls = []
+        candidate_counts = []
+        for row in range(0, len(self.profiles), 37):
+            scores = self.profiles @ self.profiles[row]
+            scores[row] = -np.inf
+            nearest = np.argsort(-scores)[:k]
+            candidates = self.index.candidates(self.profiles[row], probes)
+            recalls.append(np.isin(nearest, candidates).mean())
+            candidate_counts.append(len(candidates))
+        return np.mean(recalls), np.mean(candidate_counts)
+
+    def test_recall_grows_with_probes(self):
+        recall, candidates = self.recall(probes=0)
+        self.assertGreater(recall, 0.75)
+        self.assertLess(candidates, len(self.profiles) / 4)
+        probed_recall, probed_candidates = self.recall(probes=2)
+        self.assertGreater(probed_recall, 0.95)
+        self.assertGreater(probed_candidates, candidates)
+
+    def test_candidates_are_sorted_rows(self):
+        candidates = self.index.candidates(self.profiles[0], probes=1)
+        np.testing.assert_array_equal(candidates, np.unique(candidates))
+        self.assertIn(0, candidates)
+
+    def test_saved_index_finds_the_same_candidates(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "index.npz")
+            self.index.save(path)
+            loaded = SimilarityIndex.load(path)
+        self.assertEqual(loaded.bits, self.index.bits)
+        np.testing.assert_array_equal(loaded.candidates(self.profiles[5], 2), self.index.candidates(self.profiles[5], 2))
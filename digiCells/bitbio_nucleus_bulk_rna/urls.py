@@ -7,6 +7,12 @@ urlpatterns = [
     path('', views.bulk_rna_analysis_list, name='bulk_rna_analysis_list'),
     path('explore/<int:analysis_id>/', views.explore_analysis, name='explore_analysis'),
     path('pca/<int:analysis_id>/', views.pca_view, name='pca_view'),
+    path('differential-expression/<int:analysis_id>/', views.differential_expression_view, name='differential_expression_view'),
+    path('box-summaries/<int:analysis_id>/', views.box_plot_summaries, name='box_plot_summaries'),
+    path('coexpression/<int:analysis_id>/', views.coexpression, name='coexpression'),
+    path('gene-set-scores/<int:analysis_id>/', views.gene_set_scores_view, name='gene_set_scores_view'),
+    path('dataset-statistics/<int:analysis_id>/', views.dataset_statistics_view, name='dataset_statistics_view'),
+    path('heatmap-tiles/<int:analysis_id>/<slug:heatmap_id>/', views.heatmap_tile, name='heatmap_tile'),
     path('load-genes-from-gtf/', views.load_genes_from_gtf, name='load_genes_from_gtf'),
     path("gene-autocomplete/", views.gene_autocomplete, name="gene_autocomplete"),
     path('gene-collections/<int:analysis_id>/', views.gene_collection_list, name='gene_collection_list'),
@@ -0,0 +1,242 @@
+"""
+Write-behind recording of the genes served to users.
+
+Plotting requests no longer write the UserGeneAccess ledger themselves. Instead each
+worker keeps a buffer of (user request, gene) events and flushes it in one batched
+transaction once it reaches BULK_RNA_USAGE_FLUSH_SIZE events or every
+BULK_RNA_USAGE_FLUSH_INTERVAL seconds, whichever comes first.
+
+Quota enforcement uses a reserved/committed model:
+
+- committed usage is UserGeneRequest.gene_count (or the windowed ledger count),
+- reserved usage is the UsageReservation rows of the user, one per gene handed out but not yet
+  flushed. A request reserves its new genes in one transaction holding the row lock of the
+  user's UserGeneRequest, against the committed usage read under the same lock, so concurrent
+  requests and workers can never hand out more than the tier allows. A flush takes the same
+  locks, commits ledger rows and deletes their reservations in one transaction.
+
+A gene is only charged once: if it is already in the ledger (served inside the quota window, for
+windowed tiers), reserved by any worker or pending in this one, it is served without touching
+the quota; the worker that flushes it first commits it. Each reservation expires on its own
+after BULK_RNA_USAGE_RESERVATION_TTL: an older one was left by a worker that died before
+flushing, it no longer counts and the next flush deletes it.
+"""
+
+import atexit
+import logging
+import threading
+import time
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, connections, transaction
+from django.db.models import Count, F, Q
+from django.utils import timezone
+
+from .models import UsageReservation, UserGeneAccess, UserGeneRequest
+
+logger = logging.getLogger(__name__)
+
+
+class UsageRecorder:
+    """
+    Per-process buffer of gene access events, flushed to the ledger in batches.
+    """
+
+    def __init__(self, flush_size, flush_interval, reservation_ttl, write_behind=True):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.reservation_ttl = reservation_ttl
+        self.write_behind = write_behind
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        # (user_request_id, gene_id) -> last_requested_at
+        self._pending = {}
+        self._flusher = None
+        # When False, only size-triggered and explicit flush() calls write to the ledger
+        self.background_flush = True
+
+    def reserve(self, user_request, tier, genes):
+        """
+        Decide which genes can be served under the user's quota and queue them for recording.
+        Sets ``user_request.quota_used`` to the user's usage including this request's genes,
+        when it had to be read.
+
+        Args:
+            user_request (UserGeneRequest): The user's ledger header.
+            tier (Tier): The user's tier, providing max_genes and the optional quota window.
+            genes (list of Gene): Genes the user is allowed to see by tier.
+
+        Returns:
+            tuple: (added_genes, skipped_genes, over_quota_genes)
+                - added_genes: Genes newly charged against the quota.
+                - skipped_genes: Genes already in the ledger (inside the quota window, if any) or
+                  already reserved.
+                - over_quota_genes: Genes refused because the quota is used up.
+        """
+        genes_by_id = {gene.id: gene for gene in genes}
+        if not genes_by_id:
+            return [], [], []
+
+        with self._lock:
+            pending_ids = {gene_id for gene_id in genes_by_id if (user_request.id, gene_id) in self._pending}
+        # With a windowed quota, genes last served before the window are charged again like new ones
+        committed = UserGeneAccess.objects.filter(user_request=user_request, gene_id__in=genes_by_id.keys() - pending_ids)
+        window_start = tier.quota_window_start()
+        if window_start is not None:
+            committed = committed.filter(last_requested_at__gte=window_start)
+        known_ids = pending_ids | set(committed.values_list("gene_id", flat=True))
+
+        new_genes = [gene for gene_id, gene in genes_by_id.items() if gene_id not in known_ids]
+        added_ids, reserved_ids = self._reserve(user_request, tier, new_genes) if new_genes else (set(), set())
+        known_ids |= reserved_ids
+        added_genes = [gene for gene in new_genes if gene.id in added_ids]
+        skipped_genes = [gene for gene_id, gene in genes_by_id.items() if gene_id in known_ids]
+        over_quota_genes = [gene for gene in new_genes if gene.id not in added_ids | reserved_ids]
+
+        self._enqueue(user_request.id, [gene.id for gene in added_genes + skipped_genes])
+        return added_genes, skipped_genes, over_quota_genes
+
+    def _reserve(self, user_request, tier, genes):
+        """
+        Reserves as many of `genes` as the user's quota allows.
+
+        Returns:
+            tuple: (IDs of the genes reserved, IDs of those another request had reserved already)
+        """
+        with transaction.atomic():
+            locked = UserGeneRequest.objects.select_for_update().get(pk=user_request.pk)
+            reserved_ids = set(
+                UsageReservation.objects.filter(user_request=locked, reserved_at__gte=self._expiry()).values_list(
+                    "gene_id", flat=True
+                )
+            )
+            wanted = [gene.id for gene in genes if gene.id not in reserved_ids]
+            used = locked.genes_used(tier) + len(reserved_ids)
+            granted = wanted[: max(tier.max_genes - used, 0)]
+            if granted:
+                # Replaces expired reservations of the same genes
+                UsageReservation.objects.filter(user_request=locked, gene_id__in=granted).delete()
+                UsageReservation.objects.bulk_create(
+                    [UsageReservation(user_request=locked, gene_id=gene_id) for gene_id in granted]
+                )
+        user_request.quota_used = used + len(granted)
+        return set(granted), reserved_ids & {gene.id for gene in genes}
+
+    def _expiry(self):
+        """Reservations made before this time were left by a worker that died before flushing."""
+        return timezone.now() - timedelta(seconds=self.reservation_ttl)
+
+    def reserved_count(self):
+        """Expression counting a UserGeneRequest's live reservations, for annotate()."""
+        return Count("reservations", filter=Q(reservations__reserved_at__gte=self._expiry()))
+
+    def flush(self):
+        """
+        Write all buffered events to the ledger and release their reservations, in one transaction.
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return 0
+
+            by_request = defaultdict(dict)
+            for (user_request_id, gene_id), requested_at in pending.items():
+                by_request[user_request_id][gene_id] = requested_at
+
+            try:
+                inserted = self._write(by_request)
+            except Exception:
+                logger.exception("Failed to flush %d gene access events, re-queueing", len(pending))
+                with self._lock:
+                    for key, requested_at in pending.items():
+                        self._pending.setdefault(key, requested_at)
+                return 0
+            return inserted
+
+    def _write(self, by_request):
+        inserted = 0
+        with transaction.atomic():
+            # The row locks reserve() takes, in a fixed order so that concurrent flushes take them alike
+            list(UserGeneRequest.objects.select_for_update().filter(pk__in=by_request).order_by("pk").values_list("pk"))
+            for user_request_id, events in sorted(by_request.items()):
+                existing_ids = set(
+                    UserGeneAccess.objects.filter(user_request_id=user_request_id, gene_id__in=events).values_list(
+                        "gene_id", flat=True
+                    )
+                )
+                new_rows = [
+                    UserGeneAccess(
+                        user_request_id=user_request_id,
+                        gene_id=gene_id,
+                        first_requested_at=requested_at,
+                        last_requested_at=requested_at,
+                    )
+                    for gene_id, requested_at in events.items()
+                    if gene_id not in existing_ids
+                ]
+                if existing_ids:
+                    latest = max(events[gene_id] for gene_id in existing_ids)
+                    UserGeneAccess.objects.filter(user_request_id=user_request_id, gene_id__in=existing_ids).update(
+                        last_requested_at=latest
+                    )
+                if new_rows:
+                    UserGeneAccess.objects.bulk_create(new_rows, ignore_conflicts=True)
+                    UserGeneRequest.objects.filter(pk=user_request_id).update(gene_count=F("gene_count") + len(new_rows))
+                    inserted += len(new_rows)
+                # Committed now, whichever worker reserved them
+                UsageReservation.objects.filter(user_request_id=user_request_id, gene_id__in=events).delete()
+            UsageReservation.objects.filter(reserved_at__lt=self._expiry()).delete()
+        return inserted
+
+    def _enqueue(self, user_request_id, gene_ids):
+        if not gene_ids:
+            return
+        now = timezone.now()
+        with self._lock:
+            for gene_id in gene_ids:
+                self._pending[(user_request_id, gene_id)] = now
+            pending_size = len(self._pending)
+
+        if not self.write_behind or pending_size >= self.flush_size:
+            self.flush()
+        else:
+            self._ensure_flusher()
+
+    def _ensure_flusher(self):
+        # Started lazily so that each forked gunicorn worker gets its own thread
+        if self._flusher is not None and self._flusher.is_alive():
+            return
+        with self._lock:
+            if self._flusher is not None and self._flusher.is_alive():
+                return
+            self._flusher = threading.Thread(target=self._run_flusher, name="bulk-rna-usage-flusher", daemon=True)
+            self._flusher.start()
+
+    def _run_flusher(self):
+        while True:
+            time.sleep(self.flush_interval)
+            if self.background_flush:
+                # Outside any request: the thread manages its own connection like a request would
+                close_old_connections()
+                try:
+                    self.flush()
+                finally:
+                    connections.close_all()
+
+    def flush_at_exit(self):
+        try:
+            self.flush()
+        finally:
+            connections.close_all()
+
+
+recorder = UsageRecorder(
+    flush_size=settings.BULK_RNA_USAGE_FLUSH_SIZE,
+    flush_interval=settings.BULK_RNA_USAGE_FLUSH_INTERVAL,
+    reservation_ttl=settings.BULK_RNA_USAGE_RESERVATION_TTL,
+    write_behind=settings.BULK_RNA_USAGE_WRITE_BEHIND,
+)
+atexit.register(recorder.flush_at_exit)
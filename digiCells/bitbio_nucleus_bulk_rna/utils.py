@@ -1,5 +1,10 @@
+import logging
+from collections import defaultdict
+
 from .models import Gene, UserGeneRequest, UserTier, Tier
-from django.db import transaction
+from .usage import recorder
+
+logger = logging.getLogger(__name__)
 
 
 def convert_id_list_to_obj(gene_id_list):
@@ -10,7 +15,7 @@ def convert_id_list_to_obj(gene_id_list):
     (e.g., "ENSG00000141510_TP53"). The function splits each identifier to extract the
     `gene_name` and `ensembl_id`, then attempts to retrieve the corresponding `Gene` object
     from the database. If a matching `Gene` object is found, it is added to the result list.
-    If no matching object is found or multiple objects are found, an error message is printed.
+    If no matching object is found a warning is logged; if multiple objects match, an exception is raised.
 
     Parameters:
         gene_id_list (list of str): A list of gene identifiers, each formatted as "ensembl_id_gene_name".
@@ -20,8 +25,8 @@ def convert_id_list_to_obj(gene_id_list):
                       Only genes that match uniquely in the database are included.
 
     Exceptions:
-        - Prints "No gene found with the specified criteria." if no `Gene` object matches a given identifier.
-        - Prints "Multiple genes found with the specified criteria." if more than one `Gene` object matches a given identifier.
+        - Logs "No gene found with the specified criteria." if no `Gene` object matches a given identifier.
+        - Raises "Multiple genes found with the specified criteria." if more than one `Gene` object matches a given identifier.
 
     Example:
         gene_id_list = ["ENSG00000141510_TP53", "ENSG00000012048_BRCA1"]
@@ -29,29 +34,31 @@ def convert_id_list_to_obj(gene_id_list):
         # selected_genes will be a list of `Gene` objects corresponding to TP53 and BRCA1.
     """
 
+    parsed_ids = [a_gene.split("_", 1) for a_gene in gene_id_list]
+
+    # Fetch every candidate in one query instead of one (or more) per identifier
+    genes_by_name = defaultdict(list)
+    for a_gene_object in Gene.objects.filter(gene_name__in={gene_name for _, gene_name in parsed_ids}):
+        genes_by_name[a_gene_object.gene_name].append(a_gene_object)
+
     selected_gene_objects = []
-    for a_gene in gene_id_list:
-        ensembl_id, gene_name = a_gene.split("_", 1)
-        print(ensembl_id, gene_name)
-        try:
-            selected_gene_objects.append(Gene.objects.get(gene_name=gene_name))
-        except Gene.DoesNotExist:
-            print("No gene found with the specified criteria.")
-        except Gene.MultipleObjectsReturned:
-
-            check_list = []
-
-            for a_gene_object in Gene.objects.filter(gene_name=gene_name):
-                print(a_gene_object.df_string.split("_")[0], ensembl_id)
-                if a_gene_object.df_string.split("_")[0] == ensembl_id:
-                    check_list.append(a_gene_object)
+    for ensembl_id, gene_name in parsed_ids:
+        matches = genes_by_name.get(gene_name, [])
+        if not matches:
+            logger.warning("No gene found with the specified criteria: %s", gene_name)
+        elif len(matches) == 1:
+            selected_gene_objects.append(matches[0])
+        else:
+            check_list = [
+                a_gene_object for a_gene_object in matches if a_gene_object.get_base_ensembl_id() == ensembl_id
+            ]
 
             if len(check_list) > 1:
-                print("Multiple genes found with the specified criteria.")
-                print(Gene.objects.filter(gene_name=gene_name))
                 raise Exception("Multiple genes found with the specified criteria.")
-            else:
+            elif check_list:
                 selected_gene_objects.append(check_list[0])
+            else:
+                logger.warning("No gene found with the specified criteria: %s", gene_name)
 
     return selected_gene_objects
 
@@ -85,8 +92,27 @@ def find_genes_in_collection(user_genes, gene_collection):
     return found_genes, not_found_genes
 
 
-def record_user_gene_request(accessed_user_genes):
-    pass
+def expand_conditions(selected_conditions_raw, conditions_with_replicates):
+    """
+    Expands conditions given without a replicate ("ioA_D0") into every replicate of the
+    dataset ("ioA_D0_R1", "ioA_D0_R2", ...). Conditions with a replicate are kept as they are.
+
+    Args:
+        selected_conditions_raw (list of str): Conditions as selected by the user.
+        conditions_with_replicates (list of str): Sample names of the dataset.
+
+    Returns:
+        list of str: Sample names.
+    """
+    selected_conditions = []
+    for a_raw_condition in selected_conditions_raw:
+        if len(a_raw_condition.split("_")) == 3:
+            selected_conditions.append(a_raw_condition)
+        else:
+            for a_replicate_condition in conditions_with_replicates:
+                if a_replicate_condition.split("_")[:-1] == a_raw_condition.split("_"):
+                    selected_conditions.append(a_replicate_condition)
+    return selected_conditions
 
 
 def center_data(df):
@@ -131,46 +157,25 @@ def transform_tpm_data(df, center=False, scale=False, replace_nan=True):
 
 
 
-def update_user_gene_request(user, new_genes):
+def update_user_gene_request(user_request, tier, new_genes):
     """
-    Updates the UserGeneRequest for a given user with new genes.
+    Charges the genes a user is about to be served against their quota.
+
+    The ledger write itself is buffered by the usage recorder and flushed in batches, so the
+    plotting request only reads the ledger for the genes passed in and reserves the new ones.
 
     Args:
-        user (User): The user whose gene request will be updated.
-        new_genes (list): A list of Gene objects to add to the user's request.
+        user_request (UserGeneRequest): The user's gene request (ledger header).
+        tier (Tier): The user's tier.
+        new_genes (list): A list of Gene objects the user is allowed to see by tier.
 
     Returns:
-        tuple: (added_genes, skipped_genes)
-            - added_genes: A list of Gene objects that were successfully added.
+        tuple: (added_genes, skipped_genes, over_quota_genes)
+            - added_genes: A list of Gene objects that were newly added to the request.
             - skipped_genes: A list of Gene objects that were already in the request.
+            - over_quota_genes: A list of Gene objects refused because the quota is used up.
     """
-    try:
-        # Retrieve or create the UserGeneRequest object
-        user_request, created = UserGeneRequest.objects.get_or_create(user=user)
-
-        # Get the set of genes already in the request
-        existing_genes = set(user_request.genes.all())
-
-        # Separate new genes into those to add and those to skip
-        added_genes = []
-        skipped_genes = []
-
-        for gene in new_genes:
-            if gene not in existing_genes:
-                added_genes.append(gene)
-            else:
-                skipped_genes.append(gene)
-
-        # Add the new genes to the UserGeneRequest
-        with transaction.atomic():  # Ensure atomicity
-            user_request.genes.add(*added_genes)
-
-        return added_genes, skipped_genes
-
-    except Exception as e:
-        # Handle exceptions and optionally log the error
-        print(f"Error updating user gene request: {e}")
-        return [], []
+    return recorder.reserve(user_request, tier, new_genes)
 
 
 def get_or_create_user_tier_and_request(user):
@@ -178,6 +183,10 @@ def get_or_create_user_tier_and_request(user):
     Ensure the user has a UserTier and UserGeneRequest object.
     Automatically assign the 'Free' tier if the user has no tier.
 
+    Usage is read from the denormalised UserGeneRequest.gene_count (or an indexed count for
+    windowed tiers) plus the genes reserved but not yet flushed by the usage recorder, so this
+    costs two queries for an existing user regardless of history.
+
     Args:
         user (User): The user object.
 
@@ -186,20 +195,23 @@ def get_or_create_user_tier_and_request(user):
     """
     try:
         # Get the user's tier and gene request
-        user_tier = UserTier.objects.get(user=user)
+        user_tier = UserTier.objects.select_related("tier").get(user=user)
     except UserTier.DoesNotExist:
         # Assign the user to the default 'Free' tier if they don't have one
         free_tier, _ = Tier.objects.get_or_create(name="Free", defaults={"max_genes": 100})
         user_tier = UserTier.objects.create(user=user, tier=free_tier)
 
-    try:
-        # Get the user's gene request object
-        user_request = UserGeneRequest.objects.get(user=user)
-    except UserGeneRequest.DoesNotExist:
-        # Create a new UserGeneRequest for the user if it doesn't exist
-        user_request = UserGeneRequest.objects.create(user=user)
+    # Get or create the user's gene request object, with its live reservations
+    user_request, _ = UserGeneRequest.objects.annotate(reserved=recorder.reserved_count()).get_or_create(user=user)
+
+    user_request.quota_used = user_request.genes_used(user_tier.tier) + getattr(user_request, "reserved", 0)
 
-    # Calculate usage percentage
-    usage_percentage = (user_request.genes.count() / user_tier.tier.max_genes) * 100
+    return user_tier, user_request, quota_percentage(user_tier, user_request)
 
-    return user_tier, user_request, usage_percentage
\ No newline at end of file
+
+def quota_percentage(user_tier, user_request):
+    """
+    Share of the tier's quota used, from ``user_request.quota_used``: as read by
+    get_or_create_user_tier_and_request(), or after serving as updated by the usage recorder.
+    """
+    return (user_request.quota_used / user_tier.tier.max_genes) * 100
@@ -1,45 +1,75 @@
-from django.shortcuts import render, get_object_or_404, redirect
+from django.shortcuts import render, get_object_or_404, aget_object_or_404, redirect
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import Group
 from django.contrib import messages
 from django.http import JsonResponse, HttpResponse
-from django.views.decorators.http import require_GET
-from django.db.models import Q
+from django.views.decorators.http import require_GET, require_POST
+from django.db.models import Prefetch, Q
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.urls import reverse
 
+import asyncio
 import os
 import gzip
 import csv
+import logging
 from itertools import groupby
 
 
+from asgiref.sync import sync_to_async
 from django_tables2 import RequestConfig
 
 from .models import AnalysisOutput, Gene, GeneCollection, UserTier, UserGeneRequest
 from .tables import BulkRNATable, GeneCollectionTable, GeneTable
 from .forms import GeneCollectionForm
+from .analytics import (
+    box_plot_data,
+    box_summaries,
+    condition_group,
+    condition_means,
+    differential_expression,
+    encode_labels,
+    gene_set_scores,
+    GENE_SET_METHODS,
+    get_coexpression,
+    get_pca,
+    heatmap_data,
+    heatmap_overview,
+    subset_pca,
+)
+from .compute import cached_result, run_analysis, run_cached_analysis
+from .dataset_statistics import (
+    ensure_dataset_statistics,
+    highly_variable_genes,
+    stored_statistics,
+    unpack_statistics,
+)
+from .datasets import get_dataset_columns, get_s3_client
+from .heatmaps import load_heatmap, overview_bins, save_heatmap, tile_bounds
+from .payloads import pack_values
+from .similarity import get_similar_genes
+from digiCells_core.admission import DeadlineExceeded, check_deadline
+from digiCells_core.executors import run_io
+from digiCells_core.metrics import time_s3
+from digiCells_core.tracing import span
 from .utils import (
     convert_id_list_to_obj,
+    expand_conditions,
     find_genes_in_collection,
-    transform_tpm_data,
     update_user_gene_request,
     get_or_create_user_tier_and_request,
+    quota_percentage,
 )
 
 from collections import defaultdict
 
-import pandas as pd
-import numpy as np
-from sklearn.preprocessing import StandardScaler
-from sklearn.decomposition import PCA
-from sklearn.preprocessing import LabelEncoder
-
-import boto3
-from io import StringIO
+logger = logging.getLogger(__name__)
 
 
 @login_required
 @require_GET
-def gene_autocomplete(request):
+async def gene_autocomplete(request):
     query = request.GET.get("term", "").strip()
     if query:
         # Search by gene name or ensembl_id (case-insensitive)
@@ -53,7 +83,7 @@ def gene_autocomplete(request):
                 "id": gene.ensembl_id.split(".")[0] + "_" + gene.gene_name,
                 "label": f"{gene.ensembl_id} - {gene.gene_name}",
             }
-            for gene in genes[:10]
+            async for gene in genes[:10]
         ]
     else:
         results = []
@@ -61,6 +91,87 @@ def gene_autocomplete(request):
     return JsonResponse(results, safe=False)
 
 
+async def _serve_genes(user_tier, user_request, genes):
+    """
+    Splits `genes` into those the user's tier gives access to and the others, and charges the
+    former against the user's quota. Genes that would take the user over their quota are moved
+    to the others.
+
+    Returns:
+        tuple: (accessible_genes, non_accessible_genes)
+    """
+    with span("tier_filter", tier=user_tier.tier.name) as attributes:
+        if user_tier.tier.name == "Free":
+            free_gene_collection = await GeneCollection.objects.aget(
+                collection_name="Free access"
+            )
+            accessible_genes, non_accessible_genes = await sync_to_async(
+                find_genes_in_collection
+            )(genes, free_gene_collection)
+        elif user_tier.tier.name == "Premium":
+            premium_access_collection = await GeneCollection.objects.aget(
+                collection_name="Premium access"
+            )
+            accessible_genes, non_accessible_genes = await sync_to_async(
+                find_genes_in_collection
+            )(genes, premium_access_collection)
+        elif user_tier.tier.name == "Researcher":
+            accessible_genes = genes
+            non_accessible_genes = []
+        else:
+            accessible_genes = []
+            non_accessible_genes = genes
+
+        # Record what genes the user has requested successfully, and add to count.
+        # Genes that would take the user over their quota are not served.
+        added_genes, skipped_genes, over_quota_genes = await sync_to_async(
+            update_user_gene_request
+        )(user_request, user_tier.tier, accessible_genes)
+        if over_quota_genes:
+            accessible_genes = [
+                gene for gene in accessible_genes if gene not in over_quota_genes
+            ]
+            non_accessible_genes = list(non_accessible_genes) + over_quota_genes
+
+        attributes.update(
+            accessible=len(accessible_genes),
+            restricted=len(non_accessible_genes),
+            added=len(added_genes),
+        )
+    return accessible_genes, non_accessible_genes
+
+
+async def _request_user(request):
+    """
+    The request's user, also set as request.user: the templates' context processors read that
+    one, which does not share auser()'s cache and would load the user again.
+    """
+    request.user = await request.auser()
+    return request.user
+
+
+async def _tier_gene_ids(user_tier):
+    """
+    The genes the user's tier gives access to, as in the expression matrix's index
+    ("<ensembl id>_<gene name>"), or None when it is every gene.
+    """
+    tier_collections = {"Free": "Free access", "Premium": "Premium access"}
+    if user_tier.tier.name == "Researcher":
+        return None
+    if user_tier.tier.name not in tier_collections:
+        return []
+    collection = await GeneCollection.objects.aget(collection_name=tier_collections[user_tier.tier.name])
+    return sorted([gene.df_string async for gene in collection.included_genes.only("ensembl_id", "gene_name")])
+
+
+def _visible_collections(analysis, user):
+    """The gene collections of the explore page: linked to the dataset, the user's own or shared."""
+    return GeneCollection.objects.filter(
+        (Q(linked_analyses=analysis) & Q(created_by=user))
+        | (Q(linked_analyses=analysis) & Q(private_collection=False) & Q(customer_visible=True))
+    ).distinct().order_by("collection_name", "id")
+
+
 @login_required
 def bulk_rna_analysis_list(request):
     # Filter for analysis outputs where the type is 'bulk_rna'
@@ -76,6 +187,9 @@ def bulk_rna_analysis_list(request):
         # If the user is in the Customer group, only show those visible in the commercial app
         analysis_outputs = analysis_outputs.filter(is_visible_in_commercial_app=True)
 
+    # Dataset summaries, where computed (see dataset_statistics.py)
+    statistics = stored_statistics(analysis_outputs)
+
     rows = []
 
     for analysis in analysis_outputs:
@@ -91,6 +205,7 @@ def bulk_rna_analysis_list(request):
                 "origin": analysis.origin,
                 "created_at": analysis.created_at,
                 "is_visible_in_commercial_app": analysis.is_visible_in_commercial_app,
+                "statistics": statistics.get(analysis.id),
             }
         )
 
@@ -108,10 +223,12 @@ def bulk_rna_analysis_list(request):
 
 
 @login_required
-def explore_analysis(request, analysis_id):
+async def explore_analysis(request, analysis_id):
     # Fetch the selected AnalysisOutput object
 
-    if request.user.groups.filter(name="Customer").exists():
+    user = await _request_user(request)
+
+    if await user.groups.filter(name="Customer").aexists():
         limit_gene_list = True
         limited_gene_list = []
 
@@ -119,7 +236,7 @@ def explore_analysis(request, analysis_id):
     selected_conditions = None
     selected_conditions_raw = None
     selected_conditions_for_plot = None
-    plot_data = None
+    plot_payload = None  # Plot data for the page's decoder, see payloads.py
     plot_type = None  # 'bar' for bar plot, 'heatmap' for heatmap
     display_field = None
     non_accessible_genes = None
@@ -127,47 +244,35 @@ def explore_analysis(request, analysis_id):
     bar_or_box_plot = "boxplot"
     group_by_condition = "day"
 
-    user = request.user
-
-    user_tier, user_request, usage_percentage = get_or_create_user_tier_and_request(
-        user
-    )
+    user_tier, user_request, usage_percentage = await sync_to_async(
+        get_or_create_user_tier_and_request
+    )(user)
 
     applied_normalisation = {}
 
     # Retrieve the analysis object
-    selected_dataset = get_object_or_404(AnalysisOutput, id=analysis_id)
+    selected_dataset = await aget_object_or_404(AnalysisOutput, id=analysis_id)
 
     # Retrieve all individual genes and gene sets (gene collections)
     gene_collections = GeneCollection.objects.filter(
-        (Q(linked_analyses=selected_dataset) & Q(created_by=request.user))
+        (Q(linked_analyses=selected_dataset) & Q(created_by=user))
         | (
             Q(linked_analyses=selected_dataset)
             & Q(private_collection=False)
             & Q(customer_visible=True)
         )
-    ).distinct()
+    ).distinct().select_related("created_by")
 
-    # Load the TSV file into a DataFrame for testing
+    # Only the conditions are needed here: read from the dataset's header, not the whole matrix
     path_to_tsv = selected_dataset.file_path
 
-    if path_to_tsv[:2].lower() == "s3":
-        # Read in from S3
-        s3 = boto3.client("s3")
-        bucket_name, key = path_to_tsv[5:].split("/", 1)  # Extract bucket name and key
-        response = s3.get_object(Bucket=bucket_name, Key=key)
-        file_content = response["Body"].read().decode("utf-8")
-        tsv_df = pd.read_csv(StringIO(file_content), sep="\t", index_col=0)
-
-    else:
-        # read from local file
-        tsv_df = pd.read_csv(path_to_tsv, sep="\t", index_col=0)
+    dataset_columns = await run_io(get_dataset_columns, path_to_tsv, selected_dataset.file_generation)
 
     if user_tier.tier.name == "Researcher":
-        conditions_with_replicates = list(tsv_df.columns)  # Conditions from TSV
-        display_conditions = list(tsv_df.columns)
+        conditions_with_replicates = list(dataset_columns)  # Conditions from TSV
+        display_conditions = list(dataset_columns)
     else:
-        conditions_with_replicates = list(tsv_df.columns)  # Conditions from TSV
+        conditions_with_replicates = list(dataset_columns)  # Conditions from TSV
         # These are the displayed conditions, with no replicate information
         display_conditions = []
         for a_condition in conditions_with_replicates:
@@ -186,78 +291,39 @@ def explore_analysis(request, analysis_id):
             selected_conditions_raw = display_conditions
 
         # This includes replicates
-        selected_conditions = []
-        for a_raw_condition in selected_conditions_raw:
-            if len(a_raw_condition.split("_")) == 3:
-                selected_conditions.append(a_raw_condition)
-            else:
-                for a_replicate_condition in conditions_with_replicates:
-                    if a_replicate_condition.split("_")[:-1] == a_raw_condition.split(
-                        "_"
-                    ):
-                        selected_conditions.append(a_replicate_condition)
+        selected_conditions = expand_conditions(selected_conditions_raw, conditions_with_replicates)
 
-        print("Selected conditions", selected_conditions)
+        logger.debug("Selected conditions %s", selected_conditions)
 
         display_field = request.POST.getlist("display_field")[0]
-        print("Plotting")
 
         # Dealing with if individual genes were selected or a gene collection
         if selection_type == "individual":
             # Individual gene selection
             selected_genes = request.POST.getlist("genes")
-            selected_gene_objects = convert_id_list_to_obj(selected_genes)
+            selected_gene_objects = await sync_to_async(convert_id_list_to_obj)(
+                selected_genes
+            )
 
         elif selection_type == "gene_set":
             # Gene set selection
-            print("Using gene collection")
             selected_collection_id = request.POST.get("gene_set")
-            selected_collection = get_object_or_404(
+            selected_collection = await aget_object_or_404(
                 GeneCollection, id=selected_collection_id
             )
-            selected_genes = [
-                gene.df_string for gene in selected_collection.included_genes.all()
+            selected_gene_objects = [
+                gene async for gene in selected_collection.included_genes.all()
             ]
 
-            selected_gene_objects = convert_id_list_to_obj(selected_genes)
-
-        print(selected_gene_objects)
-
         # Do some filtering based on the user tier
-        if user_tier.tier.name == "Free":
-            free_gene_collection = GeneCollection.objects.get(
-                collection_name="Free access"
-            )
-            accessible_genes, non_accessible_genes = find_genes_in_collection(
-                selected_gene_objects, free_gene_collection
-            )
-        elif user_tier.tier.name == "Premium":
-            premium_access_collection = GeneCollection.objects.get(
-                collection_name="Premium access"
-            )
-            accessible_genes, non_accessible_genes = find_genes_in_collection(
-                selected_gene_objects, premium_access_collection
-            )
-        elif user_tier.tier.name == "Researcher":
-            accessible_genes = selected_gene_objects
-            non_accessible_genes = []
-        else:
-            accessible_genes = []
-            non_accessible_genes = selected_gene_objects
-
-        print("Pass genes", accessible_genes)
-        print("Restricted genes", non_accessible_genes)
-
-        # Record what genes the user has requested successfully, and add to count
-        added_genes, skipped_genes = update_user_gene_request(user, accessible_genes)
-        print("Added genes", added_genes)
-        print("Skipped genes", skipped_genes)
+        accessible_genes, non_accessible_genes = await _serve_genes(
+            user_tier, user_request, selected_gene_objects
+        )
 
         # Determine plot type and data based on selected genes
         if accessible_genes and selected_conditions:
             if len(accessible_genes) == 1:
                 # -------------------------------------- Box plot --------------------------------------
-                print("Plotting", bar_or_box_plot)
                 selected_conditions_for_plot = selected_conditions
                 selected_conditions_for_plot.sort()
 
@@ -275,19 +341,22 @@ def explore_analysis(request, analysis_id):
                 else:
                     applied_normalisation = {"center": False, "scale": False}
 
-                processed_tsv_df = transform_tpm_data(
-                    tsv_df,
-                    center=applied_normalisation["center"],
-                    scale=applied_normalisation["scale"],
-                )
-
                 # Bar plot for one gene
-                plot_data = processed_tsv_df.loc[
-                    accessible_genes[0].df_string, selected_conditions_for_plot
-                ].to_dict()
+                plot_payload = {
+                    "samples": selected_conditions_for_plot,
+                    "values": await run_cached_analysis(
+                        box_plot_data,
+                        path_to_tsv,
+                        accessible_genes[0].df_string,
+                        selected_conditions_for_plot,
+                        applied_normalisation,
+                        scope=user_tier.tier.name,
+                        generation=selected_dataset.file_generation,
+                        version=selected_dataset.file_version,
+                    ),
+                }
                 plot_type = bar_or_box_plot
             else:
-                print("Plotting Heatmap")
                 # -------------------------------------- Heatmap for multiple genes -----------------------------------
                 selected_conditions_for_plot = selected_conditions
                 selected_conditions_for_plot.sort()
@@ -306,81 +375,553 @@ def explore_analysis(request, analysis_id):
                 else:
                     applied_normalisation = {"center": True, "scale": True}
 
-                processed_tsv_df = transform_tpm_data(
-                    tsv_df,
-                    center=applied_normalisation["center"],
-                    scale=applied_normalisation["scale"],
-                )
-
                 gene_df_ids = [gene.df_string for gene in accessible_genes]
-                print(processed_tsv_df)
-                plot_data = processed_tsv_df.loc[
-                    gene_df_ids, selected_conditions_for_plot
-                ].values.tolist()
-                print(plot_data)
-                plot_type = "heatmap"
-
-    # Render the template with gene, gene set, and condition options
-    return render(
+                plot_payload = {
+                    "genes": [
+                        gene.ensembl_id if display_field == "ensembl_id" else gene.gene_name
+                        for gene in accessible_genes
+                    ],
+                    "conditions": selected_conditions_for_plot,
+                }
+
+                heatmap_id = None
+                if len(gene_df_ids) > settings.BULK_RNA_HEATMAP_TILE_THRESHOLD:
+                    # Too many cells for the browser: an overview, and the genes a window at a time
+                    heatmap_id, heatmap = await save_heatmap(
+                        user,
+                        selected_dataset,
+                        gene_df_ids,
+                        selected_conditions_for_plot,
+                        applied_normalisation,
+                        scope=user_tier.tier.name,
+                    )
+
+                if heatmap_id is not None:
+                    start, stop = tile_bounds(heatmap, 0)
+                    overview, first_tile = await asyncio.gather(
+                        run_cached_analysis(
+                            heatmap_overview,
+                            path_to_tsv,
+                            gene_df_ids,
+                            selected_conditions_for_plot,
+                            applied_normalisation,
+                            settings.BULK_RNA_HEATMAP_OVERVIEW_ROWS,
+                            scope=user_tier.tier.name,
+                            generation=selected_dataset.file_generation,
+                            version=selected_dataset.file_version,
+                        ),
+                        run_cached_analysis(
+                            heatmap_data,
+                            path_to_tsv,
+                            gene_df_ids[start:stop],
+                            selected_conditions_for_plot,
+                            applied_normalisation,
+                            scope=user_tier.tier.name,
+                            generation=selected_dataset.file_generation,
+                            version=selected_dataset.file_version,
+                        ),
+                    )
+                    plot_payload.update(
+                        overview_starts=overview_bins(len(gene_df_ids), settings.BULK_RNA_HEATMAP_OVERVIEW_ROWS),
+                        overview=overview,
+                        tile_rows=heatmap["tile_rows"],
+                        tile_url=reverse("bulk_rna:heatmap_tile", args=[selected_dataset.id, heatmap_id]),
+                        values=first_tile,
+                    )
+                    plot_type = "tiled_heatmap"
+                else:
+                    if len(gene_df_ids) <= settings.BULK_RNA_BOX_SUMMARY_MAX_GENES:
+                        # What the page posts to compare the genes as box plots
+                        plot_payload["summaries"] = {
+                            "url": reverse("bulk_rna:box_plot_summaries", args=[selected_dataset.id]),
+                            "genes": gene_df_ids,
+                            "conditions": selected_conditions_for_plot,
+                            "normalisation": applied_normalisation,
+                            "display_field": display_field,
+                        }
+                    plot_payload["values"] = await run_cached_analysis(
+                        heatmap_data,
+                        path_to_tsv,
+                        gene_df_ids,
+                        selected_conditions_for_plot,
+                        applied_normalisation,
+                        scope=user_tier.tier.name,
+                        generation=selected_dataset.file_generation,
+                        version=selected_dataset.file_version,
+                    )
+                    plot_type = "heatmap"
+
+    # The usage shown includes the genes just served
+    usage_percentage = quota_percentage(user_tier, user_request)
+
+    # Render the template with gene, gene set, and condition options. Rendering can evaluate
+    # querysets (gene_collections), so it runs in a thread.
+    with span("render"):
+        response = await sync_to_async(render)(
+            request,
+            "explore_analysis.html",
+            {
+                "user_tier": user_tier,
+                "user_request": user_request,
+                "usage_percentage": usage_percentage,
+                "analysis": selected_dataset,
+                "gene_collections": gene_collections,
+                "conditions": display_conditions,
+                "selected_gene_objects": accessible_genes,
+                "selected_conditions": selected_conditions_for_plot,
+                "plot_payload": plot_payload,
+                "plot_type": plot_type,  # Pass the plot type to the template
+                "display_field": display_field,
+                "non_accessible_genes": non_accessible_genes,
+                "applied_normalisation": applied_normalisation,
+            },
+        )
+    return response
+
+
+@login_required
+@require_GET
+async def heatmap_tile(request, analysis_id, heatmap_id):
+    """
+    Full-resolution rows of a tiled heatmap shown by explore_analysis, see heatmaps.py.
+
+    The tile number is given by the "tile" query parameter. Returns the tile's first and last
+    (excluded) row, and its values packed by payloads.pack_values().
+    """
+    user = await _request_user(request)
+    heatmap = await load_heatmap(heatmap_id, user, analysis_id)
+    if heatmap is None:
+        return JsonResponse({"error": "This heatmap has expired, please plot it again"}, status=404)
+
+    analysis = await aget_object_or_404(AnalysisOutput, id=analysis_id)
+
+    try:
+        tile = int(request.GET.get("tile", ""))
+    except ValueError:
+        tile = -1
+    bounds = tile_bounds(heatmap, tile)
+    if bounds is None:
+        return JsonResponse({"error": "No such tile"}, status=404)
+    start, stop = bounds
+
+    try:
+        values = await run_cached_analysis(
+            heatmap_data,
+            analysis.file_path,
+            heatmap["gene_df_ids"][start:stop],
+            heatmap["conditions"],
+            heatmap["normalisation"],
+            scope=heatmap["scope"],
+            generation=analysis.file_generation,
+            version=analysis.file_version,
+        )
+    except KeyError:
+        # The dataset was replaced by one without some of the genes or conditions
+        return JsonResponse({"error": "The dataset has been updated, please plot it again"}, status=410)
+    return JsonResponse({"tile": tile, "start": start, "stop": stop, "values": values})
+
+
+@login_required
+@require_POST
+async def box_plot_summaries(request, analysis_id):
+    """
+    Box plot statistics of several genes per condition, to compare them side by side without
+    reloading the explore page. See analytics.box_summaries() for the statistics.
+
+    Takes the explore form's fields: genes (as "<ensembl id>_<gene name>"), conditions (all
+    when empty), display_field and, for researchers, norm_center and norm_scale; and points
+    to also get the value of every sample. Genes are charged against the quota as on the
+    explore page.
+    """
+    user = await _request_user(request)
+
+    user_tier, user_request, usage_percentage = await sync_to_async(
+        get_or_create_user_tier_and_request
+    )(user)
+
+    selected_dataset = await aget_object_or_404(AnalysisOutput, id=analysis_id)
+    path_to_tsv = selected_dataset.file_path
+
+    selected_genes = request.POST.getlist("genes")
+    if not selected_genes:
+        return JsonResponse({"error": "Select at least one gene"}, status=400)
+    if len(selected_genes) > settings.BULK_RNA_BOX_SUMMARY_MAX_GENES:
+        return JsonResponse(
+            {"error": f"At most {settings.BULK_RNA_BOX_SUMMARY_MAX_GENES} genes can be compared"}, status=400
+        )
+
+    conditions_with_replicates = list(
+        await run_io(get_dataset_columns, path_to_tsv, selected_dataset.file_generation)
+    )
+    selected_conditions = expand_conditions(request.POST.getlist("conditions"), conditions_with_replicates)
+    if not selected_conditions:
+        selected_conditions = conditions_with_replicates
+    unknown_conditions = set(selected_conditions) - set(conditions_with_replicates)
+    if unknown_conditions:
+        return JsonResponse({"error": f"Unknown conditions: {', '.join(sorted(unknown_conditions))}"}, status=400)
+    # Sorted by day, as on the explore page
+    selected_conditions = sorted(sorted(selected_conditions), key=lambda x: x.split("_")[1])
+
+    selected_gene_objects = await sync_to_async(convert_id_list_to_obj)(selected_genes)
+    accessible_genes, non_accessible_genes = await _serve_genes(
+        user_tier, user_request, selected_gene_objects
+    )
+
+    if user_tier.tier.name == "Researcher":
+        applied_normalisation = {
+            "center": request.POST.get("norm_center"),
+            "scale": request.POST.get("norm_scale"),
+        }
+    else:
+        applied_normalisation = {"center": False, "scale": False}
+    points = bool(request.POST.get("points"))
+
+    summaries = {}
+    if accessible_genes:
+        try:
+            summaries = await run_cached_analysis(
+                box_summaries,
+                path_to_tsv,
+                [gene.df_string for gene in accessible_genes],
+                selected_conditions,
+                applied_normalisation,
+                points,
+                scope=user_tier.tier.name,
+                generation=selected_dataset.file_generation,
+                version=selected_dataset.file_version,
+            )
+        except KeyError:
+            return JsonResponse({"error": "Some of the genes are not in this dataset"}, status=400)
+
+    display_field = request.POST.get("display_field")
+    return JsonResponse(
+        {
+            "genes": [
+                gene.ensembl_id if display_field == "ensembl_id" else gene.gene_name
+                for gene in accessible_genes
+            ],
+            "non_accessible_genes": [str(gene) for gene in non_accessible_genes],
+            "samples": selected_conditions,
+            **summaries,
+        }
+    )
+
+
+@login_required
+@require_GET
+async def coexpression(request, analysis_id):
+    """
+    The genes whose expression correlates best with a query gene across the samples of a
+    dataset. See analytics.top_correlated().
+
+    Takes gene (as "<ensembl id>_<gene name>"), method ("pearson" or "spearman") and k. With
+    probes, Pearson correlations are searched approximately through the dataset's similarity
+    index, looking at that many extra buckets per hash table (see similarity.py). The
+    query gene is charged against the quota as on the explore page; the genes returned are
+    limited to those the user's tier gives access to.
+    """
+    user = await _request_user(request)
+
+    user_tier, user_request, usage_percentage = await sync_to_async(
+        get_or_create_user_tier_and_request
+    )(user)
+
+    selected_dataset = await aget_object_or_404(AnalysisOutput, id=analysis_id)
+    path_to_tsv = selected_dataset.file_path
+
+    method = request.GET.get("method", "pearson")
+    if method not in ("pearson", "spearman"):
+        return JsonResponse({"error": "method must be pearson or spearman"}, status=400)
+    try:
+        k = int(request.GET.get("k", 20))
+    except ValueError:
+        return JsonResponse({"error": "k must be a number"}, status=400)
+    if not 1 <= k <= settings.BULK_RNA_COEXPRESSION_MAX_K:
+        return JsonResponse({"error": f"k must be between 1 and {settings.BULK_RNA_COEXPRESSION_MAX_K}"}, status=400)
+    probes = request.GET.get("probes")
+    if probes is not None:
+        if method != "pearson":
+            return JsonResponse({"error": "Approximate search is only available for pearson"}, status=400)
+        try:
+            probes = int(probes)
+        except ValueError:
+            return JsonResponse({"error": "probes must be a number"}, status=400)
+        if probes < 0:
+            return JsonResponse({"error": "probes cannot be negative"}, status=400)
+
+    query_genes = await sync_to_async(convert_id_list_to_obj)([request.GET.get("gene", "")])
+    if not query_genes:
+        return JsonResponse({"error": "Unknown gene"}, status=404)
+    accessible_genes, non_accessible_genes = await _serve_genes(user_tier, user_request, query_genes)
+    if not accessible_genes:
+        return JsonResponse({"error": f"Your tier does not give access to {query_genes[0]}"}, status=403)
+    gene_df_id = accessible_genes[0].df_string
+
+    allowed = await _tier_gene_ids(user_tier)
+    if probes is None:
+        search, args = get_coexpression, (gene_df_id, method, k, allowed)
+    else:
+        search, args = get_similar_genes, (gene_df_id, k, probes, allowed)
+    try:
+        result = await cached_result(
+            search,
+            path_to_tsv,
+            args,
+            lambda: run_io(search, path_to_tsv, *args, generation=selected_dataset.file_generation),
+            generation=selected_dataset.file_generation,
+            version=selected_dataset.file_version,
+        )
+    except KeyError:
+        return JsonResponse({"error": "This gene is not in this dataset"}, status=400)
+
+    return JsonResponse({"gene": gene_df_id, "method": method, "approximate": probes is not None, **result})
+
+
+@login_required
+@require_GET
+async def gene_set_scores_view(request, analysis_id):
+    """
+    Scores of gene collections in every sample of a dataset, as a heatmap. See
+    analytics.gene_set_scores() for the methods.
+
+    Takes collection, a list of collection IDs (every collection linked to the dataset the
+    user can see when empty), and method. Collections only count the genes the user's tier
+    gives access to.
+    """
+    user = await _request_user(request)
+
+    user_tier, user_request, usage_percentage = await sync_to_async(
+        get_or_create_user_tier_and_request
+    )(user)
+
+    analysis = await aget_object_or_404(AnalysisOutput, id=analysis_id)
+    path_to_tsv = analysis.file_path
+
+    method = request.GET.get("method", GENE_SET_METHODS[0])
+    if method not in GENE_SET_METHODS:
+        method = GENE_SET_METHODS[0]
+
+    visible_collections = _visible_collections(analysis, user)
+    selected_ids = request.GET.getlist("collection")
+    collections = visible_collections
+    if selected_ids:
+        try:
+            collections = visible_collections.filter(id__in=[int(selected_id) for selected_id in selected_ids])
+        except ValueError:
+            collections = visible_collections.none()
+
+    allowed = await _tier_gene_ids(user_tier)
+    allowed = set(allowed) if allowed is not None else None
+    names = []
+    gene_sets = []
+    async for collection in collections.prefetch_related(
+        Prefetch("included_genes", queryset=Gene.objects.only("ensembl_id", "gene_name").order_by("id"))
+    ):
+        names.append(collection.collection_name)
+        gene_sets.append(
+            [
+                gene.df_string
+                for gene in collection.included_genes.all()
+                if allowed is None or gene.df_string in allowed
+            ]
+        )
+
+    plot_payload = None
+    if gene_sets:
+        # The key covers the genes of each set: an edited collection is scored again
+        result = await run_cached_analysis(
+            gene_set_scores,
+            path_to_tsv,
+            gene_sets,
+            method,
+            generation=analysis.file_generation,
+            version=analysis.file_version,
+        )
+        plot_payload = {
+            "collections": names,
+            "sizes": result["sizes"],
+            "samples": result["samples"],
+            "values": result["scores"],
+        }
+
+    return await sync_to_async(render)(
         request,
-        "explore_analysis.html",
+        "gene_set_scores.html",
         {
-            "user_tier": user_tier,
-            "user_request": user_request,
-            "usage_percentage": usage_percentage,
-            "analysis": selected_dataset,
-            "gene_collections": gene_collections,
-            "conditions": display_conditions,
-            "selected_gene_objects": accessible_genes,
-            "selected_conditions": selected_conditions_for_plot,
-            "plot_data": plot_data,
-            "plot_type": plot_type,  # Pass the plot type to the template
-            "display_field": display_field,
-            "non_accessible_genes": non_accessible_genes,
-            "applied_normalisation": applied_normalisation,
+            "analysis": analysis,
+            "method": method,
+            "methods": GENE_SET_METHODS,
+            "collections": [collection async for collection in visible_collections.only("id", "collection_name")],
+            "selected_ids": selected_ids,
+            "plot_payload": plot_payload,
         },
     )
 
 
 @login_required
-def pca_view(request, analysis_id, plot_3d=True):
+@require_GET
+async def dataset_statistics_view(request, analysis_id):
+    """
+    Summary statistics of a dataset as JSON, see dataset_statistics.py: the QC of every sample
+    and the `top` most highly variable genes (50 by default), among those the user's tier
+    gives access to. Computed on the first request for a new version of the file.
 
-    print("Creating PCA")
+    Their expression statistics are for researchers, as the differential expression: other
+    tiers only get the genes and their rank, their values are charged to the quota through
+    the explore page.
+    """
+    user = await _request_user(request)
 
-    # Fetch the selected AnalysisOutput object
-    analysis = get_object_or_404(AnalysisOutput, id=analysis_id)
+    user_tier, user_request, usage_percentage = await sync_to_async(
+        get_or_create_user_tier_and_request
+    )(user)
 
-    # Load the TSV file into a DataFrame
-    path_to_tsv = analysis.file_path
+    analysis = await aget_object_or_404(AnalysisOutput, id=analysis_id)
+    try:
+        top = min(max(int(request.GET.get("top", 50)), 0), settings.BULK_RNA_STATISTICS_MAX_GENES)
+    except ValueError:
+        return JsonResponse({"error": "top must be a number"}, status=400)
+
+    stored = await run_io(ensure_dataset_statistics, analysis.file_path, analysis.file_generation)
+    statistics = await run_io(unpack_statistics, stored.data)
+
+    allowed = await _tier_gene_ids(user_tier)
+    allowed = set(allowed) if allowed is not None else None
+    top_variable_genes = []
+    for rank, row in enumerate(statistics["hvg_order"].tolist(), 1):
+        if len(top_variable_genes) >= top:
+            break
+        gene = str(statistics["genes"][row])
+        if allowed is None:
+            top_variable_genes.append(
+                {
+                    "gene": gene,
+                    "rank": rank,
+                    "mean": float(statistics["mean"][row]),
+                    "variance": float(statistics["variance"][row]),
+                    "dispersion": float(statistics["dispersion"][row]),
+                    "normalised_dispersion": float(statistics["normalised_dispersion"][row]),
+                }
+            )
+        elif gene in allowed:
+            top_variable_genes.append({"gene": gene, "rank": rank})
 
-    if path_to_tsv[:2].lower() == "s3":
-        # Read in from S3
-        s3 = boto3.client("s3")
-        bucket_name, key = path_to_tsv[5:].split("/", 1)  # Extract bucket name and key
-        response = s3.get_object(Bucket=bucket_name, Key=key)
-        file_content = response["Body"].read().decode("utf-8")
-        tsv_df = pd.read_csv(StringIO(file_content), sep="\t", index_col=0)
-    else:
-        # read from local file
-        tsv_df = pd.read_csv(path_to_tsv, sep="\t", index_col=0)
+    return JsonResponse(
+        {
+            "genes": stored.n_genes,
+            "detected_genes": stored.detected_genes,
+            "median_library_size": stored.median_library_size,
+            "samples": statistics["samples"].tolist(),
+            "library_size": statistics["library_size"].tolist(),
+            "detected": statistics["detected"].tolist(),
+            "correlation": pack_values(statistics["correlation"]),
+            "top_variable_genes": top_variable_genes,
+        }
+    )
 
-    import json
 
-    # Preprocessing: Log-transform and scale
-    log_tpm_df = np.log1p(tsv_df)
-    log_tpm_df = log_tpm_df.loc[
-        log_tpm_df.var(axis=1) > 0.1
-    ]  # Optional low-variance filtering
+async def _pca_subset(request, analysis, user, n_components):
+    """
+    The genes of the subset PCA asked for by pca_view's query string.
+
+    Returns:
+        tuple: (description, sorted genes as in the matrix's index), or (None, None) for a PCA
+            over every gene.
 
-    scaler = StandardScaler()
-    scaled_data = scaler.fit_transform(log_tpm_df.T)  # Transpose for PCA
+    Raises:
+        ValueError: The collection is not one the user can see, or top is not a number of
+            genes the PCA can use.
+    """
+    collection_id = request.GET.get("collection")
+    if collection_id:
+        try:
+            collection = await _visible_collections(analysis, user).aget(id=int(collection_id))
+        except (ValueError, GeneCollection.DoesNotExist):
+            raise ValueError("Unknown gene collection") from None
+        user_tier, user_request, usage_percentage = await sync_to_async(
+            get_or_create_user_tier_and_request
+        )(user)
+        allowed = await _tier_gene_ids(user_tier)
+        allowed = set(allowed) if allowed is not None else None
+        genes = [
+            gene.df_string
+            async for gene in collection.included_genes.only("ensembl_id", "gene_name")
+            if allowed is None or gene.df_string in allowed
+        ]
+        return collection.collection_name, sorted(genes)
 
-    # Perform PCA
-    if plot_3d:
-        pca = PCA(n_components=3)
-    else:
-        pca = PCA(n_components=2)
-    pca_result = pca.fit_transform(scaled_data)
+    top = request.GET.get("top")
+    if top:
+        try:
+            top = min(int(top), settings.BULK_RNA_PCA_MAX_TOP_GENES)
+        except ValueError:
+            raise ValueError("The number of variable genes must be a number") from None
+        if top < n_components:
+            raise ValueError(f"The PCA needs at least {n_components} variable genes")
+        genes = await run_io(highly_variable_genes, analysis.file_path, top, analysis.file_generation)
+        return f"the {top} most variable genes", sorted(genes)
+
+    return None, None
+
+
+@login_required
+async def pca_view(request, analysis_id, plot_3d=True):
+    """
+    PCA of the samples of a dataset, over every gene with enough variance by default.
+
+    Takes collection, a gene collection ID, to use the genes of the collection the user's tier
+    gives access to, or else top, to use that many of the most highly variable genes. Subset
+    PCAs are cached by dataset version and genes.
+    """
+
+    # Fetch the selected AnalysisOutput object
+    analysis = await aget_object_or_404(AnalysisOutput, id=analysis_id)
+
+    # Load the TSV file into a DataFrame
+    path_to_tsv = analysis.file_path
+    import json
+
+    n_components = 3 if plot_3d else 2
+    user = await _request_user(request)
+    context = {
+        "analysis": analysis,
+        "collections": [
+            collection async for collection in _visible_collections(analysis, user).only("id", "collection_name")
+        ],
+        "selected_collection": request.GET.get("collection", ""),
+        "top": request.GET.get("top", ""),
+        "subset": None,
+        "n_genes": None,
+        "error": None,
+    }
+    try:
+        context["subset"], gene_df_ids = await _pca_subset(request, analysis, user, n_components)
+        if gene_df_ids is None:
+            # The thread only waits while the compute pool does the work
+            pca_result, conditions = await run_io(
+                get_pca,
+                path_to_tsv,
+                n_components=n_components,
+                generation=analysis.file_generation,
+                version=analysis.file_version,
+            )
+        else:
+            # Only the subset's rows are read from the dataset's shared export
+            pca_result, conditions, context["n_genes"] = await run_cached_analysis(
+                subset_pca,
+                path_to_tsv,
+                gene_df_ids,
+                n_components,
+                generation=analysis.file_generation,
+                version=analysis.file_version,
+            )
+    except ValueError as e:
+        context["error"] = str(e)
+        template = "explore_analysis_pca_3d.html" if plot_3d else "explore_analysis_pca.html"
+        context.update(
+            grouped_pca_data=[], pc1_values="[]", pc2_values="[]", conditions="[]", group_numeric="[]", groups="[]"
+        )
+        return await sync_to_async(render)(request, template, context, status=400)
 
     # Prepare the PCA result as lists
     pc1_values = pca_result[:, 0].tolist()  # First principal component
@@ -388,15 +929,12 @@ def pca_view(request, analysis_id, plot_3d=True):
     if plot_3d:
         pc3_values = pca_result[:, 2].tolist()  # Third principal component
 
-    conditions = log_tpm_df.columns.tolist()  # Condition labels
-
     # Extract groups by splitting the condition names by underscore
     groups = [
         condition.split("_")[0] for condition in conditions
     ]  # Get the first part of the condition string
 
     if plot_3d:
-        print("plot_3d")
         # Group the PCA results by group
         grouped_pca_data = defaultdict(
             lambda: {"x": [], "y": [], "z": [], "labels": []}
@@ -422,44 +960,139 @@ def pca_view(request, analysis_id, plot_3d=True):
         ]
 
         # Pass the PCA data and groups to the template
-        return render(
+        return await sync_to_async(render)(
             request,
             "explore_analysis_pca_3d.html",
             {
-                "analysis": analysis,
+                **context,
                 "grouped_pca_data": grouped_pca_data_list,  # Pass the grouped PCA data to the template
             },
         )
 
     else:
-        # Convert groups to numeric labels for coloring
-        label_encoder = LabelEncoder()
-        group_numeric = label_encoder.fit_transform(
-            groups
-        )  # Convert group names to numeric labels
+        # Convert group names to numeric labels for coloring
+        group_numeric = encode_labels(groups)
 
         # Pass the PCA data, group labels, and groups to the template with JSON encoding
-        return render(
+        return await sync_to_async(render)(
             request,
             "explore_analysis_pca.html",
             {
-                "analysis": analysis,
+                **context,
                 "pc1_values": json.dumps(pc1_values),
                 "pc2_values": json.dumps(pc2_values),
                 "conditions": json.dumps(conditions),
-                "group_numeric": json.dumps(group_numeric.tolist()),
+                "group_numeric": json.dumps(group_numeric),
                 "groups": json.dumps(groups),
             },
         )
 
 
+@login_required
+@require_GET
+async def differential_expression_view(request, analysis_id):
+    """
+    Genes differentially expressed between two groups of conditions, for researchers: the top
+    genes by adjusted p-value as a table, or every gene as CSV with format=csv. See
+    analytics.differential_expression() for the test.
+
+    Takes group_a and group_b, each a list of conditions ("ioA_D0") or samples ("ioA_D0_R1"),
+    and top, the number of genes shown.
+    """
+    user = await _request_user(request)
+
+    user_tier, user_request, usage_percentage = await sync_to_async(
+        get_or_create_user_tier_and_request
+    )(user)
+    # Genome-wide results, not filtered by the gene collections of the other tiers
+    if user_tier.tier.name != "Researcher":
+        raise PermissionDenied
+
+    analysis = await aget_object_or_404(AnalysisOutput, id=analysis_id)
+    path_to_tsv = analysis.file_path
+
+    conditions_with_replicates = list(await run_io(get_dataset_columns, path_to_tsv, analysis.file_generation))
+    # Sorted by day, as on the explore page
+    condition_groups = sorted(
+        sorted({condition_group(condition) for condition in conditions_with_replicates}),
+        key=lambda x: x.split("_")[1],
+    )
+
+    group_a_raw = request.GET.getlist("group_a")
+    group_b_raw = request.GET.getlist("group_b")
+    try:
+        top = min(max(int(request.GET.get("top", 50)), 1), settings.BULK_RNA_DE_MAX_ROWS)
+    except ValueError:
+        top = 50
+
+    context = {
+        "analysis": analysis,
+        "condition_groups": condition_groups,
+        "group_a": group_a_raw,
+        "group_b": group_b_raw,
+        "top": top,
+        "results": None,
+        "error": None,
+    }
+    if not (group_a_raw or group_b_raw):
+        return await sync_to_async(render)(request, "differential_expression.html", context)
+
+    group_a = expand_conditions(group_a_raw, conditions_with_replicates)
+    group_b = expand_conditions(group_b_raw, conditions_with_replicates)
+    unknown_conditions = {
+        condition
+        for condition in group_a_raw + group_b_raw
+        if not set(expand_conditions([condition], conditions_with_replicates)) & set(conditions_with_replicates)
+    }
+    if unknown_conditions:
+        context["error"] = f"Unknown conditions: {', '.join(sorted(unknown_conditions))}"
+    elif set(group_a) & set(group_b):
+        context["error"] = "A sample cannot be in both groups"
+    elif len(set(group_a)) < 2 or len(set(group_b)) < 2:
+        context["error"] = "Each group needs at least two samples"
+    if context["error"]:
+        return await sync_to_async(render)(request, "differential_expression.html", context, status=400)
+
+    # Through the result cache, so paging through the table and exporting it compute it once
+    result = await run_cached_analysis(
+        differential_expression,
+        path_to_tsv,
+        sorted(set(group_a)),
+        sorted(set(group_b)),
+        generation=analysis.file_generation,
+        version=analysis.file_version,
+    )
+
+    if request.GET.get("format") == "csv":
+        response = HttpResponse(content_type="text/csv")
+        response["Content-Disposition"] = 'attachment; filename="differential_expression.csv"'
+        with span("serialise", rows=len(result)):
+            result.to_csv(response, index_label="Gene", float_format="%.6g")
+        return response
+
+    context["results"] = [
+        {"ensembl_id": gene.split("_", 1)[0], "gene_name": gene.split("_", 1)[-1], **row}
+        for gene, row in zip(result.index[:top], result.iloc[:top].to_dict("records"))
+    ]
+    context["tested_genes"] = int(result["t"].notna().sum())
+    export_query = request.GET.copy()
+    export_query["format"] = "csv"
+    context["export_query"] = export_query.urlencode()
+    return await sync_to_async(render)(request, "differential_expression.html", context)
+
+
 @login_required
 def gene_collection_list(request, analysis_id=0):
     # Get all GeneCollections and render them in the table
-    filtered_collection_objects = GeneCollection.objects.filter(
-        Q(created_by=request.user)
-        | (Q(private_collection=False) & Q(customer_visible=True))
-    ).distinct()
+    filtered_collection_objects = (
+        GeneCollection.objects.filter(
+            Q(created_by=request.user)
+            | (Q(private_collection=False) & Q(customer_visible=True))
+        )
+        .distinct()
+        .select_related("created_by")
+        .prefetch_related("linked_analyses")
+    )
 
     table = GeneCollectionTable(filtered_collection_objects, request=request)
 
@@ -531,10 +1164,8 @@ def edit_gene_collection(request, collection_id):
     )
 
     if request.method == "POST":
-        print("Saving gene collection")
         form = GeneCollectionForm(request.POST, instance=collection)
         if form.is_valid():
-            print("Form valid", collection_id)
             collection = form.save(commit=False)
             collection.save()
 
@@ -590,8 +1221,9 @@ def load_genes_from_gtf(request):
     if load_from_s3:
         # Load from AWS S3
         try:
-            s3 = boto3.client("s3")
-            s3.download_file(s3_bucket_name, s3_file_key, "temp_gtf_file.gtf.gz")
+            s3 = get_s3_client()
+            with time_s3("download_file"):
+                s3.download_file(s3_bucket_name, s3_file_key, "temp_gtf_file.gtf.gz")
             gtf_file_path = "temp_gtf_file.gtf.gz"
         except Exception as e:
             return JsonResponse(
@@ -640,6 +1272,8 @@ def load_genes_from_gtf(request):
 
                     # Ensure we have required fields before creating or updating
                     if gene_name and ensembl_id:
+                        # Stop cleanly if the request has run out of time, genes loaded so far are kept
+                        check_deadline()
                         # Use Django's get_or_create to avoid duplicate entries
                         gene, created = Gene.objects.update_or_create(
                             ensembl_id=ensembl_id,
@@ -659,6 +1293,9 @@ def load_genes_from_gtf(request):
         if load_from_s3 and os.path.exists("temp_gtf_file.gtf.gz"):
             os.remove("temp_gtf_file.gtf.gz")
 
+        if isinstance(e, DeadlineExceeded):
+            raise
+
         return JsonResponse(
             {"error": f"Failed to process GTF file: {str(e)}"}, status=500
         )
@@ -667,111 +1304,55 @@ def load_genes_from_gtf(request):
 
 
 @login_required
-def download_csv(request, analysis_id):
+async def download_csv(request, analysis_id):
     """
     Generates and downloads a CSV file containing the average gene expression values
     for the selected genes and conditions.
     """
     # Get selected genes and conditions from POST request
 
-    user = request.user
+    user = await _request_user(request)
 
-    user_tier, user_request, usage_percentage = get_or_create_user_tier_and_request(
-        user
-    )
+    user_tier, user_request, usage_percentage = await sync_to_async(
+        get_or_create_user_tier_and_request
+    )(user)
 
     applied_normalisation = {"center": False, "scale": False}
 
     selected_genes = request.POST.get("genes").split(",")
-    print(">>>>>>>", selected_genes)
-    print(user_tier)
 
     selected_conditions_raw = request.POST.getlist("conditions")[0].split(",")
-    print("selected_conditions_raw", selected_conditions_raw)
-    selected_conditions = []
 
-    selected_gene_objects = convert_id_list_to_obj(selected_genes)
-    print("selected_gene_objects", selected_gene_objects)
+    selected_gene_objects = await sync_to_async(convert_id_list_to_obj)(selected_genes)
 
-    selected_dataset = get_object_or_404(AnalysisOutput, id=analysis_id)
+    selected_dataset = await aget_object_or_404(AnalysisOutput, id=analysis_id)
 
-    # Do some filtering based on the user tier
-    if user_tier.tier.name == "Free":
-        print("Filtering by free genes")
-        free_gene_collection = GeneCollection.objects.get(collection_name="Free access")
-        accessible_genes, non_accessible_genes = find_genes_in_collection(
-            selected_gene_objects, free_gene_collection
-        )
-        print(accessible_genes, non_accessible_genes)
-    elif user_tier.tier.name == "Premium":
-        premium_access_collection = GeneCollection.objects.get(
-            collection_name="Premium access"
-        )
-        accessible_genes, non_accessible_genes = find_genes_in_collection(
-            selected_gene_objects, premium_access_collection
-        )
-    elif user_tier.tier.name == "Researcher":
-        accessible_genes = selected_gene_objects
-        non_accessible_genes = []
-    else:
-        accessible_genes = []
-        non_accessible_genes = selected_gene_objects
+    # Filtered by tier and charged against the quota, as on the explore page
+    accessible_genes, non_accessible_genes = await _serve_genes(user_tier, user_request, selected_gene_objects)
 
     # Load the gene expression data (replace with your actual data source)
     path_to_tsv = selected_dataset.file_path
 
-    if path_to_tsv[:2].lower() == "s3":
-        # Read in from S3
-        s3 = boto3.client("s3")
-        bucket_name, key = path_to_tsv[5:].split("/", 1)  # Extract bucket name and key
-        response = s3.get_object(Bucket=bucket_name, Key=key)
-        file_content = response["Body"].read().decode("utf-8")
-        tsv_df = pd.read_csv(StringIO(file_content), sep="\t", index_col=0)
-
-    else:
-        # read from local file
-        tsv_df = pd.read_csv(path_to_tsv, sep="\t", index_col=0)
-
-    # Apply normalisation
-    processed_tsv_df = transform_tpm_data(
-        tsv_df,
-        center=applied_normalisation["center"],
-        scale=applied_normalisation["scale"],
-    )
-
-    # Get replicates
-    conditions_with_replicates = list(tsv_df.columns)
-    for a_raw_condition in selected_conditions_raw:
-        if len(a_raw_condition.split("_")) == 3:
-            selected_conditions.append(a_raw_condition)
-        else:
-            for a_replicate_condition in conditions_with_replicates:
-                if a_replicate_condition.split("_")[:-1] == a_raw_condition.split("_"):
-                    selected_conditions.append(a_replicate_condition)
-
-    print("Conditions", selected_conditions)
-
-    # Filter data for selected genes and conditions
     gene_df_ids = [gene.df_string for gene in accessible_genes]
-    filtered_df = processed_tsv_df.loc[gene_df_ids, selected_conditions]
-
-    # Calculate the average expression values across replicates
-    # Assuming replicate names end with _R1, _R2, etc.
-    grouped_df = filtered_df.groupby(
-        by=[f"{col.split('_')[0]}_{col.split('_')[1]}" for col in filtered_df.columns],
-        # Group by condition and timepoint
-        axis=1,
-    ).mean()
+    grouped_df = await run_analysis(
+        condition_means,
+        path_to_tsv,
+        gene_df_ids,
+        selected_conditions_raw,
+        applied_normalisation,
+        generation=selected_dataset.file_generation,
+    )
 
     # Prepare response
     response = HttpResponse(content_type="text/csv")
     response["Content-Disposition"] = 'attachment; filename="gene_expression.csv"'
 
     # Write CSV
-    writer = csv.writer(response)
-    writer.writerow(["Gene"] + list(grouped_df.columns))  # Write header
-    for gene, row in grouped_df.iterrows():
-        writer.writerow([gene] + list(row))  # Write each row
+    with span("serialise", rows=len(grouped_df)):
+        writer = csv.writer(response)
+        writer.writerow(["Gene"] + list(grouped_df.columns))  # Write header
+        for gene, row in grouped_df.iterrows():
+            writer.writerow([gene] + list(row))  # Write each row
 
     return response
 
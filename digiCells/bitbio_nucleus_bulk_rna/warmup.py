@@ -0,0 +1,191 @@
+"""
+Preloading of datasets into the per-process dataset cache.
+
+When BULK_RNA_WARM_ON_BOOT is on, gunicorn warms the cache at boot (see gunicorn.conf.py):
+in each worker after it starts or, with GUNICORN_PRELOAD_APP, once in the master before the
+workers are forked. The first user after a deploy or a worker recycle then does not pay for the
+S3 download, parse and PCA.
+
+``manage.py warm_datasets`` cannot fill the workers' caches from its own short-lived process.
+It prepares what outlives it instead (prepare_datasets()): the spool copy and shared export of
+each dataset on the host, and its stored statistics, so that a worker's first load reads from
+disk and the compute pool maps the export at once.
+"""
+
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+
+from .analytics import get_pca
+from .dataset_statistics import ensure_dataset_statistics
+from .datasets import dataset_cache, dataset_use_counts, get_shared_matrix
+from .models import AnalysisOutput
+
+logger = logging.getLogger(__name__)
+
+
+def select_datasets(limit=None, analysis_ids=None):
+    """
+    Picks the datasets worth warming: datasets visible in the commercial app first, then by
+    recorded use, then the most recently updated.
+
+    Args:
+        limit (int): Maximum number of datasets, BULK_RNA_WARM_LIMIT by default.
+        analysis_ids (list of int): Warm exactly these analyses, in this order.
+
+    Returns:
+        list of AnalysisOutput
+    """
+    analyses = AnalysisOutput.objects.filter(analysis_type="bulk_rna").exclude(file_path__isnull=True).exclude(
+        file_path=""
+    )
+    if analysis_ids:
+        by_id = analyses.in_bulk(analysis_ids)
+        return [by_id[analysis_id] for analysis_id in analysis_ids if analysis_id in by_id]
+
+    analyses = list(analyses.order_by("-updated_at"))
+    uses = dataset_use_counts([analysis.file_path for analysis in analyses])
+    analyses.sort(key=lambda analysis: (not analysis.is_visible_in_commercial_app, -uses[analysis.file_path]))
+    return analyses[: settings.BULK_RNA_WARM_LIMIT if limit is None else limit]
+
+
+def warm_datasets(analyses, budget_bytes=None, with_pca=True, progress=None, in_process=False):
+    """
+    Loads each dataset into the dataset cache until the memory budget is used up, and puts its
+    PCA in the result cache.
+
+    Args:
+        analyses (list of AnalysisOutput): Datasets to warm, in priority order.
+        budget_bytes (int): Memory to spend, BULK_RNA_WARM_BUDGET_BYTES by default. Never more
+            than the cache itself can hold.
+        with_pca (bool): Also compute the 3D PCA shown by pca_view.
+        progress (callable): Called with one result dict per dataset.
+        in_process (bool): Compute the PCA in this process rather than in the compute pool,
+            e.g. in a gunicorn master about to fork: its pool's processes would not be inherited.
+
+    Returns:
+        list of dict: One result per dataset with analysis id, path, status
+            ("warmed", "cached", "skipped" or "failed"), seconds and bytes.
+    """
+    if budget_bytes is None:
+        budget_bytes = settings.BULK_RNA_WARM_BUDGET_BYTES
+    budget_bytes = min(budget_bytes, dataset_cache.max_bytes)
+
+    results = []
+    used = 0
+    for analysis in analyses:
+        path_to_tsv = analysis.file_path
+        result = {"analysis_id": analysis.id, "path": path_to_tsv, "seconds": 0.0, "bytes": 0}
+        if used >= budget_bytes:
+            result["status"] = "skipped"
+        else:
+            start = time.perf_counter()
+            was_cached = dataset_cache.contains(path_to_tsv)
+            try:
+                dataset_cache.get(path_to_tsv, analysis.file_generation)
+                if with_pca:
+                    get_pca(path_to_tsv, in_process=in_process, generation=analysis.file_generation)
+            except Exception as e:
+                logger.warning("Could not warm analysis %s (%s)", analysis.id, path_to_tsv, exc_info=True)
+                result.update(status="failed", error=str(e))
+            else:
+                result["status"] = "cached" if was_cached else "warmed"
+            result["seconds"] = time.perf_counter() - start
+            result["bytes"] = dataset_cache.entry_size(path_to_tsv)
+            used += result["bytes"]
+            if used > budget_bytes and result["status"] == "warmed":
+                # The last dataset does not fit: give the memory back rather than overrun the budget
+                dataset_cache.discard(path_to_tsv, reason="warm_budget")
+                used -= result["bytes"]
+                result["status"] = "skipped"
+        results.append(result)
+        if progress:
+            progress(result)
+    return results
+
+
+def prepare_datasets(analyses, progress=None):
+    """
+    Builds the on-disk exports and the stored statistics of each dataset: the spool copy of S3
+    datasets and the shared export the compute pool maps, on this host, and the statistics in
+    the database. Matrices loaded to build them are not kept.
+
+    Args:
+        analyses (list of AnalysisOutput): Datasets to prepare, a file once.
+        progress (callable): Called with one result dict per dataset.
+
+    Returns:
+        list of dict: One result per dataset with analysis id, path, status ("prepared" or
+            "failed"), seconds and bytes (the size of the shared export).
+    """
+    results = []
+    seen = set()
+    for analysis in analyses:
+        path_to_tsv = analysis.file_path
+        if path_to_tsv in seen:
+            continue
+        seen.add(path_to_tsv)
+        result = {"analysis_id": analysis.id, "path": path_to_tsv, "seconds": 0.0, "bytes": 0}
+        start = time.perf_counter()
+        try:
+            shared = get_shared_matrix(path_to_tsv, analysis.file_generation)
+            # After the export, which the compute pool maps to compute them
+            ensure_dataset_statistics(path_to_tsv, analysis.file_generation)
+        except Exception as e:
+            logger.warning("Could not prepare analysis %s (%s)", analysis.id, path_to_tsv, exc_info=True)
+            result.update(status="failed", error=str(e))
+        else:
+            result.update(status="prepared", bytes=os.path.getsize(shared.values_path))
+        finally:
+            dataset_cache.discard(path_to_tsv, reason="prepared")
+        result["seconds"] = time.perf_counter() - start
+        results.append(result)
+        if progress:
+            progress(result)
+    return results
+
+
+def warm_on_boot(background=True):
+    """
+    Boot hook: warms the default selection when BULK_RNA_WARM_ON_BOOT is on.
+
+    In a worker the warm-up runs in a background thread, so the worker starts serving at once
+    and cannot trip the gunicorn timeout. In a preloading gunicorn master it runs in the
+    foreground before the workers are forked, and they share the result copy-on-write.
+
+    Returns:
+        Thread or None: The warm-up thread when running in the background.
+    """
+    if not settings.BULK_RNA_WARM_ON_BOOT:
+        return None
+
+    def run():
+        from django.db import connection
+
+        start = time.perf_counter()
+        try:
+            results = warm_datasets(select_datasets(), in_process=not background)
+        except Exception:
+            logger.exception("Dataset warm-up failed")
+            return
+        finally:
+            # Not to be shared with forked workers, nor left open by a finished thread
+            connection.close()
+        warmed = [result for result in results if result["status"] in ("warmed", "cached")]
+        logger.info(
+            "Warmed %d of %d datasets (%.1f MB) in %.1fs",
+            len(warmed),
+            len(results),
+            sum(result["bytes"] for result in warmed) / 1024**2,
+            time.perf_counter() - start,
+        )
+
+    if not background:
+        run()
+        return None
+    thread = threading.Thread(target=run, name="bulk-rna-warmup", daemon=True)
+    thread.start()
+    return thread
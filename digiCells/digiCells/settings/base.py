@@ -53,6 +53,9 @@ CRISPY_ALLOWED_TEMPLATE_PACKS = ["bootstrap5"]
 CRISPY_TEMPLATE_PACK = "bootstrap5"
 
 MIDDLEWARE = [
+    "digiCells_core.tracing.RequestTracingMiddleware",
+    "digiCells_core.middleware.MetricsMiddleware",
+    "digiCells_core.middleware.QueryBudgetMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "whitenoise.middleware.WhiteNoiseMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
@@ -61,6 +64,7 @@ MIDDLEWARE = [
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
+    "digiCells_core.admission.AdmissionControlMiddleware",
 ]
 
 ROOT_URLCONF = "digiCells.urls"
@@ -149,3 +153,159 @@ CSRF_TRUSTED_ORIGINS = [
     "http://www.member.bit.bio",
 ]
 CSRF_FAILURE_VIEW = "django.views.csrf.csrf_failure"
+
+# Bulk RNA gene usage recording
+# Accessed genes are buffered per worker and written to the ledger in batches
+BULK_RNA_USAGE_WRITE_BEHIND = os.environ.get("BULK_RNA_USAGE_WRITE_BEHIND", "True").lower() == "true"
+BULK_RNA_USAGE_FLUSH_SIZE = int(os.environ.get("BULK_RNA_USAGE_FLUSH_SIZE", "200"))
+BULK_RNA_USAGE_FLUSH_INTERVAL = float(os.environ.get("BULK_RNA_USAGE_FLUSH_INTERVAL", "5"))
+# Reservations must outlive the flush interval, they are released once the flush commits. Older
+# ones were left by a worker that died before flushing and no longer count against the quota.
+BULK_RNA_USAGE_RESERVATION_TTL = int(os.environ.get("BULK_RNA_USAGE_RESERVATION_TTL", "600"))
+
+# Per-view query budgets, checked by digiCells_core.middleware.QueryBudgetMiddleware.
+# Overruns are logged, or raise QueryBudgetExceeded when QUERY_BUDGET_STRICT is on, as it is
+# in the tests (TEST_RUNNER).
+# They include the queries of the view's run_io() / run_cpu() jobs, e.g. the 3 that record the
+# version of a dataset on its first load in a worker, and the 2 that create the usage row of a
+# user's first request.
+QUERY_BUDGETS = {
+    "bulk_rna:bulk_rna_analysis_list": 10,
+    "bulk_rna:explore_analysis": 22,
+    "bulk_rna:gene_collection_list": 8,
+    "bulk_rna:heatmap_tile": 4,
+    "bulk_rna:box_plot_summaries": 19,
+    "bulk_rna:coexpression": 21,
+    "bulk_rna:gene_set_scores_view": 16,
+    "bulk_rna:dataset_statistics_view": 16,
+    "bulk_rna:pca_view": 16,
+}
+QUERY_BUDGET_STRICT = os.environ.get("QUERY_BUDGET_STRICT", "False").lower() == "true"
+# Runs the tests with QUERY_BUDGET_STRICT on
+TEST_RUNNER = "digiCells_core.testing.QueryBudgetTestRunner"
+# Log a warning when a request repeats the same query signature this many times
+QUERY_DUPLICATE_THRESHOLD = int(os.environ.get("QUERY_DUPLICATE_THRESHOLD", "5"))
+
+# Request tracing (digiCells_core.tracing). Traces of requests slower than this are logged at INFO.
+TRACE_SLOW_REQUEST_SECONDS = float(os.environ.get("TRACE_SLOW_REQUEST_SECONDS", "2.0"))
+# Optional JSON-lines file receiving every trace, e.g. for profiling a single slow request locally
+TRACE_FILE = os.environ.get("TRACE_FILE") or None
+
+# Bulk RNA data layer
+# Point at a local S3-compatible server (e.g. MinIO) instead of AWS; empty means AWS
+BULK_RNA_S3_ENDPOINT_URL = os.environ.get("BULK_RNA_S3_ENDPOINT_URL") or None
+# Per-worker cache of parsed datasets and their PCA results, bounded by memory
+BULK_RNA_DATASET_CACHE_MAX_BYTES = int(os.environ.get("BULK_RNA_DATASET_CACHE_MAX_BYTES", str(512 * 1024**2)))
+# How often a cached dataset is checked against its file (mtime/size) or S3 ETag
+BULK_RNA_DATASET_CACHE_REVALIDATE_SECONDS = float(os.environ.get("BULK_RNA_DATASET_CACHE_REVALIDATE_SECONDS", "60"))
+
+# S3 datasets are downloaded once per host into this directory and parsed from there by every
+# worker; concurrent downloads of the same version wait on a file lock. Empty disables spooling.
+BULK_RNA_DATASET_SPOOL_DIR = os.environ.get("BULK_RNA_DATASET_SPOOL_DIR", os.path.join(TMP_DIR, "datasets"))
+# Longest a worker waits for another worker's download before downloading itself
+BULK_RNA_DATASET_LOCK_TIMEOUT = float(os.environ.get("BULK_RNA_DATASET_LOCK_TIMEOUT", "120"))
+
+# Dataset warm-up at worker boot when BULK_RNA_WARM_ON_BOOT is on (manage.py warm_datasets only
+# builds the on-disk exports and statistics, see warmup.py; it takes BULK_RNA_WARM_LIMIT)
+BULK_RNA_WARM_ON_BOOT = os.environ.get("BULK_RNA_WARM_ON_BOOT", "False").lower() == "true"
+# At most this many datasets, and no more memory than this (defaults to the cache budget)
+BULK_RNA_WARM_LIMIT = int(os.environ.get("BULK_RNA_WARM_LIMIT", "5"))
+BULK_RNA_WARM_BUDGET_BYTES = int(
+    os.environ.get("BULK_RNA_WARM_BUDGET_BYTES", str(BULK_RNA_DATASET_CACHE_MAX_BYTES))
+)
+
+# Admission control (digiCells_core.admission). Concurrency limits are host-wide, across workers.
+# A queued request still holds its worker while it waits, so queues are kept short: with 3 sync
+# workers, these limits always leave a worker free for the login page and the cheap views.
+ADMISSION_LIMITS = {
+    "bulk_rna:pca_view": {"concurrency": 1, "queue": 1},
+    "bulk_rna:download_csv": {"concurrency": 1, "queue": 1},
+    "bulk_rna:load_genes_from_gtf": {"concurrency": 1, "queue": 0},
+    "bulk_rna:explore_analysis": {"concurrency": 2, "queue": 2, "methods": ["POST"]},
+    "bulk_rna:heatmap_tile": {"concurrency": 2, "queue": 4},
+    "bulk_rna:box_plot_summaries": {"concurrency": 2, "queue": 2},
+    "bulk_rna:differential_expression_view": {"concurrency": 1, "queue": 2},
+    "bulk_rna:coexpression": {"concurrency": 2, "queue": 4},
+    "bulk_rna:gene_set_scores_view": {"concurrency": 1, "queue": 2},
+    "bulk_rna:dataset_statistics_view": {"concurrency": 2, "queue": 2},
+}
+# Longest a request waits in the queue before it is turned away
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", "10"))
+# Retry-After sent with 503 responses
+ADMISSION_RETRY_AFTER = int(os.environ.get("ADMISSION_RETRY_AFTER", "5"))
+ADMISSION_LOCK_DIR = os.environ.get("ADMISSION_LOCK_DIR", os.path.join(TMP_DIR, "admission"))
+# Requests abort at their next stage past this, keep it below the gunicorn timeout
+REQUEST_DEADLINE_SECONDS = float(os.environ.get("REQUEST_DEADLINE_SECONDS", "100"))
+
+# Async views (served by both WSGI and ASGI): blocking S3/disk reads and CPU-bound pandas and
+# scikit-learn work run in these per-worker thread pools, keeping the event loop free
+ASYNC_IO_THREADS = int(os.environ.get("ASYNC_IO_THREADS", "16"))
+ASYNC_CPU_THREADS = int(os.environ.get("ASYNC_CPU_THREADS", "2"))
+
+# Compute pool (bitbio_nucleus_bulk_rna.compute): PCA, normalisation and the other analyses run in
+# this many processes per worker, started on first use. 0 runs them in the CPU threads instead.
+BULK_RNA_COMPUTE_PROCESSES = int(os.environ.get("BULK_RNA_COMPUTE_PROCESSES", "2"))
+# Requests waiting for a busy pool beyond this get a 503
+BULK_RNA_COMPUTE_QUEUE = int(os.environ.get("BULK_RNA_COMPUTE_QUEUE", "4"))
+# Analyses running longer are stopped (their process is replaced), queueing included
+BULK_RNA_COMPUTE_TASK_TIMEOUT = float(os.environ.get("BULK_RNA_COMPUTE_TASK_TIMEOUT", "60"))
+# Datasets are exported here once per host for the pool's processes to map; a tmpfs such as
+# /dev/shm avoids the disk write
+BULK_RNA_SHARED_MATRIX_DIR = os.environ.get("BULK_RNA_SHARED_MATRIX_DIR", os.path.join(TMP_DIR, "shared"))
+
+# Explore plot results, cached in this cache (shared by the workers when it is the database
+# cache, as in production) for this many seconds; 0 disables. Larger results are not cached.
+BULK_RNA_RESULT_CACHE = os.environ.get("BULK_RNA_RESULT_CACHE", "default")
+BULK_RNA_RESULT_CACHE_TTL = int(os.environ.get("BULK_RNA_RESULT_CACHE_TTL", "600"))
+BULK_RNA_RESULT_CACHE_MAX_ENTRY_BYTES = int(os.environ.get("BULK_RNA_RESULT_CACHE_MAX_ENTRY_BYTES", str(1024**2)))
+
+# The default cache holds plot results (one per analysis, selection and tier, up to
+# BULK_RNA_RESULT_CACHE_MAX_ENTRY_BYTES each), tiled heatmap selections and dataset headers.
+# Django's default of 300 entries evicts results well within their TTL with a few dozen users
+# exploring; 2000 keeps them while bounding the cache to about 2 GiB at worst
+CACHE_MAX_ENTRIES = int(os.environ.get("CACHE_MAX_ENTRIES", "2000"))
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "OPTIONS": {"MAX_ENTRIES": CACHE_MAX_ENTRIES},
+    }
+}
+
+# Heatmaps of more genes than this are tiled (bitbio_nucleus_bulk_rna.heatmaps): the explore page
+# shows a mean-pooled overview of at most BULK_RNA_HEATMAP_OVERVIEW_ROWS rows and fetches the
+# genes at full resolution, BULK_RNA_HEATMAP_TILE_ROWS at a time. Tiled selections can be
+# browsed for BULK_RNA_HEATMAP_TTL seconds, after which the form has to be submitted again.
+BULK_RNA_HEATMAP_TILE_THRESHOLD = int(os.environ.get("BULK_RNA_HEATMAP_TILE_THRESHOLD", "500"))
+BULK_RNA_HEATMAP_OVERVIEW_ROWS = int(os.environ.get("BULK_RNA_HEATMAP_OVERVIEW_ROWS", "200"))
+BULK_RNA_HEATMAP_TILE_ROWS = int(os.environ.get("BULK_RNA_HEATMAP_TILE_ROWS", "100"))
+BULK_RNA_HEATMAP_TTL = int(os.environ.get("BULK_RNA_HEATMAP_TTL", "3600"))
+
+# Most genes compared at once as box plots (bulk_rna:box_plot_summaries)
+BULK_RNA_BOX_SUMMARY_MAX_GENES = int(os.environ.get("BULK_RNA_BOX_SUMMARY_MAX_GENES", "50"))
+
+# Most genes listed on the differential expression page; the CSV export has every gene
+BULK_RNA_DE_MAX_ROWS = int(os.environ.get("BULK_RNA_DE_MAX_ROWS", "1000"))
+
+# Most genes returned by a co-expression query (bulk_rna:coexpression)
+BULK_RNA_COEXPRESSION_MAX_K = int(os.environ.get("BULK_RNA_COEXPRESSION_MAX_K", "200"))
+
+# Approximate co-expression search (bitbio_nucleus_bulk_rna.similarity): random-projection LSH
+# with this many hash tables and buckets of about this many genes. More tables raise recall
+# and query time; the probes of a query trade them off further.
+BULK_RNA_SIMILARITY_TABLES = int(os.environ.get("BULK_RNA_SIMILARITY_TABLES", "16"))
+BULK_RNA_SIMILARITY_BUCKET_SIZE = int(os.environ.get("BULK_RNA_SIMILARITY_BUCKET_SIZE", "16"))
+
+# Most highly variable genes listed by bulk_rna:dataset_statistics_view
+BULK_RNA_STATISTICS_MAX_GENES = int(os.environ.get("BULK_RNA_STATISTICS_MAX_GENES", "2000"))
+
+# Most highly variable genes a subset PCA can be asked for (bulk_rna:pca_view with top)
+BULK_RNA_PCA_MAX_TOP_GENES = int(os.environ.get("BULK_RNA_PCA_MAX_TOP_GENES", "5000"))
+
+# /metrics answers direct requests from these networks only (the Prometheus scraper reaches
+# gunicorn on the internal network, whose subnet the docker-compose files set here); nginx
+# refuses it from outside
+METRICS_ALLOWED_NETWORKS = [
+    network.strip()
+    for network in os.environ.get("METRICS_ALLOWED_NETWORKS", "127.0.0.1/32,::1/128").split(",")
+    if network.strip()
+]
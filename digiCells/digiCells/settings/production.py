@@ -111,6 +111,9 @@ LOGGING = {
             "format": "{levelname} {asctime} {module} {process:d} {thread:d} {message}",
             "style": "{",
         },
+        "json": {
+            "()": "digiCells_core.tracing.JsonFormatter",
+        },
     },
     "handlers": {
         "file": {
@@ -124,6 +127,17 @@ LOGGING = {
             "class": "logging.StreamHandler",
             "formatter": "verbose",
         },
+        "trace_file": {
+            "level": "INFO",
+            "class": "logging.FileHandler",
+            "filename": os.path.join(BASE_DIR.parent, "logs", "trace.log"),
+            "formatter": "json",
+        },
+        "trace_console": {
+            "level": "INFO",
+            "class": "logging.StreamHandler",
+            "formatter": "json",
+        },
     },
     "root": {
         "handlers": ["file", "console"],
@@ -135,6 +149,12 @@ LOGGING = {
             "level": "INFO",
             "propagate": False,
         },
+        # Per-request stage timings from digiCells_core.tracing, one JSON object per line
+        "digiCells.trace": {
+            "handlers": ["trace_file", "trace_console"],
+            "level": "INFO",
+            "propagate": False,
+        },
     },
 }
 
@@ -143,6 +163,7 @@ CACHES = {
     "default": {
         "BACKEND": "django.core.cache.backends.db.DatabaseCache",
         "LOCATION": "cache_table",
+        "OPTIONS": {"MAX_ENTRIES": CACHE_MAX_ENTRIES},
     }
 }
 
@@ -0,0 +1,197 @@
+"""
+Admission control and request deadlines for the heavy views.
+
+AdmissionControlMiddleware caps how many requests to each view listed in ADMISSION_LIMITS
+run at once across all workers on the host (see locks.SlotPool). A request that finds every
+slot busy waits in a bounded queue for up to ADMISSION_QUEUE_TIMEOUT seconds; when the queue
+is full or the wait times out it is rejected at once with a 503 and a Retry-After header,
+instead of tying up a worker that the login page or a cheap view could use. Shared resources
+further down raise Overloaded when they are saturated, which is answered the same way.
+
+Every request also gets a deadline, REQUEST_DEADLINE_SECONDS by default. Long computations
+check it at each stage (every ``tracing.span()`` does) and abort with DeadlineExceeded, which
+the middleware turns into a 503, rather than running on until gunicorn kills the worker.
+"""
+
+import contextvars
+import logging
+import os
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.http import HttpResponse
+
+from . import metrics
+from .locks import SlotPool
+
+logger = logging.getLogger(__name__)
+
+_deadline = contextvars.ContextVar("request_deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    """Raised by check_deadline() once the current request has run out of time."""
+
+
+class Overloaded(Exception):
+    """
+    Raised by a shared resource, such as the compute pool, that cannot take on more work.
+    The middleware answers it with a 503, rejections are counted under `reason`.
+    """
+
+    reason = "overloaded"
+
+
+def remaining_time():
+    """Seconds left before the current request's deadline, or None outside a request."""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def check_deadline():
+    remaining = remaining_time()
+    if remaining is not None and remaining <= 0:
+        raise DeadlineExceeded()
+
+
+def busy_response(retry_after, message="The server is busy, please try again shortly."):
+    response = HttpResponse(message, status=503, content_type="text/plain")
+    response["Retry-After"] = str(int(retry_after))
+    return response
+
+
+class AdmissionControlMiddleware:
+    """
+    Applies ADMISSION_LIMITS and request deadlines. Should come after the authentication
+    middleware so that rejected requests have already been through the cheap checks.
+    Under ASGI, queued requests wait on the event loop instead of holding a thread.
+    """
+
+    async_capable = True
+    sync_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+            # Django picks the async or sync process_view from the instance
+            self.process_view = self.aprocess_view
+        self.lock_dir = settings.ADMISSION_LOCK_DIR
+        self.limits = {}
+        for view_name, limit in settings.ADMISSION_LIMITS.items():
+            name = view_name.replace(":", "_")
+            self.limits[view_name] = {
+                "slots": SlotPool(self.lock_dir, name, limit["concurrency"]),
+                "queue": SlotPool(self.lock_dir, f"{name}.queue", limit.get("queue", 0)),
+                "methods": {method.upper() for method in limit.get("methods", ())},
+                "deadline": limit.get("deadline"),
+            }
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        token = _deadline.set(time.monotonic() + settings.REQUEST_DEADLINE_SECONDS)
+        try:
+            return self.get_response(request)
+        finally:
+            _deadline.reset(token)
+            self._release(request)
+
+    async def __acall__(self, request):
+        token = _deadline.set(time.monotonic() + settings.REQUEST_DEADLINE_SECONDS)
+        try:
+            return await self.get_response(request)
+        finally:
+            _deadline.reset(token)
+            self._release(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        view_name, limit = self._limit_for(request)
+        if limit is None:
+            return None
+
+        slot = limit["slots"].try_acquire()
+        if slot is None:
+            queue_slot = limit["queue"].try_acquire()
+            if queue_slot is None:
+                return self._reject(view_name, "queue_full")
+
+            metrics.ADMISSION_QUEUE_DEPTH.labels(view_name).inc()
+            start = time.perf_counter()
+            try:
+                slot = limit["slots"].acquire(self._queue_timeout())
+            finally:
+                limit["queue"].release(queue_slot)
+                metrics.ADMISSION_QUEUE_DEPTH.labels(view_name).dec()
+                metrics.ADMISSION_WAIT_SECONDS.labels(view_name).observe(time.perf_counter() - start)
+            if slot is None:
+                return self._reject(view_name, "wait_timeout")
+
+        self._admit(request, view_name, limit, slot)
+        return None
+
+    async def aprocess_view(self, request, view_func, view_args, view_kwargs):
+        view_name, limit = self._limit_for(request)
+        if limit is None:
+            return None
+
+        slot = limit["slots"].try_acquire()
+        if slot is None:
+            queue_slot = limit["queue"].try_acquire()
+            if queue_slot is None:
+                return self._reject(view_name, "queue_full")
+
+            metrics.ADMISSION_QUEUE_DEPTH.labels(view_name).inc()
+            start = time.perf_counter()
+            try:
+                slot = await limit["slots"].aacquire(self._queue_timeout())
+            finally:
+                limit["queue"].release(queue_slot)
+                metrics.ADMISSION_QUEUE_DEPTH.labels(view_name).dec()
+                metrics.ADMISSION_WAIT_SECONDS.labels(view_name).observe(time.perf_counter() - start)
+            if slot is None:
+                return self._reject(view_name, "wait_timeout")
+
+        self._admit(request, view_name, limit, slot)
+        return None
+
+    def _limit_for(self, request):
+        view_name = request.resolver_match.view_name if request.resolver_match else None
+        limit = self.limits.get(view_name)
+        if limit is None or (limit["methods"] and request.method not in limit["methods"]):
+            return view_name, None
+        if limit["deadline"]:
+            _deadline.set(time.monotonic() + limit["deadline"])
+        return view_name, limit
+
+    @staticmethod
+    def _queue_timeout():
+        return min(settings.ADMISSION_QUEUE_TIMEOUT, max(remaining_time(), 0))
+
+    @staticmethod
+    def _admit(request, view_name, limit, slot):
+        request._admission = (view_name, limit["slots"], slot)
+        metrics.ADMISSION_IN_FLIGHT.labels(view_name).inc()
+
+    @staticmethod
+    def _release(request):
+        admitted = getattr(request, "_admission", None)
+        if admitted is not None:
+            view_name, slots, slot = admitted
+            slots.release(slot)
+            metrics.ADMISSION_IN_FLIGHT.labels(view_name).dec()
+
+    def process_exception(self, request, exception):
+        view_name = request.resolver_match.view_name if request.resolver_match else "<unresolved>"
+        if isinstance(exception, Overloaded):
+            logger.warning("%s %s turned away: %s (pid %s)", request.method, request.path, exception.reason, os.getpid())
+            return self._reject(view_name, exception.reason)
+        if not isinstance(exception, DeadlineExceeded):
+            return None
+        logger.warning("%s %s aborted at its deadline (pid %s)", request.method, request.path, os.getpid())
+        return self._reject(view_name, "deadline", "The request took too long and was stopped, please try again.")
+
+    def _reject(self, view_name, reason, *message):
+        metrics.ADMISSION_REJECTED.labels(view_name, reason).inc()
+        return busy_response(settings.ADMISSION_RETRY_AFTER, *message)
@@ -0,0 +1,64 @@
+"""
+Bounded thread pools for async views.
+
+Async views must not block the event loop. Blocking I/O (S3 and disk reads through boto3 and
+pandas, which have no async API) goes to ``run_io``, CPU-bound pandas/scikit-learn work to
+``run_cpu``. The pools are sized by ASYNC_IO_THREADS and ASYNC_CPU_THREADS and created lazily,
+so each forked worker gets its own. The caller's context variables (request trace, deadline)
+are carried into the pool threads.
+
+Pool threads have database connections of their own. As Django does around a request, broken
+connections and those past CONN_MAX_AGE are closed before and after each job, and the job's
+queries count towards the request's QueryStats (see middleware.py).
+"""
+
+import asyncio
+import contextvars
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .middleware import current_query_stats
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _pool(kind, size):
+    pool = _pools.get(kind)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(kind)
+            if pool is None:
+                pool = _pools[kind] = ThreadPoolExecutor(max_workers=size, thread_name_prefix=f"async-{kind}")
+    return pool
+
+
+def _job(fn, args, kwargs):
+    close_old_connections()
+    stats = current_query_stats()
+    try:
+        with stats.watch() if stats is not None else nullcontext():
+            return fn(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+async def _run(kind, size, fn, args, kwargs):
+    context = contextvars.copy_context()
+    call = functools.partial(context.run, _job, fn, args, kwargs)
+    return await asyncio.get_running_loop().run_in_executor(_pool(kind, size), call)
+
+
+async def run_io(fn, *args, **kwargs):
+    """Runs blocking I/O ``fn(*args, **kwargs)`` in the I/O pool."""
+    return await _run("io", settings.ASYNC_IO_THREADS, fn, args, kwargs)
+
+
+async def run_cpu(fn, *args, **kwargs):
+    """Runs CPU-bound ``fn(*args, **kwargs)`` in the CPU pool."""
+    return await _run("cpu", settings.ASYNC_CPU_THREADS, fn, args, kwargs)
@@ -0,0 +1,164 @@
+"""
+Coordination primitives for work that several threads or gunicorn workers may try to do at once.
+
+- ``SingleFlight`` coalesces concurrent calls with the same key inside a process: the first
+  caller runs the function, the others wait for and share its result (or exception).
+- ``file_lock`` is an exclusive lock between processes on the same host, using flock on a
+  lock file. fcntl is not available everywhere: without it the lock is never acquired and
+  callers fall back to doing the work themselves.
+- ``SlotPool`` caps how many processes (or threads) may do something at once, host-wide.
+"""
+
+import asyncio
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        """
+        Runs ``fn()`` unless a call with the same key is already in flight, in which case
+        waits for that call instead.
+
+        Returns:
+            tuple: (result, shared), `shared` is True when the result came from another caller.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+
+@contextmanager
+def file_lock(path, timeout=60.0, poll_interval=0.05):
+    """
+    Holds an exclusive lock on `path` (created if needed) for the duration of the block.
+
+    Yields:
+        bool: True if the lock was acquired, False if it timed out or locking is unsupported.
+    """
+    if fcntl is None:
+        yield False
+        return
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    acquired = False
+    try:
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                acquired = True
+                break
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    break
+                time.sleep(poll_interval)
+        yield acquired
+    finally:
+        if acquired:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+class SlotPool:
+    """
+    `size` slots shared by every process on the host, each backed by a lock file in
+    `directory`. Holding a slot means holding the flock on its file, so slots of a crashed
+    process are freed by the kernel. Without fcntl the pool only limits threads of this process.
+    """
+
+    def __init__(self, directory, name, size):
+        self.directory = directory
+        self.name = name
+        self.size = size
+        self._local = threading.BoundedSemaphore(size) if fcntl is None else None
+
+    def try_acquire(self):
+        """
+        Takes a free slot without waiting.
+
+        Returns:
+            A token to pass to release(), or None if every slot is taken.
+        """
+        if self.size <= 0:
+            return None
+        if self._local is not None:
+            return True if self._local.acquire(blocking=False) else None
+
+        os.makedirs(self.directory, exist_ok=True)
+        for slot in range(self.size):
+            fd = os.open(os.path.join(self.directory, f"{self.name}.{slot}.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            return fd
+        return None
+
+    def acquire(self, timeout, poll_interval=0.05):
+        """Waits up to `timeout` seconds for a slot. Returns a token, or None on timeout."""
+        deadline = time.monotonic() + timeout
+        while True:
+            token = self.try_acquire()
+            if token is not None or time.monotonic() >= deadline:
+                return token
+            time.sleep(poll_interval)
+
+    async def aacquire(self, timeout, poll_interval=0.05):
+        """acquire() for async code: waits without blocking the event loop."""
+        deadline = time.monotonic() + timeout
+        while True:
+            token = self.try_acquire()
+            if token is not None or time.monotonic() >= deadline:
+                return token
+            await asyncio.sleep(poll_interval)
+
+    def release(self, token):
+        if self._local is not None:
+            self._local.release()
+            return
+        fcntl.flock(token, fcntl.LOCK_UN)
+        os.close(token)
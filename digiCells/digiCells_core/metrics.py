@@ -0,0 +1,183 @@
+"""
+Prometheus metrics for the web app and the bulk RNA data layer.
+
+Metrics are exposed at /metrics (see digiCells_core.views.metrics) to the addresses in
+METRICS_ALLOWED_NETWORKS, for scrapers that reach gunicorn directly. Under gunicorn,
+set PROMETHEUS_MULTIPROC_DIR to an empty, writable directory before the workers start so
+that every worker writes its samples there and /metrics aggregates them
+(gunicorn.conf.py takes care of this).
+
+prometheus_client is optional: without it every metric below is a no-op.
+"""
+
+import os
+import time
+from contextlib import contextmanager
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+
+class _NoopMetric:
+    def labels(self, *args, **kwargs):
+        return self
+
+    def observe(self, *args, **kwargs):
+        pass
+
+    def inc(self, *args, **kwargs):
+        pass
+
+    def dec(self, *args, **kwargs):
+        pass
+
+    def set(self, *args, **kwargs):
+        pass
+
+
+def _metric(kind, name, documentation, labelnames=(), **kwargs):
+    if prometheus_client is None:
+        return _NoopMetric()
+    return getattr(prometheus_client, kind)(name, documentation, labelnames, **kwargs)
+
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+SIZE_BUCKETS = (1e4, 1e5, 1e6, 5e6, 1e7, 5e7, 1e8, 5e8, 1e9)
+
+# Web layer
+REQUEST_LATENCY = _metric(
+    "Histogram", "django_http_request_duration_seconds", "Request latency by view.",
+    ["view", "method", "status"], buckets=LATENCY_BUCKETS,
+)
+REQUESTS_IN_PROGRESS = _metric(
+    "Gauge", "django_http_requests_in_progress", "Requests currently being handled.",
+    multiprocess_mode="livesum",
+)
+DB_QUERIES = _metric(
+    "Histogram", "django_db_queries_per_request", "Database queries run per request.",
+    ["view"], buckets=(1, 2, 5, 10, 20, 50, 100, 250),
+)
+DB_QUERY_TIME = _metric(
+    "Histogram", "django_db_query_seconds_per_request", "Time spent in the database per request.",
+    ["view"], buckets=LATENCY_BUCKETS,
+)
+ADMISSION_IN_FLIGHT = _metric(
+    "Gauge", "django_admission_in_flight", "Requests holding a concurrency slot, by view.",
+    ["view"], multiprocess_mode="livesum",
+)
+ADMISSION_QUEUE_DEPTH = _metric(
+    "Gauge", "django_admission_queue_depth", "Requests waiting for a concurrency slot, by view.",
+    ["view"], multiprocess_mode="livesum",
+)
+ADMISSION_WAIT_SECONDS = _metric(
+    "Histogram", "django_admission_wait_seconds", "Time spent waiting for a concurrency slot.",
+    ["view"], buckets=LATENCY_BUCKETS,
+)
+ADMISSION_REJECTED = _metric(
+    "Counter", "django_admission_rejected_total",
+    "Requests turned away with a 503, by view and reason (queue_full, wait_timeout, deadline, "
+    "or the reason of an Overloaded error such as pool_busy).",
+    ["view", "reason"],
+)
+COMPUTE_PROCESSES = _metric(
+    "Gauge", "compute_pool_processes", "Worker processes started by each compute pool.",
+    ["pool"], multiprocess_mode="livesum",
+)
+COMPUTE_QUEUE_DEPTH = _metric(
+    "Gauge", "compute_pool_queue_depth", "Callers waiting for a free compute pool process.",
+    ["pool"], multiprocess_mode="livesum",
+)
+COMPUTE_QUEUE_WAIT_SECONDS = _metric(
+    "Histogram", "compute_pool_queue_wait_seconds", "Time spent waiting for a compute pool process.",
+    ["pool"], buckets=LATENCY_BUCKETS,
+)
+COMPUTE_TASK_SECONDS = _metric(
+    "Histogram", "compute_pool_task_seconds",
+    "Latency of compute pool tasks, queueing included, by outcome (ok, error, timeout, cancelled, died).",
+    ["pool", "task", "outcome"], buckets=LATENCY_BUCKETS,
+)
+
+# Bulk RNA data layer
+DATASET_LOAD_SECONDS = _metric(
+    "Histogram", "bulk_rna_dataset_load_seconds", "Time to fetch and parse an expression matrix.",
+    ["source"], buckets=LATENCY_BUCKETS,
+)
+DATASET_LOAD_BYTES = _metric(
+    "Histogram", "bulk_rna_dataset_load_bytes", "Size of the expression matrix files read.",
+    ["source"], buckets=SIZE_BUCKETS,
+)
+S3_REQUEST_SECONDS = _metric(
+    "Histogram", "bulk_rna_s3_request_seconds", "Latency of S3 calls.",
+    ["operation"], buckets=LATENCY_BUCKETS,
+)
+CACHE_REQUESTS = _metric(
+    "Counter", "bulk_rna_cache_requests_total", "Cache lookups by cache and result (hit or miss).",
+    ["cache", "result"],
+)
+DATASET_CACHE_BYTES = _metric(
+    "Gauge", "bulk_rna_dataset_cache_bytes", "Memory held by the in-process dataset cache.",
+    multiprocess_mode="livesum",
+)
+DATASET_CACHE_EVICTIONS = _metric(
+    "Counter", "bulk_rna_dataset_cache_evictions_total", "Datasets dropped from the in-process cache, by reason.",
+    ["reason"],
+)
+DATASET_COALESCED = _metric(
+    "Counter", "bulk_rna_dataset_coalesced_total",
+    "Loads served by another caller's in-flight or finished work instead of repeating it, by kind and scope "
+    "(thread: same worker, worker: another worker's download).",
+    ["kind", "scope"],
+)
+DATASET_DUPLICATE_LOADS = _metric(
+    "Counter", "bulk_rna_dataset_duplicate_loads_total",
+    "S3 downloads made without the cross-worker lock, which may duplicate another worker's download.",
+    ["reason"],
+)
+STAGE_SECONDS = _metric(
+    "Histogram", "bulk_rna_stage_seconds", "Time spent in each stage of the analysis pipeline.",
+    ["stage"], buckets=LATENCY_BUCKETS,
+)
+
+
+@contextmanager
+def time_s3(operation):
+    """Observe the duration of the wrapped S3 call in bulk_rna_s3_request_seconds."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        S3_REQUEST_SECONDS.labels(operation).observe(time.perf_counter() - start)
+
+
+def record_cache_lookup(cache_name, hit):
+    """Count a cache lookup; the hit ratio is hit / (hit + miss) per cache."""
+    CACHE_REQUESTS.labels(cache_name, "hit" if hit else "miss").inc()
+
+
+def render_latest():
+    """
+    Return (payload, content_type) for the /metrics endpoint, aggregating all gunicorn
+    workers when PROMETHEUS_MULTIPROC_DIR is set.
+    """
+    from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, generate_latest, multiprocess
+
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid):
+    """
+    Drops the live gauge samples of a process that exited, e.g. a gunicorn worker or a compute
+    pool process, so that /metrics stops adding them up.
+    """
+    if prometheus_client is None or not os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        return
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(pid)
@@ -0,0 +1,211 @@
+import contextvars
+import logging
+import re
+import time
+from collections import Counter
+from contextlib import ExitStack
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import connections
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LIST = re.compile(r"\bIN \((?:\s*(?:%s|\?|\d+)\s*,?)+\)", re.IGNORECASE)
+
+# The active QueryStats, seen by the thread pools of digiCells_core.executors
+_current_stats = contextvars.ContextVar("query_stats", default=None)
+
+
+class QueryBudgetExceeded(Exception):
+    """Raised in strict mode when a view runs more queries than its declared budget."""
+
+
+def query_signature(sql):
+    """
+    Reduce a SQL statement to a signature that is the same for every execution of the same
+    query shape, so repeated lookups that only differ in their parameters are grouped together.
+    """
+    sql = _STRING_LITERAL.sub("?", sql)
+    sql = _NUMBER_LITERAL.sub("?", sql)
+    sql = _IN_LIST.sub("IN (...)", sql)
+    return " ".join(sql.split())
+
+
+class QueryStats:
+    """
+    Records every query run on any database connection while it is active.
+
+    Usage:
+        with QueryStats() as stats:
+            ...
+        stats.count, stats.total_time, stats.duplicates()
+    """
+
+    def __init__(self):
+        self.queries = []
+        self._stack = None
+        self._previous = None
+
+    def __enter__(self):
+        self._stack = self.watch()
+        # Not a token: under ASGI __enter__ and __exit__ run in different contexts
+        self._previous = _current_stats.get()
+        _current_stats.set(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stack.close()
+        _current_stats.set(self._previous)
+        return False
+
+    def watch(self):
+        """
+        Records the queries run on the current thread's connections until the returned
+        ExitStack is closed. Other threads, e.g. run_io() jobs, have connections of their own.
+        """
+        stack = ExitStack()
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(self))
+        return stack
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((sql, time.perf_counter() - start))
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def total_time(self):
+        return sum(duration for _, duration in self.queries)
+
+    def duplicates(self, threshold=2):
+        """Query signatures executed at least ``threshold`` times, most repeated first."""
+        counts = Counter(query_signature(sql) for sql, _ in self.queries)
+        return [(signature, n) for signature, n in counts.most_common() if n >= threshold]
+
+
+def current_query_stats():
+    """The QueryStats active in the current context, None outside of one."""
+    return _current_stats.get()
+
+
+def get_query_budget(view_name):
+    return getattr(settings, "QUERY_BUDGETS", {}).get(view_name)
+
+
+class QueryBudgetMiddleware:
+    """
+    Counts the queries and DB time of each request and checks them against QUERY_BUDGETS.
+
+    Repeated query signatures (the usual sign of an N+1) are logged, as are budget overruns.
+    With QUERY_BUDGET_STRICT enabled (by the test runner), an overrun raises QueryBudgetExceeded instead.
+    The stats are attached to the response as ``response.query_stats``.
+
+    Under ASGI the ORM runs in the request's thread-sensitive thread, so the query wrappers are
+    installed (and removed) there. Jobs the view sends to run_io() / run_cpu() install them on
+    their pool thread's connections.
+    """
+
+    async_capable = True
+    sync_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with QueryStats() as stats:
+            response = self.get_response(request)
+        return self._check(request, response, stats)
+
+    async def __acall__(self, request):
+        stats = QueryStats()
+        await sync_to_async(stats.__enter__)()
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(stats.__exit__)(None, None, None)
+        return self._check(request, response, stats)
+
+    def _check(self, request, response, stats):
+        view_name = request.resolver_match.view_name if request.resolver_match else request.path
+        response.query_stats = stats
+
+        duplicate_threshold = getattr(settings, "QUERY_DUPLICATE_THRESHOLD", 5)
+        for signature, n in stats.duplicates(duplicate_threshold):
+            logger.warning("%s ran the same query %d times: %s", view_name, n, signature)
+
+        budget = get_query_budget(view_name)
+        if budget is not None and stats.count > budget:
+            message = (
+                f"{view_name} ran {stats.count} queries ({stats.total_time * 1000:.1f} ms), budget is {budget}"
+            )
+            if getattr(settings, "QUERY_BUDGET_STRICT", False):
+                raise QueryBudgetExceeded(message)
+            logger.warning(message)
+        else:
+            logger.debug("%s ran %d queries (%.1f ms)", view_name, stats.count, stats.total_time * 1000)
+
+        return response
+
+
+class MetricsMiddleware:
+    """
+    Records request latency, in-flight requests and per-request DB cost in Prometheus.
+
+    Should sit above QueryBudgetMiddleware so it can read the query stats that one
+    attaches to the response.
+    """
+
+    async_capable = True
+    sync_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        metrics.REQUESTS_IN_PROGRESS.inc()
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            metrics.REQUESTS_IN_PROGRESS.dec()
+        return self._record(request, response, start)
+
+    async def __acall__(self, request):
+        metrics.REQUESTS_IN_PROGRESS.inc()
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            metrics.REQUESTS_IN_PROGRESS.dec()
+        return self._record(request, response, start)
+
+    def _record(self, request, response, start):
+        # Unresolved paths share one label so that 404 scans cannot blow up the label set
+        view_name = request.resolver_match.view_name if request.resolver_match else "<unresolved>"
+        metrics.REQUEST_LATENCY.labels(view_name, request.method, response.status_code).observe(
+            time.perf_counter() - start
+        )
+        stats = getattr(response, "query_stats", None)
+        if stats is not None:
+            metrics.DB_QUERIES.labels(view_name).observe(stats.count)
+            metrics.DB_QUERY_TIME.labels(view_name).observe(stats.total_time)
+        return response
@@ -0,0 +1,263 @@
+"""
+Persistent pool of worker processes for CPU-bound work.
+
+Pure CPU work (pandas, scikit-learn) holds the GIL for its whole duration, so running it in a
+thread of a Django worker stalls every other request of that worker. ``ProcessPool`` keeps up
+to `size` long-lived processes per Django worker, started on first use, and runs one task at
+a time in each:
+
+- at most `max_queue` callers wait for a busy pool; beyond that PoolBusy is raised at once;
+- a task that runs past its timeout, or past the request deadline, has its process killed
+  and replaced, so it stops using the CPU as soon as nobody waits for it any more;
+- ``run()``, the async entry point, does the same when the awaiting request is cancelled.
+
+Tasks and their arguments are pickled: pass handles to large inputs (see
+bitbio_nucleus_bulk_rna.datasets.SharedMatrix), not the inputs themselves.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+from . import metrics
+from .admission import DeadlineExceeded, Overloaded, remaining_time
+from .executors import run_io
+
+logger = logging.getLogger(__name__)
+
+
+class PoolBusy(Overloaded):
+    """Every process is busy and the queue is full."""
+
+    reason = "pool_busy"
+
+
+class TaskTimeout(Overloaded):
+    """The task did not finish within its timeout and was stopped."""
+
+    reason = "task_timeout"
+
+
+class TaskCancelled(Exception):
+    """The caller gave up on the task and it was stopped."""
+
+
+class WorkerDied(RuntimeError):
+    """The process running the task exited without returning a result."""
+
+
+def setup_django(settings_module):
+    """
+    Initializer for pools whose tasks use Django. Lives here, away from any app module: the
+    initializer is imported in the new process before it runs.
+    """
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", settings_module)
+    import django
+
+    django.setup()
+
+
+def _worker_main(conn, initializer, initargs):
+    try:
+        _serve(conn, initializer, initargs)
+    finally:
+        metrics.mark_process_dead(os.getpid())
+
+
+def _serve(conn, initializer, initargs):
+    if initializer is not None:
+        initializer(*initargs)
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            # The pool's owner is gone
+            return
+        if message is None:
+            return
+        fn, args, kwargs = message
+        try:
+            result = (True, fn(*args, **kwargs))
+        except Exception as e:
+            result = (False, e)
+        try:
+            conn.send(result)
+        except Exception as e:
+            # Result or exception that cannot be pickled
+            conn.send((False, RuntimeError(f"{fn.__name__} returned an unpicklable result: {e!r}")))
+
+
+class _Worker:
+    def __init__(self, context, initializer, initargs, name):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main, args=(child_conn, initializer, initargs), name=name, daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+
+    def stop(self, kill=False):
+        try:
+            if kill:
+                self.process.kill()
+            else:
+                self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(timeout=5)
+        self.conn.close()
+        # Killed processes cannot clean up their metrics themselves
+        metrics.mark_process_dead(self.process.pid)
+
+
+class ProcessPool:
+    """
+    Args:
+        name (str): Used for process names and metric labels.
+        size (int): Maximum number of worker processes.
+        max_queue (int): Maximum number of callers waiting for a free process.
+        task_timeout (float): Default timeout of a task, in seconds, queueing included.
+        initializer (callable): Run once in each new process, e.g. to set up Django.
+        initargs (tuple): Arguments of `initializer`.
+        start_method (str): multiprocessing start method, "forkserver" by default where
+            available. Forking a threaded web worker directly is not safe.
+    """
+
+    def __init__(self, name, size, max_queue, task_timeout, initializer=None, initargs=(), start_method=None):
+        self.name = name
+        self.size = size
+        self.max_queue = max_queue
+        self.task_timeout = task_timeout
+        self.initializer = initializer
+        self.initargs = initargs
+        if start_method is None:
+            start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        self._context = multiprocessing.get_context(start_method)
+        self._cond = threading.Condition()
+        self._idle = []
+        self._started = 0
+        self._waiting = 0
+        self._pid = os.getpid()
+
+    def call(self, fn, args=(), kwargs=None, timeout=None, cancel=None):
+        """
+        Runs ``fn(*args, **kwargs)`` in a worker process and returns its result, or raises its
+        exception.
+
+        Args:
+            fn (callable): A module-level function, it is pickled by reference.
+            timeout (float): Overrides the pool's task timeout.
+            cancel (threading.Event): Stops the task when set.
+
+        Raises:
+            PoolBusy: The queue is full.
+            TaskTimeout: The task ran out of time.
+            DeadlineExceeded: The current request ran out of time first.
+            TaskCancelled: `cancel` was set.
+            WorkerDied: The worker process exited during the task.
+        """
+        timeout = self.task_timeout if timeout is None else timeout
+        remaining = remaining_time()
+        by_deadline = remaining is not None and remaining < timeout
+        deadline = time.monotonic() + (remaining if by_deadline else timeout)
+        task_name = getattr(fn, "__name__", "task")
+
+        start = time.perf_counter()
+        worker = self._checkout(deadline, by_deadline)
+        metrics.COMPUTE_QUEUE_WAIT_SECONDS.labels(self.name).observe(time.perf_counter() - start)
+
+        outcome = "died"
+        try:
+            worker.conn.send((fn, args, kwargs or {}))
+            while not worker.conn.poll(min(0.1, max(deadline - time.monotonic(), 0))):
+                if cancel is not None and cancel.is_set():
+                    outcome = "cancelled"
+                    raise TaskCancelled(task_name)
+                if time.monotonic() >= deadline:
+                    outcome = "timeout"
+                    raise DeadlineExceeded() if by_deadline else TaskTimeout(task_name)
+            ok, value = worker.conn.recv()
+            outcome = "ok" if ok else "error"
+        except (EOFError, OSError) as e:
+            raise WorkerDied(f"{self.name} worker exited while running {task_name}") from e
+        finally:
+            self._checkin(worker, healthy=outcome in ("ok", "error"))
+            metrics.COMPUTE_TASK_SECONDS.labels(self.name, task_name, outcome).observe(time.perf_counter() - start)
+
+        if not ok:
+            raise value
+        return value
+
+    async def run(self, fn, args=(), kwargs=None, timeout=None):
+        """call() for async code. Cancelling the awaiting task stops the process's task too."""
+        cancel = threading.Event()
+        try:
+            return await run_io(self.call, fn, args, kwargs, timeout, cancel)
+        except asyncio.CancelledError:
+            cancel.set()
+            raise
+
+    def shutdown(self):
+        """Stops the idle processes; busy ones stop when they return to the pool."""
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._started -= len(idle)
+            self._publish()
+        for worker in idle:
+            worker.stop()
+
+    def stats(self):
+        with self._cond:
+            return {"processes": self._started, "idle": len(self._idle), "waiting": self._waiting}
+
+    def _checkout(self, deadline, by_deadline):
+        with self._cond:
+            if os.getpid() != self._pid:
+                # Forked since the pool was used: its processes belong to the parent
+                self._pid, self._idle, self._started, self._waiting = os.getpid(), [], 0, 0
+            if not self._idle and self._started >= self.size:
+                if self._waiting >= self.max_queue:
+                    raise PoolBusy(self.name)
+                self._waiting += 1
+                self._publish()
+                try:
+                    while not self._idle and self._started >= self.size:
+                        wait = deadline - time.monotonic()
+                        if wait <= 0:
+                            raise DeadlineExceeded() if by_deadline else TaskTimeout(self.name)
+                        self._cond.wait(wait)
+                finally:
+                    self._waiting -= 1
+                    self._publish()
+            if self._idle:
+                return self._idle.pop()
+            self._started += 1
+            self._publish()
+            name = f"{self.name}-{self._started}"
+
+        try:
+            return _Worker(self._context, self.initializer, self.initargs, name)
+        except BaseException:
+            with self._cond:
+                self._started -= 1
+                self._publish()
+                self._cond.notify()
+            raise
+
+    def _checkin(self, worker, healthy):
+        if not healthy:
+            worker.stop(kill=True)
+        with self._cond:
+            if healthy and os.getpid() == self._pid:
+                self._idle.append(worker)
+            else:
+                self._started -= 1
+            self._publish()
+            self._cond.notify()
+
+    def _publish(self):
+        metrics.COMPUTE_PROCESSES.labels(self.name).set(self._started)
+        metrics.COMPUTE_QUEUE_DEPTH.labels(self.name).set(self._waiting)
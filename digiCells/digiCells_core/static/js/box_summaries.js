@@ -0,0 +1,78 @@
+// Box plots of several genes side by side, one panel per gene, drawn from the statistics of the
+// box_plot_summaries view rather than from raw values. Needs Plotly and plot_payload.js.
+
+async function showBoxSummaries(request, containerId, csrfToken) {
+    const container = document.getElementById(containerId);
+    const form = new FormData();
+    request.genes.forEach(gene => form.append('genes', gene));
+    request.conditions.forEach(condition => form.append('conditions', condition));
+    form.append('display_field', request.display_field || '');
+    if (request.normalisation.center) {
+        form.append('norm_center', request.normalisation.center);
+    }
+    if (request.normalisation.scale) {
+        form.append('norm_scale', request.normalisation.scale);
+    }
+    form.append('points', '1');
+
+    container.textContent = 'Loading…';
+    const response = await fetch(request.url, {
+        method: 'POST',
+        body: form,
+        headers: { 'X-CSRFToken': csrfToken },
+        credentials: 'same-origin'
+    });
+    const body = await response.json();
+    if (!response.ok) {
+        container.textContent = body.error || response.statusText;
+        return;
+    }
+    if (!body.genes.length) {
+        container.textContent = 'None of these genes are available.';
+        return;
+    }
+    container.textContent = '';
+
+    const stats = {};
+    Object.entries(body.stats).forEach(([name, packed]) => { stats[name] = decodeValues(packed); });
+    const points = decodeValues(body.points);
+    const sampleGroups = body.samples.map(sample => sample.replace(/_R\d+$/, ''));
+
+    const columns = Math.min(3, body.genes.length);
+    const rows = Math.ceil(body.genes.length / columns);
+    const traces = [];
+    const layout = {
+        grid: { rows: rows, columns: columns, pattern: 'independent' },
+        height: 300 * rows,
+        showlegend: false
+    };
+    body.genes.forEach((gene, row) => {
+        const axis = row === 0 ? '' : String(row + 1);
+        traces.push({
+            type: 'box',
+            name: gene,
+            x: body.groups,
+            lowerfence: stats.min[row],
+            q1: stats.q1[row],
+            median: stats.median[row],
+            q3: stats.q3[row],
+            upperfence: stats.max[row],
+            mean: stats.mean[row],
+            sd: stats.sd[row],
+            xaxis: 'x' + axis,
+            yaxis: 'y' + axis
+        });
+        traces.push({
+            type: 'scatter',
+            mode: 'markers',
+            x: sampleGroups,
+            y: points[row],
+            text: body.samples,
+            marker: { size: 4, color: 'black' },
+            xaxis: 'x' + axis,
+            yaxis: 'y' + axis
+        });
+        layout['yaxis' + axis] = { title: gene };
+    });
+    Plotly.newPlot(container, traces, layout);
+}
@@ -0,0 +1,28 @@
+// Decodes the plot payloads of bitbio_nucleus_bulk_rna.payloads: base64 of little-endian
+// float32 values, with their shape.
+
+function decodeValues(packed) {
+    const bytes = atob(packed.data);
+    const buffer = new Uint8Array(bytes.length);
+    for (let i = 0; i < bytes.length; i++) {
+        buffer[i] = bytes.charCodeAt(i);
+    }
+    // Float32Array reads in the platform's byte order, little-endian in every browser we support
+    const values = new Float32Array(buffer.buffer);
+    if (packed.shape.length === 1) {
+        return Array.from(values);
+    }
+    const [rows, columns] = packed.shape;
+    const matrix = new Array(rows);
+    for (let row = 0; row < rows; row++) {
+        matrix[row] = Array.from(values.subarray(row * columns, (row + 1) * columns));
+    }
+    return matrix;
+}
+
+// Parses the payload emitted by {{ payload|json_script:id }} and decodes its values
+function readPlotPayload(id) {
+    const payload = JSON.parse(document.getElementById(id).textContent);
+    payload.values = decodeValues(payload.values);
+    return payload;
+}
@@ -0,0 +1,95 @@
+// Tiled heatmap for large gene selections (bitbio_nucleus_bulk_rna.heatmaps): a mean-pooled
+// overview of every gene next to one window of genes at full resolution, fetched from the tile
+// view as the user moves through them. Needs Plotly and plot_payload.js.
+
+function showTiledHeatmap(payload, ids) {
+    const genes = payload.genes;
+    const tileCount = Math.ceil(genes.length / payload.tile_rows);
+    const starts = payload.overview_starts;
+    const tiles = new Map([[0, payload.values]]);
+    let current = 0;
+
+    const binOf = row => {
+        let bin = 0;
+        while (bin + 1 < starts.length && starts[bin + 1] <= row) {
+            bin++;
+        }
+        return bin;
+    };
+    const binLabels = starts.map((start, bin) => {
+        const last = (bin + 1 < starts.length ? starts[bin + 1] : genes.length) - 1;
+        return last > start ? `${genes[start]} … ${genes[last]}` : genes[start];
+    });
+
+    Plotly.newPlot(ids.overview, [{
+        z: decodeValues(payload.overview),
+        x: payload.conditions,
+        y: binLabels,
+        type: 'heatmap',
+        colorscale: 'Viridis'
+    }], {
+        title: `Overview of ${genes.length} genes`,
+        xaxis: { title: 'Conditions' },
+        yaxis: { autorange: 'reversed', showticklabels: false },
+        shapes: []
+    });
+
+    async function fetchTile(tile) {
+        if (!tiles.has(tile)) {
+            const response = await fetch(`${payload.tile_url}?tile=${tile}`, { credentials: 'same-origin' });
+            const body = await response.json();
+            if (!response.ok) {
+                throw new Error(body.error || response.statusText);
+            }
+            tiles.set(tile, decodeValues(body.values));
+        }
+        return tiles.get(tile);
+    }
+
+    async function show(tile) {
+        tile = Math.max(0, Math.min(tileCount - 1, tile));
+        const status = document.getElementById(ids.status);
+        let values;
+        try {
+            values = await fetchTile(tile);
+        } catch (error) {
+            status.textContent = error.message;
+            return;
+        }
+        current = tile;
+        const start = tile * payload.tile_rows;
+        const stop = Math.min(start + payload.tile_rows, genes.length);
+
+        Plotly.react(ids.detail, [{
+            z: values,
+            x: payload.conditions,
+            y: genes.slice(start, stop),
+            type: 'heatmap',
+            colorscale: 'Viridis'
+        }], {
+            title: 'Gene Expression Heatmap',
+            xaxis: { title: 'Conditions' },
+            yaxis: { title: 'Genes', autorange: 'reversed' }
+        });
+        // Outline the window on the overview
+        Plotly.relayout(ids.overview, {
+            shapes: [{
+                type: 'rect', xref: 'paper', x0: 0, x1: 1,
+                y0: binOf(start) - 0.5, y1: binOf(stop - 1) + 0.5,
+                line: { color: 'red', width: 2 }
+            }]
+        });
+        status.textContent = `Genes ${start + 1}–${stop} of ${genes.length}`;
+        document.getElementById(ids.previous).disabled = tile === 0;
+        document.getElementById(ids.next).disabled = tile === tileCount - 1;
+    }
+
+    document.getElementById(ids.previous).addEventListener('click', () => show(current - 1));
+    document.getElementById(ids.next).addEventListener('click', () => show(current + 1));
+    // Clicking the overview jumps to the window holding the clicked genes
+    document.getElementById(ids.overview).on('plotly_click', event => {
+        const bin = event.points[0].pointIndex[0];
+        show(Math.floor(starts[bin] / payload.tile_rows));
+    });
+    show(0);
+}
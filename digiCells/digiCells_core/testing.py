@@ -0,0 +1,68 @@
+from contextlib import contextmanager
+
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+from .middleware import QueryStats, get_query_budget
+
+
+@contextmanager
+def assert_max_queries(max_queries, allow_duplicates=True):
+    """
+    Fail if the wrapped block runs more than ``max_queries`` queries.
+
+    Unlike ``assertNumQueries`` this is an upper bound, and the failure message lists the
+    repeated query signatures so an N+1 is easy to spot.
+
+    Usage:
+        with assert_max_queries(6):
+            client.get(url)
+    """
+    with QueryStats() as stats:
+        yield stats
+
+    duplicates = stats.duplicates()
+    if stats.count > max_queries or (duplicates and not allow_duplicates):
+        repeated = "\n".join(f"  {n}x {signature}" for signature, n in duplicates)
+        raise AssertionError(
+            f"{stats.count} queries run ({stats.total_time * 1000:.1f} ms), budget is {max_queries}."
+            + (f"\nRepeated queries:\n{repeated}" if repeated else "")
+        )
+
+
+class QueryBudgetTestMixin:
+    """
+    TestCase mixin that checks responses against the per-view budgets in QUERY_BUDGETS.
+
+    Requires QueryBudgetMiddleware, which attaches ``query_stats`` to every response.
+    """
+
+    def assertWithinQueryBudget(self, response, budget=None):
+        view_name = response.resolver_match.view_name
+        budget = budget if budget is not None else get_query_budget(view_name)
+        if budget is None:
+            self.fail(f"No query budget declared for {view_name}")
+
+        stats = response.query_stats
+        if stats.count > budget:
+            repeated = "\n".join(f"  {n}x {signature}" for signature, n in stats.duplicates())
+            self.fail(
+                f"{view_name} ran {stats.count} queries, budget is {budget}."
+                + (f"\nRepeated queries:\n{repeated}" if repeated else "")
+            )
+
+
+class QueryBudgetTestRunner(DiscoverRunner):
+    """
+    Test runner that turns QUERY_BUDGET_STRICT on, so that any request overrunning its
+    budget in QUERY_BUDGETS raises QueryBudgetExceeded and fails its test.
+    """
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self._strict_budgets = override_settings(QUERY_BUDGET_STRICT=True)
+        self._strict_budgets.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self._strict_budgets.disable()
+        super().teardown_test_environment(**kwargs)
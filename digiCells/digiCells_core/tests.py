@@ -1,3 +1,137 @@
-from django.test import TestCase
+import tempfile
+import threading
+import time
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from .executors import run_io
+from .locks import SlotPool
+from .middleware import QueryBudgetExceeded, QueryStats, current_query_stats
+from .processes import PoolBusy, ProcessPool, TaskTimeout
+
+
+class MetricsAccessTests(TestCase):
+    def test_direct_scrape_from_allowed_network(self):
+        response = self.client.get(reverse("metrics"), REMOTE_ADDR="127.0.0.1")
+        self.assertIn(response.status_code, (200, 503))
+
+    def test_other_addresses_are_refused(self):
+        response = self.client.get(reverse("metrics"), REMOTE_ADDR="203.0.113.7")
+        self.assertEqual(response.status_code, 403)
+
+    @override_settings(METRICS_ALLOWED_NETWORKS=["10.0.0.0/8"])
+    def test_requests_relayed_by_a_proxy_are_refused(self):
+        response = self.client.get(reverse("metrics"), REMOTE_ADDR="10.1.2.3", HTTP_X_FORWARDED_FOR="203.0.113.7")
+        self.assertEqual(response.status_code, 403)
+        response = self.client.get(reverse("metrics"), REMOTE_ADDR="10.1.2.3")
+        self.assertIn(response.status_code, (200, 503))
+
+
+class RequestIdTests(TestCase):
+    def test_valid_request_id_is_echoed(self):
+        response = self.client.get(reverse("login"), HTTP_X_REQUEST_ID="load-test.42_a")
+        self.assertEqual(response["X-Request-ID"], "load-test.42_a")
+
+    def test_unsafe_request_ids_are_replaced(self):
+        for incoming in ("abc\nfake log line", "a" * 65, "id with spaces", ""):
+            response = self.client.get(reverse("login"), HTTP_X_REQUEST_ID=incoming)
+            self.assertNotEqual(response["X-Request-ID"], incoming)
+            self.assertRegex(response["X-Request-ID"], r"^[0-9a-f]{32}$")
+
+
+class QueryBudgetTests(TestCase):
+    @override_settings(QUERY_BUDGETS={"index": 1})
+    def test_overruns_fail_the_tests(self):
+        self.client.force_login(User.objects.create_user("user", password="password"))
+        with self.assertRaises(QueryBudgetExceeded):
+            self.client.get(reverse("index"))
+
+
+class PoolQueryTests(TestCase):
+    def test_pool_queries_count_towards_the_request(self):
+        # As QueryBudgetMiddleware does under ASGI
+        async def request():
+            stats = QueryStats()
+            await sync_to_async(stats.__enter__)()
+            try:
+                await run_io(User.objects.count)
+            finally:
+                await sync_to_async(stats.__exit__)(None, None, None)
+            return stats, current_query_stats()
+
+        stats, after = async_to_sync(request)()
+        self.assertEqual(stats.count, 1)
+        self.assertIsNone(after)
+
+
+class AdmissionControlTests(TestCase):
+    def setUp(self):
+        lock_dir = self.enterContext(tempfile.TemporaryDirectory())
+        self.enterContext(
+            self.settings(
+                ADMISSION_LIMITS={"login": {"concurrency": 1, "queue": 1}},
+                ADMISSION_LOCK_DIR=lock_dir,
+                ADMISSION_QUEUE_TIMEOUT=0.2,
+                ADMISSION_RETRY_AFTER=7,
+            )
+        )
+        self.slots = SlotPool(lock_dir, "login", 1)
+        self.queue = SlotPool(lock_dir, "login.queue", 1)
+
+    def assertTurnedAway(self, response):
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], "7")
+
+    def test_requests_release_their_slot(self):
+        for _ in range(2):
+            self.assertEqual(self.client.get(reverse("login")).status_code, 200)
+        slot = self.slots.try_acquire()
+        self.assertIsNotNone(slot)
+        self.slots.release(slot)
+
+    def test_requests_beyond_a_full_queue_are_turned_away_at_once(self):
+        slot, queue_slot = self.slots.try_acquire(), self.queue.try_acquire()
+        start = time.monotonic()
+        self.assertTurnedAway(self.client.get(reverse("login")))
+        self.assertLess(time.monotonic() - start, 0.2)
+        self.slots.release(slot)
+        self.queue.release(queue_slot)
+        self.assertEqual(self.client.get(reverse("login")).status_code, 200)
+
+    def test_queued_requests_are_turned_away_after_the_queue_timeout(self):
+        slot = self.slots.try_acquire()
+        try:
+            self.assertTurnedAway(self.client.get(reverse("login")))
+        finally:
+            self.slots.release(slot)
+        # The request left the queue
+        queue_slot = self.queue.try_acquire()
+        self.assertIsNotNone(queue_slot)
+        self.queue.release(queue_slot)
+
+
+class ProcessPoolTests(TestCase):
+    def setUp(self):
+        self.pool = ProcessPool("test", size=1, max_queue=0, task_timeout=30)
+        self.addCleanup(self.pool.shutdown)
+
+    def test_callers_beyond_the_queue_are_turned_away(self):
+        busy = threading.Thread(target=self.pool.call, args=(time.sleep, (1,)))
+        busy.start()
+        self.addCleanup(busy.join)
+        while self.pool.stats()["processes"] == 0:
+            time.sleep(0.01)
+        with self.assertRaises(PoolBusy):
+            self.pool.call(divmod, (7, 2))
+
+    def test_tasks_past_their_timeout_are_stopped(self):
+        start = time.monotonic()
+        with self.assertRaises(TaskTimeout):
+            self.pool.call(time.sleep, (30,), timeout=0.5)
+        self.assertLess(time.monotonic() - start, 10)
+        self.assertEqual(self.pool.stats()["processes"], 0)
+        # Replaced by a new process
+        self.assertEqual(self.pool.call(divmod, (7, 2)), (3, 1))
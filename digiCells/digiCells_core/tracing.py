@@ -0,0 +1,192 @@
+"""
+Lightweight per-request tracing.
+
+RequestTracingMiddleware starts a trace for every request, identified by the incoming
+X-Request-ID header when it is a short token (letters, digits, ".", "_" and "-", at most 64)
+or else a fresh UUID, and returns the ID in the response. Code on the request
+path wraps its stages in ``span()``:
+
+    with span("normalise", genes=len(genes)):
+        ...
+
+When the request finishes the trace (request ID, view, status, total time and every span
+with its duration and attributes) is logged to the "digiCells.trace" logger, at INFO for
+requests slower than TRACE_SLOW_REQUEST_SECONDS and DEBUG otherwise, and appended as one
+JSON line to TRACE_FILE if that is set. Span durations also feed bulk_rna_stage_seconds.
+"""
+
+import contextvars
+import json
+import logging
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+from . import metrics
+from .admission import check_deadline
+
+logger = logging.getLogger("digiCells.trace")
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+_REQUEST_ID = re.compile(r"[A-Za-z0-9._-]{1,64}")
+_trace_file_lock = threading.Lock()
+
+
+class Trace:
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self.start = time.perf_counter()
+        self.spans = []
+
+    def add_span(self, name, offset, duration, attributes):
+        self.spans.append(
+            {
+                "name": name,
+                "offset_ms": round(offset * 1000, 3),
+                "duration_ms": round(duration * 1000, 3),
+                **attributes,
+            }
+        )
+
+    def as_dict(self, **fields):
+        return {
+            "request_id": self.request_id,
+            **fields,
+            "duration_ms": round((time.perf_counter() - self.start) * 1000, 3),
+            "spans": self.spans,
+        }
+
+
+def current_request_id():
+    trace = _current_trace.get()
+    return trace.request_id if trace else None
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Time a stage of the current request. Works outside a request too (only the metric is recorded).
+    Attributes can be added inside the block through the yielded dict.
+
+    Raises DeadlineExceeded instead of starting the stage once the request is past its deadline.
+    """
+    check_deadline()
+    trace = _current_trace.get()
+    start = time.perf_counter()
+    try:
+        yield attributes
+    finally:
+        duration = time.perf_counter() - start
+        metrics.STAGE_SECONDS.labels(name).observe(duration)
+        if trace is not None:
+            trace.add_span(name, start - trace.start, duration, attributes)
+
+
+@contextmanager
+def capture_spans():
+    """
+    Records the spans of the block in a trace of its own and yields their list, to be sent
+    back from another process and passed to add_spans().
+    """
+    trace = Trace(current_request_id())
+    token = _current_trace.set(trace)
+    try:
+        yield trace.spans
+    finally:
+        _current_trace.reset(token)
+
+
+def add_spans(spans, start):
+    """Adds spans captured elsewhere to the current trace, with offsets relative to `start` (perf_counter)."""
+    trace = _current_trace.get()
+    if trace is None:
+        return
+    offset_ms = round((start - trace.start) * 1000, 3)
+    for captured in spans:
+        trace.spans.append({**captured, "offset_ms": round(captured["offset_ms"] + offset_ms, 3)})
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats log records as one JSON object per line, merging in a dict passed as ``extra={"trace": ...}``."""
+
+    def format(self, record):
+        payload = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        trace = getattr(record, "trace", None)
+        if trace:
+            payload.update(trace)
+        elif current_request_id():
+            payload["request_id"] = current_request_id()
+        if record.exc_info:
+            payload["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(payload, default=str)
+
+
+def request_id(request):
+    """
+    The client's X-Request-ID if it is safe to log and echo back, else a new ID: the header is
+    client-controlled, and could otherwise inject lines into the logs.
+    """
+    incoming = request.headers.get("X-Request-ID", "")
+    if _REQUEST_ID.fullmatch(incoming):
+        return incoming
+    return uuid.uuid4().hex
+
+
+class RequestTracingMiddleware:
+    async_capable = True
+    sync_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        trace = Trace(request_id(request))
+        request.request_id = trace.request_id
+        token = _current_trace.set(trace)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current_trace.reset(token)
+        return self._finish(trace, request, response)
+
+    async def __acall__(self, request):
+        trace = Trace(request_id(request))
+        request.request_id = trace.request_id
+        token = _current_trace.set(trace)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current_trace.reset(token)
+        return self._finish(trace, request, response)
+
+    def _finish(self, trace, request, response):
+        response["X-Request-ID"] = trace.request_id
+        if trace.spans:
+            self._emit(trace, request, response)
+        return response
+
+    def _emit(self, trace, request, response):
+        view_name = request.resolver_match.view_name if request.resolver_match else request.path
+        record = trace.as_dict(view=view_name, method=request.method, status=response.status_code)
+
+        slow = record["duration_ms"] >= getattr(settings, "TRACE_SLOW_REQUEST_SECONDS", 2.0) * 1000
+        logger.log(logging.INFO if slow else logging.DEBUG, "trace %s", view_name, extra={"trace": record})
+
+        trace_file = getattr(settings, "TRACE_FILE", None)
+        if trace_file:
+            with _trace_file_lock, open(trace_file, "a") as handle:
+                handle.write(json.dumps(record, default=str) + "\n")
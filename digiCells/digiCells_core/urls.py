@@ -9,4 +9,5 @@ urlpatterns = [
     path("login/", views.login_request, name="login"),
     path("logout/", views.logout_request, name="logout"),
     path("csrf-debug/", views.csrf_debug, name="csrf_debug"),
+    path("metrics", views.metrics, name="metrics"),
 ]
@@ -1,11 +1,15 @@
+import ipaddress
+
+from django.conf import settings
 from django.shortcuts import render, redirect
-from django.http import HttpResponse, JsonResponse
+from django.http import HttpResponse, HttpResponseForbidden, JsonResponse
 from django.contrib.auth import login, logout
 from django.contrib import messages
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.middleware.csrf import get_token
 from .forms import LoginForm
+from . import metrics as app_metrics
 
 
 def index(request):
@@ -49,3 +53,25 @@ def csrf_debug(request):
             }
         )
     return JsonResponse({"error": "Only GET requests allowed"})
+
+
+def _is_metrics_client(request):
+    # Requests relayed by nginx carry X-Forwarded-For: only direct scrapes are trusted
+    if "HTTP_X_FORWARDED_FOR" in request.META:
+        return False
+    try:
+        address = ipaddress.ip_address(request.META.get("REMOTE_ADDR", ""))
+    except ValueError:
+        return False
+    return any(address in ipaddress.ip_network(network) for network in settings.METRICS_ALLOWED_NETWORKS)
+
+
+@require_http_methods(["GET"])
+def metrics(request):
+    """Prometheus scrape endpoint, for the addresses in METRICS_ALLOWED_NETWORKS."""
+    if not _is_metrics_client(request):
+        return HttpResponseForbidden("Forbidden", content_type="text/plain")
+    if app_metrics.prometheus_client is None:
+        return HttpResponse("prometheus_client is not installed", status=503, content_type="text/plain")
+    payload, content_type = app_metrics.render_latest()
+    return HttpResponse(payload, content_type=content_type)
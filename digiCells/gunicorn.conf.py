@@ -0,0 +1,52 @@
+"""
+Gunicorn configuration, picked up automatically when gunicorn is started from this directory:
+
+    cd digiCells && gunicorn digiCells.wsgi
+
+or, to serve the async views on an event loop (needs uvicorn):
+
+    cd digiCells && GUNICORN_WORKER_CLASS=uvicorn.workers.UvicornWorker gunicorn digiCells.asgi
+"""
+
+import os
+import shutil
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("GUNICORN_WORKERS", "3"))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "120"))
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "sync")
+# Load the app in the master before forking. With BULK_RNA_WARM_ON_BOOT the datasets are then
+# warmed once, in the master, and every worker (including recycled ones) starts with them.
+preload_app = os.environ.get("GUNICORN_PRELOAD_APP", "False").lower() == "true"
+
+# Prometheus multiprocess mode: every worker writes its samples into this directory and
+# /metrics aggregates them. It has to be set before prometheus_client is imported.
+prometheus_multiproc_dir = os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tmp", "prometheus")
+)
+
+
+def on_starting(server):
+    # Samples left over from a previous run would be aggregated into the new one
+    shutil.rmtree(prometheus_multiproc_dir, ignore_errors=True)
+    os.makedirs(prometheus_multiproc_dir, exist_ok=True)
+
+
+def child_exit(server, worker):
+    from digiCells_core.metrics import mark_process_dead
+
+    mark_process_dead(worker.pid)
+
+
+def when_ready(server):
+    if preload_app:
+        from bitbio_nucleus_bulk_rna.warmup import warm_on_boot
+
+        warm_on_boot(background=False)
+
+
+def post_worker_init(worker):
+    if not preload_app:
+        from bitbio_nucleus_bulk_rna.warmup import warm_on_boot
+
+        warm_on_boot(background=True)